@@ -8,6 +8,8 @@ import scipy.ndimage as ndi
 from skimage.color import rgb2gray, gray2rgb
 from skimage import img_as_float
 
+from dataset_loaders.profiling import null_timer
+
 
 def optical_flow(seq, rows_idx, cols_idx, chan_idx, return_rgb=False):
     '''Optical flow
@@ -167,11 +169,13 @@ def apply_transform(x, transform_matrix, fill_mode='nearest', cval=0.,
     return x
 
 
-def random_channel_shift(x, shift_range, rows_idx, cols_idx, chan_idx):
+def random_channel_shift(x, shift_range, rows_idx, cols_idx, chan_idx,
+                         rng=None):
     '''Shift the intensity values of each channel uniformly.
 
     Channel by channel, shift all the intensity values by a random value in
     [-shift_range, shift_range]'''
+    rng = np.random if rng is None else rng
     pattern = [chan_idx]
     pattern += [el for el in range(x.ndim) if el not in [rows_idx, cols_idx,
                                                          chan_idx]]
@@ -184,7 +188,7 @@ def random_channel_shift(x, shift_range, rows_idx, cols_idx, chan_idx):
     # Loop on the channels/batches/etc
     for i in range(x.shape[0]):
         min_x, max_x = np.min(x), np.max(x)
-        x[i] = np.clip(x[i] + np.random.uniform(-shift_range, shift_range),
+        x[i] = np.clip(x[i] + rng.uniform(-shift_range, shift_range),
                        min_x, max_x)
     x = x.reshape(x_shape)  # unsquash
     x = x.transpose(inv_pattern)
@@ -262,9 +266,10 @@ def pad_image(x, pad_amount, mode='reflect', constant=0.):
     return x_padded
 
 
-def gen_warp_field(shape, sigma=0.1, grid_size=3):
+def gen_warp_field(shape, sigma=0.1, grid_size=3, rng=None):
     '''Generate an spline warp field'''
     import SimpleITK as sitk
+    rng = np.random if rng is None else rng
     # Initialize bspline transform
     args = shape+(sitk.sitkFloat32,)
     ref_image = sitk.Image(*args)
@@ -272,7 +277,7 @@ def gen_warp_field(shape, sigma=0.1, grid_size=3):
 
     # Initialize shift in control points:
     # mesh size = number of control points - spline order
-    p = sigma * np.random.randn(grid_size+3, grid_size+3, 2)
+    p = sigma * rng.randn(grid_size+3, grid_size+3, 2)
 
     # Anchor the edges of the image
     p[:, 0, :] = 0
@@ -357,7 +362,9 @@ def random_transform(x, y=None,
                      cols_idx=2,  # No batch yet: (s, 0, 1, c)
                      void_label=None,
                      mask_labels=[],
-                     prescale=1.0):
+                     prescale=1.0,
+                     rng=None,
+                     timer=None):
     '''Random Transform.
 
     A function to perform data augmentation of images and masks during
@@ -465,6 +472,14 @@ def random_transform(x, y=None,
     mask_labels: list of strings
         The list of the mask labels. Used in smart cropping to look for
         the background label.
+    rng: :class:`numpy.random.RandomState` instance
+        The random number generator used to draw the parameters of the
+        transformations. If None, the numpy global random number
+        generator will be used. Default: None.
+    timer: callable
+        If not None, `timer(stage)` should return a context manager
+        used to time each transformation, with stage in 'affine',
+        'flip', 'warp', 'crop' and 'optical_flow'. Default: None.
 
     References
     ----------
@@ -482,6 +497,8 @@ def random_transform(x, y=None,
                            '3 dimensions. Received %d instead.' % x.ndim)
     if rescale:
         raise NotImplementedError()
+    rng = np.random if rng is None else rng
+    timer = null_timer if timer is None else timer
 
     # Do not modify the original images
     x = x.copy()
@@ -522,7 +539,7 @@ def random_transform(x, y=None,
     # Channel shift
     if channel_shift_range != 0:
         x = random_channel_shift(x, channel_shift_range, rows_idx, cols_idx,
-                                 chan_idx)
+                                 chan_idx, rng)
 
     # Gamma correction
     if gamma > 0:
@@ -535,8 +552,8 @@ def random_transform(x, y=None,
 
         # --> Rotation
         if rotation_range:
-            theta = np.pi / 180 * np.random.uniform(-rotation_range,
-                                                    rotation_range)
+            theta = np.pi / 180 * rng.uniform(-rotation_range,
+                                             rotation_range)
         else:
             theta = 0
         rotation_matrix = np.array([[np.cos(theta), -np.sin(theta), 0],
@@ -544,12 +561,12 @@ def random_transform(x, y=None,
                                     [0, 0, 1]])
         # --> Shift/Translation
         if height_shift_range:
-            tx = (np.random.uniform(-height_shift_range, height_shift_range) *
+            tx = (rng.uniform(-height_shift_range, height_shift_range) *
                   x.shape[rows_idx])
         else:
             tx = 0
         if width_shift_range:
-            ty = (np.random.uniform(-width_shift_range, width_shift_range) *
+            ty = (rng.uniform(-width_shift_range, width_shift_range) *
                   x.shape[cols_idx])
         else:
             ty = 0
@@ -558,7 +575,7 @@ def random_transform(x, y=None,
                                        [0, 0, 1]])
         # --> Shear
         if shear_range:
-            shear = np.random.uniform(-shear_range, shear_range)
+            shear = rng.uniform(-shear_range, shear_range)
         else:
             shear = 0
         shear_matrix = np.array([[1, -np.sin(shear), 0],
@@ -568,7 +585,7 @@ def random_transform(x, y=None,
         if zoom_range == [1, 1]:
             zx, zy = 1, 1
         else:
-            zx, zy = np.random.uniform(zoom_range[0], zoom_range[1], 2)
+            zx, zy = rng.uniform(zoom_range[0], zoom_range[1], 2)
         zoom_matrix = np.array([[zx, 0, 0],
                                 [0, zy, 0],
                                 [0, 0, 1]])
@@ -581,25 +598,28 @@ def random_transform(x, y=None,
         transform_matrix = transform_matrix_offset_center(transform_matrix,
                                                           h, w)
         # Apply all the transformations together
-        x = apply_transform(x, transform_matrix, fill_mode=fill_mode,
-                            cval=cval, order=1, rows_idx=rows_idx,
-                            cols_idx=cols_idx)
-        if y is not None and len(y) > 0:
-            y = apply_transform(y, transform_matrix, fill_mode=fill_mode,
-                                cval=cval_mask, order=0, rows_idx=rows_idx,
+        with timer('affine'):
+            x = apply_transform(x, transform_matrix, fill_mode=fill_mode,
+                                cval=cval, order=1, rows_idx=rows_idx,
                                 cols_idx=cols_idx)
+            if y is not None and len(y) > 0:
+                y = apply_transform(y, transform_matrix, fill_mode=fill_mode,
+                                    cval=cval_mask, order=0,
+                                    rows_idx=rows_idx, cols_idx=cols_idx)
 
     # Horizontal flip
-    if np.random.random() < horizontal_flip:  # 0 = disabled
-        x = flip_axis(x, cols_idx)
-        if y is not None and len(y) > 0:
-            y = flip_axis(y, cols_idx)
+    if rng.random_sample() < horizontal_flip:  # 0 = disabled
+        with timer('flip'):
+            x = flip_axis(x, cols_idx)
+            if y is not None and len(y) > 0:
+                y = flip_axis(y, cols_idx)
 
     # Vertical flip
-    if np.random.random() < vertical_flip:  # 0 = disabled
-        x = flip_axis(x, rows_idx)
-        if y is not None and len(y) > 0:
-            y = flip_axis(y, rows_idx)
+    if rng.random_sample() < vertical_flip:  # 0 = disabled
+        with timer('flip'):
+            x = flip_axis(x, rows_idx)
+            if y is not None and len(y) > 0:
+                y = flip_axis(y, rows_idx)
 
     # Spline warp
     if spline_warp:
@@ -607,114 +627,120 @@ def random_transform(x, y=None,
         warp_field = gen_warp_field(shape=(x.shape[rows_idx],
                                            x.shape[cols_idx]),
                                     sigma=warp_sigma,
-                                    grid_size=warp_grid_size)
-        x = apply_warp(x, warp_field,
-                       interpolator=sitk.sitkLinear,
-                       fill_mode=fill_mode,
-                       fill_constant=cval,
-                       rows_idx=rows_idx, cols_idx=cols_idx)
-        if y is not None and len(y) > 0:
-            y = np.round(apply_warp(y, warp_field,
-                                    interpolator=sitk.sitkNearestNeighbor,
-                                    fill_mode=fill_mode,
-                                    fill_constant=cval_mask,
-                                    rows_idx=rows_idx, cols_idx=cols_idx))
+                                    grid_size=warp_grid_size,
+                                    rng=rng)
+        with timer('warp'):
+            x = apply_warp(x, warp_field,
+                           interpolator=sitk.sitkLinear,
+                           fill_mode=fill_mode,
+                           fill_constant=cval,
+                           rows_idx=rows_idx, cols_idx=cols_idx)
+            if y is not None and len(y) > 0:
+                y = np.round(apply_warp(
+                    y, warp_field, interpolator=sitk.sitkNearestNeighbor,
+                    fill_mode=fill_mode, fill_constant=cval_mask,
+                    rows_idx=rows_idx, cols_idx=cols_idx))
 
     # Crop
     # Expects axes with shape (..., 0, 1)
     # TODO: Add center crop
     if crop_size:
-        # Reshape to (..., 0, 1)
-        pattern = [el for el in range(x.ndim) if el != rows_idx and
-                   el != cols_idx] + [rows_idx, cols_idx]
-        inv_pattern = [pattern.index(el) for el in range(x.ndim)]
-        x = x.transpose(pattern)
-
-        crop = list(crop_size)
-        pad = [0, 0]
-        h, w = x.shape[-2:]
-
-        # Compute crop and padding amounts
-        if crop[0] < h:
-            if crop_mode == 'random':
-                top = np.random.randint(h - crop[0])
-        else:
-            # Set pad and disable crop
-            pad[0] = crop[0] - h
-            top, crop[0] = 0, h
-        if crop[1] < w:
-            if crop_mode == 'random':
-                left = np.random.randint(w - crop[1])
-        else:
-            # Set pad and disable crop
-            pad[1] = crop[1] - w
-            left, crop[1] = 0, w
-
-        if crop_mode == 'smart':
-            if y is None or len(y) < 1:
-                raise RuntimeError('Cannot use smart cropping without labels')
-
-            if pad[0] == 0 or pad[1] == 0:  # We crop in at least one dimension
-                # Look for the background label, or assume it to be 0
-                bg_label = np.where([m.lower() == 'background' for m
-                                     in mask_labels])[0]
-                if len(bg_label) == 0:
-                    bg_label = np.where([m.lower() == 'void' for m
+        with timer('crop'):
+            # Reshape to (..., 0, 1)
+            pattern = [el for el in range(x.ndim) if el != rows_idx and
+                       el != cols_idx] + [rows_idx, cols_idx]
+            inv_pattern = [pattern.index(el) for el in range(x.ndim)]
+            x = x.transpose(pattern)
+
+            crop = list(crop_size)
+            pad = [0, 0]
+            h, w = x.shape[-2:]
+
+            # Compute crop and padding amounts
+            if crop[0] < h:
+                if crop_mode == 'random':
+                    top = rng.randint(h - crop[0])
+            else:
+                # Set pad and disable crop
+                pad[0] = crop[0] - h
+                top, crop[0] = 0, h
+            if crop[1] < w:
+                if crop_mode == 'random':
+                    left = rng.randint(w - crop[1])
+            else:
+                # Set pad and disable crop
+                pad[1] = crop[1] - w
+                left, crop[1] = 0, w
+
+            if crop_mode == 'smart':
+                if y is None or len(y) < 1:
+                    raise RuntimeError('Cannot use smart cropping without '
+                                       'labels')
+
+                # We crop in at least one dimension
+                if pad[0] == 0 or pad[1] == 0:
+                    # Look for the background label, or assume it to be 0
+                    bg_label = np.where([m.lower() == 'background' for m
                                          in mask_labels])[0]
-                bg_label = bg_label[0] if len(bg_label) else 0
-                # Sum the number of fg pixels in time in each location
-                fg_mask = y[..., 0] != bg_label  # 3D: seq, 0, 1
-                t_fg = fg_mask.sum(axis=0)  # accumulate over time --> 2D
-
-                # Compute the sum of the cumulated masks (i.e., the number of
-                # fg pixels over time) of each candidate crop. The result is a
-                # matrix of the cumulated fg values of the crop whose top-left
-                # corner is positioned in each location
-                from scipy.signal import fftconvolve
-                effective_crop_size = [cr if cr < sz else sz for cr, sz in
-                                       zip(crop_size, (h, w))]
-                crop_filter = np.ones(effective_crop_size)
-                cum_t_fg = fftconvolve(t_fg, crop_filter, 'valid')
-                # Account for fft numerical instability
-                cum_t_fg = np.clip(cum_t_fg, 0, np.inf)
-
-                # Convert the comulated mask to a probability
-                tot_t_fg = cum_t_fg.sum(dtype=float)
-                p = (cum_t_fg / tot_t_fg).flatten()
-
-                # Select some coordinates stochastically, with probability
-                # of each location proportional to the cumulative amount of
-                # foreground pixels in time
-                n_locations = np.prod(cum_t_fg.shape)
-                idx = np.random.choice(n_locations, p=p)  # 1D coord
-                top, left = np.unravel_index(idx, cum_t_fg.shape)  # 2D
-
-        # Cropping
-        x = x[..., top:top+crop[0], left:left+crop[1]]
-        if y is not None and len(y) > 0:
-            y = y.transpose(pattern)
-            y = y[..., top:top+crop[0], left:left+crop[1]]
-        # Padding
-        if pad != [0, 0]:
-            pad_pattern = ((0, 0),) * (x.ndim - 2) + (
-                (pad[0]//2, pad[0] - pad[0]//2),
-                (pad[1]//2, pad[1] - pad[1]//2))
-            x = np.pad(x, pad_pattern, 'constant')
-            try:
-                y = np.pad(y, pad_pattern, 'constant',
-                           constant_values=void_label)
-            except ValueError as e:
-                raise type(e)(e.message + '\nCannot pad the image: the '
-                              'dataset has no void class')
-
-        x = x.transpose(inv_pattern)
-        if y is not None and len(y) > 0:
-            y = y.transpose(inv_pattern)
+                    if len(bg_label) == 0:
+                        bg_label = np.where([m.lower() == 'void' for m
+                                             in mask_labels])[0]
+                    bg_label = bg_label[0] if len(bg_label) else 0
+                    # Sum the number of fg pixels in time in each location
+                    fg_mask = y[..., 0] != bg_label  # 3D: seq, 0, 1
+                    t_fg = fg_mask.sum(axis=0)  # accumulate over time --> 2D
+
+                    # Compute the sum of the cumulated masks (i.e., the
+                    # number of fg pixels over time) of each candidate
+                    # crop. The result is a matrix of the cumulated fg
+                    # values of the crop whose top-left corner is
+                    # positioned in each location
+                    from scipy.signal import fftconvolve
+                    effective_crop_size = [cr if cr < sz else sz for cr, sz in
+                                           zip(crop_size, (h, w))]
+                    crop_filter = np.ones(effective_crop_size)
+                    cum_t_fg = fftconvolve(t_fg, crop_filter, 'valid')
+                    # Account for fft numerical instability
+                    cum_t_fg = np.clip(cum_t_fg, 0, np.inf)
+
+                    # Convert the comulated mask to a probability
+                    tot_t_fg = cum_t_fg.sum(dtype=float)
+                    p = (cum_t_fg / tot_t_fg).flatten()
+
+                    # Select some coordinates stochastically, with probability
+                    # of each location proportional to the cumulative amount of
+                    # foreground pixels in time
+                    n_locations = np.prod(cum_t_fg.shape)
+                    idx = rng.choice(n_locations, p=p)  # 1D coord
+                    top, left = np.unravel_index(idx, cum_t_fg.shape)  # 2D
+
+            # Cropping
+            x = x[..., top:top+crop[0], left:left+crop[1]]
+            if y is not None and len(y) > 0:
+                y = y.transpose(pattern)
+                y = y[..., top:top+crop[0], left:left+crop[1]]
+            # Padding
+            if pad != [0, 0]:
+                pad_pattern = ((0, 0),) * (x.ndim - 2) + (
+                    (pad[0]//2, pad[0] - pad[0]//2),
+                    (pad[1]//2, pad[1] - pad[1]//2))
+                x = np.pad(x, pad_pattern, 'constant')
+                try:
+                    y = np.pad(y, pad_pattern, 'constant',
+                               constant_values=void_label)
+                except ValueError as e:
+                    raise type(e)(e.message + '\nCannot pad the image: the '
+                                  'dataset has no void class')
+
+            x = x.transpose(inv_pattern)
+            if y is not None and len(y) > 0:
+                y = y.transpose(inv_pattern)
 
     if return_optical_flow:
-        flow = optical_flow(x, rows_idx, cols_idx, chan_idx,
-                            return_rgb=return_optical_flow == 'rgb')
-        x = np.concatenate((x, flow), axis=chan_idx)
+        with timer('optical_flow'):
+            flow = optical_flow(x, rows_idx, cols_idx, chan_idx,
+                                return_rgb=return_optical_flow == 'rgb')
+            x = np.concatenate((x, flow), axis=chan_idx)
 
     # Save augmented images
     if save_to_dir:
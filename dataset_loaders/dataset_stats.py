@@ -0,0 +1,190 @@
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+class Moments(object):
+    '''Mergeable running mean and variance, accumulated in float64
+
+    Implements the parallel variant of Welford's algorithm by Chan et
+    al. [Moments1]_: each update computes the moments of a whole array
+    with vectorized numpy operations and merges them with the current
+    ones, and the moments computed on different parts of a dataset
+    (e.g., by different workers) can be merged with :meth:`merge`.
+
+    Parameters
+    ----------
+    shape: tuple
+        The shape of the statistics, e.g., `(nchannels,)` for channel
+        statistics or the shape of the images for pixel statistics.
+        Default: ().
+
+    References
+    ----------
+    .. [Moments1] https://en.wikipedia.org/wiki/Algorithms_for_calculating_\
+variance#Parallel_algorithm
+    '''
+    def __init__(self, shape=()):
+        self.n = 0
+        self.mean = np.zeros(shape, 'float64')
+        self.m2 = np.zeros(shape, 'float64')
+
+    def update(self, x, axis=None):
+        '''Add the elements of `x` along `axis` (default: all the axes)
+
+        The shape of `x` without `axis` should be the shape of the
+        statistics.
+        '''
+        x = np.asarray(x, dtype='float64')
+        n = x.size if axis is None else x.shape[axis]
+        if n == 0:
+            return
+        mean = x.mean(axis=axis, keepdims=True)
+        m2 = ((x - mean) ** 2).sum(axis=axis)
+        self._merge(n, mean.reshape(m2.shape), m2)
+
+    def merge(self, other):
+        '''Add the elements accounted for by the moments `other`'''
+        if other.n:
+            self._merge(other.n, other.mean, other.m2)
+
+    def _merge(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (float(n) / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (float(self.n) * n / total)
+        self.n = total
+
+    @property
+    def variance(self):
+        return self.m2 / self.n if self.n else np.zeros_like(self.m2)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+class _PartialStats(object):
+    '''The statistics of a part of a dataset'''
+    def __init__(self, nchannels, nclasses):
+        self.channel = Moments((nchannels,))
+        self.pixel = None
+        self.pixel_shape = None
+        self.class_counts = np.zeros(nclasses, 'int64')
+        self.nframes = 0
+
+    def update(self, x, y=None):
+        '''Add a frame `x` of shape (0, 1, c) and its labels `y`'''
+        self.channel.update(x.reshape((-1, x.shape[-1])), axis=0)
+        if self.nframes == 0:
+            self.pixel_shape = x.shape
+            self.pixel = Moments(x.shape)
+        if self.pixel is not None and x.shape == self.pixel_shape:
+            self.pixel.update(x[np.newaxis], axis=0)
+        else:
+            # The frames have different shapes
+            self.pixel = None
+        if y is not None:
+            nc = len(self.class_counts)
+            self.class_counts += np.bincount(y.ravel().astype('int64'),
+                                             minlength=nc)[:nc]
+        self.nframes += 1
+
+    def merge(self, other):
+        if other.nframes == 0:
+            return
+        if self.nframes == 0:
+            self.pixel, self.pixel_shape = other.pixel, other.pixel_shape
+        elif (self.pixel is None or other.pixel is None or
+              self.pixel_shape != other.pixel_shape):
+            self.pixel = None
+        else:
+            self.pixel.merge(other.pixel)
+        self.channel.merge(other.channel)
+        self.class_counts += other.class_counts
+        self.nframes += other.nframes
+
+
+def compute_stats(dataset, nthreads=None, max_frames=None, rng=None):
+    '''Compute the statistics of the images and labels of a dataset
+
+    The frames of a :class:`~parallel_loader.ThreadedDataset` are loaded
+    with `load_sequence` (i.e., before any normalization or data
+    augmentation) by `nthreads` threads (default: the `nthreads` of the
+    dataset). The uint8 frames are converted to [0, 1] first, as by the
+    normalization of the dataset, so that the statistics can be used
+    as its `mean` and `std`. Each thread accumulates the statistics of
+    its frames and the partial statistics are merged at the end.
+
+    Parameters
+    ----------
+    dataset: :class:`~parallel_loader.ThreadedDataset`
+        The dataset.
+    nthreads: int
+        The number of threads. Default: None.
+    max_frames: int
+        If not None, the statistics are computed on a random subset of
+        `max_frames` frames. Default: None.
+    rng: :class:`numpy.random.RandomState`
+        The random number generator used to pick the subset of frames.
+        Default: None.
+
+    Returns
+    -------
+    A dict with the `channel_mean` and `channel_std` (one value per
+    channel), the `pixel_mean` and `pixel_std` (with the shape of the
+    frames, None if the frames have different shapes), the
+    `class_counts` and `class_freqs` of the labels, after the void
+    labels have been mapped (None if the set has no ground truth), and
+    the number of frames `nframes`.
+    '''
+    names = dataset._names
+    prefixes = dataset._prefixes[dataset._names_prefix]
+    frames = np.arange(len(names))
+    if max_frames is not None and max_frames < len(frames):
+        rng = rng if rng is not None else np.random.RandomState(0xbeef)
+        frames = np.sort(rng.choice(frames, max_frames, replace=False))
+    nthreads = max(nthreads or dataset.nthreads, 1)
+    has_gt = dataset.set_has_GT
+
+    def chunk_stats(chunk):
+        partial = None
+        for i in chunk:
+            ret = dataset.load_sequence([(prefixes[i], names[i])])
+            x = np.asarray(ret['data'])
+            x = x.reshape(x.shape[-3:])
+            if x.dtype == np.uint8:
+                x = x / 255.
+            y = None
+            if has_gt:
+                y = dataset._remap_labels(np.array(ret['labels']))
+            if partial is None:
+                partial = _PartialStats(x.shape[-1], dataset.nclasses)
+            partial.update(x, y)
+        return partial
+
+    # A few chunks per thread, to balance the load
+    chunks = np.array_split(frames, min(4 * nthreads, len(frames)))
+    pool = ThreadPool(nthreads)
+    try:
+        partials = [p for p in pool.map(chunk_stats, chunks)
+                    if p is not None]
+    finally:
+        pool.close()
+    if not partials:
+        raise RuntimeError('Cannot compute the statistics of an empty set')
+    stats = partials[0]
+    for partial in partials[1:]:
+        stats.merge(partial)
+
+    counts = stats.class_counts if has_gt else None
+    return {'channel_mean': stats.channel.mean,
+            'channel_std': stats.channel.std,
+            'pixel_mean': (stats.pixel.mean if stats.pixel is not None
+                           else None),
+            'pixel_std': (stats.pixel.std if stats.pixel is not None
+                          else None),
+            'class_counts': counts,
+            'class_freqs': (counts / float(max(counts.sum(), 1))
+                            if has_gt else None),
+            'nframes': stats.nframes}
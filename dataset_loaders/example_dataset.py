@@ -39,7 +39,9 @@ class ExampleDataset(ThreadedDataset):
     GTclasses = range(non_void_nclasses) + _void_labels
 
     # The dataset-wide statistics (either channel-wise or pixel-wise).
-    # `extra/running_stats` contains utilities to compute them.
+    # `dataset_stats` contains utilities to compute them. If they are
+    # not defined, `remove_mean` and `divide_by_std` compute (and
+    # cache) the channel-wise ones.
     mean = [0.1, 0.2, 0.3]
     std = [0.21, 0.22, 0.23]
 
@@ -61,32 +61,51 @@ calculate-a-running-standard-deviation>
         self.n = 0.
 
     def push(self, x, per_dim=True):
-        x = numpy.array(x).copy().astype('float16')
-        # process input
-        if per_dim:
+        '''Add an image (or mask) to the statistics
+
+        If `per_dim` is True the statistics are computed per pixel,
+        otherwise over all the elements of all the images. The
+        statistics are accumulated in float64 and each image is
+        processed with vectorized operations.
+        '''
+        x = numpy.asarray(x, dtype='float64')
+        if self.compute_class_freq:
             self.update_params(x)
+        elif per_dim:
+            self.merge_params(1, x, 0.)
         else:
-            for el in x.flatten():
-                self.update_params(el)
+            mean = x.mean()
+            self.merge_params(x.size, mean, ((x - mean) ** 2).sum())
 
     def update_params(self, x):
         # class freq
         if self.compute_class_freq:
-            cl_ids, cl_counts = numpy.unique(x, return_counts=True)
-            tot_px = numpy.sum(cl_counts)
-            for cl_id, cl_count in zip(cl_ids, cl_counts):
-                self.class_counts[cl_id] += cl_count
-                self.class_tot_px[cl_id] += tot_px
+            counts = numpy.bincount(x.ravel().astype('int64'),
+                                    minlength=self.nclasses)
+            self.class_counts += counts[:self.nclasses]
+            self.class_tot_px += (counts[:self.nclasses] > 0) * x.size
         else:
-            self.n += 1
-            # mean, std_dev
-            if self.n == 1:
-                self.m = x
-                self.s = 0.
-            else:
-                prev_m = self.m.copy()
-                self.m += (x - self.m) / self.n
-                self.s += (x - prev_m) * (x - self.m)
+            self.merge_params(1, x, 0.)
+
+    def merge_params(self, n, m, s):
+        '''Merge the mean `m` and sum of squared differences `s` of `n`
+        elements (Chan et al.'s parallel algorithm)'''
+        if self.n == 0:
+            self.n, self.m, self.s = float(n), numpy.array(m, 'float64'), s
+            return
+        total = self.n + n
+        delta = m - self.m
+        self.m = self.m + delta * (n / total)
+        self.s = self.s + s + delta ** 2 * (self.n * n / total)
+        self.n = total
+
+    def merge(self, other):
+        '''Merge the statistics computed by another RunningStats'''
+        if self.compute_class_freq:
+            self.class_counts += other.class_counts
+            self.class_tot_px += other.class_tot_px
+        elif other.n:
+            self.merge_params(other.n, other.m, other.s)
 
     def mean(self):
         return self.m if self.n else 0.0
@@ -24,7 +24,9 @@ class Cifar10Dataset(ThreadedDataset):
     data_shape = (32, 32, 3)
 
     # The dataset-wide statistics (either channel-wise or pixel-wise).
-    # `extra/running_stats` contains utilities to compute them.
+    # `dataset_stats` contains utilities to compute them. If they are
+    # not defined, `remove_mean` and `divide_by_std` compute (and
+    # cache) the channel-wise ones.
     # mean = []
     # std = []
 
@@ -141,6 +141,12 @@ class KITTIdataset(ThreadedDataset):
         # TODO: does kitty have prefixes/categories?
         return {'default': self.filenames}
 
+    def get_image_size(self, prefix, img_name):
+        """Return the size (rows, cols) of an image, from its header"""
+        w, h = Image.open(os.path.join(self.image_path,
+                                       img_name + ".png")).size
+        return h, w
+
     def load_sequence(self, sequence):
         """Load a sequence of images/frames
 
@@ -123,6 +123,10 @@ class MSCocoDataset(ThreadedDataset):
                 coco.getImgIds(catIds=prefix))
         return per_subset_names
 
+    def get_image_size(self, prefix, img):
+        """Return the size (rows, cols) of an image, from the annotations"""
+        return img['height'], img['width']
+
     def load_sequence(self, sequence):
         """Load a sequence of images/frames
 
@@ -126,6 +126,15 @@ class PascalVOCdataset(ThreadedDataset):
         """Return a dict of names, per prefix/subset."""
         return self.filenames
 
+    def get_image_size(self, prefix, img_name):
+        """Return the size (rows, cols) of an image, from its header"""
+        image_path = self.image_path
+        if img_name[0] == "_":
+            image_path = self.image_path_extra
+            img_name = img_name[1:]
+        w, h = Image.open(os.path.join(image_path, img_name + ".jpg")).size
+        return h, w
+
     def load_sequence(self, sequence):
         """Load a sequence of images/frames
 
@@ -0,0 +1,288 @@
+from collections import deque
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+import sys
+from threading import Thread
+import weakref
+
+import numpy as np
+from numpy.random import RandomState
+
+
+class MixedDataset(object):
+    """
+    Mix several datasets in a single pipeline.
+
+    The samples are drawn from the datasets according to `weights`,
+    their labels are mapped to a shared label space and they are loaded
+    by a single pool of fetcher threads into a single queue. Each
+    dataset keeps its own epoch plan, data augmentation and
+    preprocessing, but should not use threads itself. The mixed dataset
+    behaves as an infinite iterator.
+
+    Parameters
+    ----------
+    datasets: list of :class:`~parallel_loader.ThreadedDataset`
+        The datasets to mix. They should be created with `use_threads`
+        False, `return_one_hot` False and `echo_factor` 1. To stack
+        samples of different datasets in the same batch, they should
+        return samples of the same shape (e.g., with the same
+        `crop_size`).
+    weights: list of floats
+        The probability of drawing from each dataset. If None, the
+        datasets are drawn with the same probability. Default: None.
+    label_maps: list of dicts or arrays
+        For each dataset, the mapping from its labels (after the void
+        labels have been mapped, see
+        :class:`~parallel_loader.ThreadedDataset`) to the shared label
+        space, as a dict or an array indexed by the dataset label. None
+        leaves the labels of a dataset unchanged. The labels of all the
+        datasets are returned with the same dtype, `label_dtype`, that
+        fits all of them. Default: None.
+    mixed_batches: bool
+        If False each batch is drawn from a single dataset. If True the
+        dataset of each sample of a batch is drawn independently.
+        Default: False.
+    batch_size: int
+        The size of the batch.
+    queues_size: int
+        The size of the buffers used in the threaded case. Default: 20.
+    use_threads: bool
+        If True a pool of threads is used to fetch the data from the
+        datasets. Default: True.
+    nthreads: int
+        The number of threads shared by all the datasets. Default: 1.
+    return_list: bool
+        If True, each call to `next()` will return a list of two numpy
+        arrays containing the data and the labels respectively.
+        Otherwise a dictionary is returned, with the keys common to the
+        datasets and a `source` key with the index of the dataset of
+        each sample. Default: False.
+    raise_IOErrors: bool
+        If False in case of an IOError a message will be printed on
+        screen but no Exception will be raised. Default: False.
+    rng: :class:`numpy.random.RandomState` instance
+        The random number generator used to draw the datasets. If None,
+        one will be created. Default: None.
+    """
+    _wait_time = 0.05
+
+    def __init__(self,
+                 datasets,
+                 weights=None,
+                 label_maps=None,
+                 mixed_batches=False,
+                 batch_size=1,
+                 queues_size=20,
+                 use_threads=True,
+                 nthreads=1,
+                 return_list=False,
+                 raise_IOErrors=False,
+                 rng=None):
+        if len(datasets) == 0:
+            raise ValueError('At least one dataset is required')
+        for ds in datasets:
+            if ds.use_threads or ds.return_one_hot or ds.echo_factor > 1:
+                raise ValueError('The mixed datasets should not use threads, '
+                                 'one-hot labels or data echoing')
+        if weights is None:
+            weights = np.ones(len(datasets))
+        weights = np.asarray(weights, dtype='float64')
+        if len(weights) != len(datasets) or (weights < 0).any():
+            raise ValueError('Expected one non-negative weight per dataset')
+        if label_maps is None:
+            label_maps = [None] * len(datasets)
+        if len(label_maps) != len(datasets):
+            raise ValueError('Expected one label map per dataset')
+
+        self.datasets = datasets
+        self.weights = weights / weights.sum()
+        self.label_maps = [_lookup_table(m, ds.nclasses)
+                           for m, ds in zip(label_maps, datasets)]
+        # The smallest dtype that fits the labels of every dataset, so
+        # that the batches do not depend on the dataset they come from
+        dtypes = [ds.label_dtype for ds in datasets]
+        for lut in self.label_maps:
+            if lut is not None and len(lut):
+                dtypes.extend([np.min_scalar_type(lut.min()),
+                               np.min_scalar_type(lut.max())])
+        self.label_dtype = np.result_type(*dtypes)
+        self.label_maps = [None if lut is None else
+                           lut.astype(self.label_dtype)
+                           for lut in self.label_maps]
+        self.mixed_batches = mixed_batches
+        self.batch_size = batch_size
+        self.queues_size = queues_size
+        self.use_threads = use_threads
+        self.nthreads = nthreads
+        self.return_list = return_list
+        self.raise_IOErrors = raise_IOErrors
+        self.rng = rng if rng is not None else RandomState(0xbeef)
+        # The samples planned by each dataset, not yet in a batch
+        self._pending = [deque() for _ in datasets]
+
+        if self.use_threads:
+            self.jobs_queue = Queue.Queue(maxsize=self.queues_size)
+            self.data_queue = Queue.Queue(maxsize=self.queues_size)
+            for _ in range(self.queues_size):
+                self.jobs_queue.put(self._next_job())
+
+            # Start the data fetcher threads
+            self.sentinel = object()  # guaranteed unique reference
+            self.data_fetchers = []
+            for _ in range(self.nthreads):
+                data_fetcher = Thread(target=mixed_fetch,
+                                      args=(weakref.ref(self),))
+                data_fetcher.setDaemon(True)  # Die when main dies
+                data_fetcher.start()
+                self.data_fetchers.append(weakref.ref(data_fetcher))
+
+    def _next_sample(self, source):
+        '''Return the next planned sample of a dataset
+
+        Returns a tuple `(source, epoch, sample_idx, sequence)`, where
+        `sample_idx` is the index of the sample in the epoch of the
+        dataset.
+        '''
+        ds = self.datasets[source]
+        pending = self._pending[source]
+        while not pending:
+            epoch, batch_idx, name_batch = ds._next_names_batch()
+            # The dataset's batches are never returned by the dataset
+            # itself: forget the bookkeeping of its past epochs
+            for e in [e for e in ds._epoch_plans if e < epoch]:
+                ds._epochs_left.pop(e, None)
+                ds._epoch_plans.pop(e, None)
+            pending.extend((source, epoch, ds._sample_index(batch_idx, i), el)
+                           for i, el in enumerate(name_batch)
+                           if el is not None)
+        return pending.popleft()
+
+    def _next_job(self):
+        '''Draw the samples of the next batch'''
+        if self.mixed_batches:
+            sources = self.rng.choice(len(self.datasets), self.batch_size,
+                                      p=self.weights)
+        else:
+            sources = [self.rng.choice(len(self.datasets),
+                                       p=self.weights)] * self.batch_size
+        return [self._next_sample(source) for source in sources]
+
+    def fetch_from_datasets(self, job):
+        '''Load, augment and remap the samples of a batch'''
+        samples = []
+        for source, epoch, sample_idx, el in job:
+            ds = self.datasets[source]
+            ret = ds._load_sample(el)
+            ret = ds._augment_sample(
+                ret, RandomState([ds._augm_seed, epoch, sample_idx]))
+            lut = self.label_maps[source]
+            if lut is not None and ds.set_has_GT:
+                ret['labels'] = lut[ret['labels'].astype('int64')]
+            elif ds.set_has_GT:
+                ret['labels'] = ret['labels'].astype(self.label_dtype,
+                                                     copy=False)
+            ret['source'] = source
+            samples.append(ret)
+
+        # Keep the keys shared by all the datasets
+        keys = set.intersection(*[set(ret.keys()) for ret in samples])
+        batch_ret = {}
+        for k in keys:
+            batch_ret[k] = [ret[k] for ret in samples]
+            try:
+                batch_ret[k] = np.array(batch_ret[k])
+            except ValueError:
+                # Variable shape: cannot wrap with a numpy array
+                pass
+        if self.return_list:
+            return [batch_ret['data'], batch_ret['labels']]
+        return batch_ret
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        while True:
+            if not self.use_threads:
+                try:
+                    return self.fetch_from_datasets(self._next_job())
+                except IOError as e:
+                    if self.raise_IOErrors:
+                        raise
+                    print('WARNING: Image corrupted or missing!')
+                    print(e)
+                    continue
+
+            try:
+                data_batch = self.data_queue.get(True, self._wait_time)
+            except Queue.Empty:
+                # We consumed the data too fast: wait for the fetchers
+                continue
+            self.data_queue.task_done()
+            self.jobs_queue.put(self._next_job())
+            # Exception handling
+            if isinstance(data_batch, tuple) and len(data_batch) == 3:
+                if (isinstance(data_batch[1], IOError) and not
+                        self.raise_IOErrors):
+                    print('WARNING: Image corrupted or missing!')
+                    print(data_batch[1])
+                    continue  # fetch the next element
+                raise data_batch[0], data_batch[1], data_batch[2]
+            return data_batch
+
+    def finish(self):
+        # Stop fetchers
+        if not self.use_threads:
+            return
+        for _ in self.data_fetchers:
+            self.jobs_queue.put(self.sentinel)
+        for data_fetcher in self.data_fetchers:
+            if data_fetcher() is not None:
+                data_fetcher().join()
+
+
+def _lookup_table(label_map, nclasses):
+    '''Convert a dict label map to an array indexed by the labels'''
+    if label_map is None or not isinstance(label_map, dict):
+        return None if label_map is None else np.asarray(label_map)
+    lut = np.arange(max(max(label_map.keys()) + 1, nclasses))
+    for k, v in label_map.items():
+        lut[k] = v
+    return lut
+
+
+def mixed_fetch(weakself):
+    """
+    Fill the data_queue of a :class:`MixedDataset`.
+
+    Whenever there are jobs in the jobs queue, it will read them,
+    fetch the corresponding samples and fill the data_queue.
+
+    Note that in case of errors, it will put the exception object in the
+    data_queue.
+    """
+    while True:
+        self = weakself()
+        if self is None:
+            break
+        try:
+            job = self.jobs_queue.get(True, self._wait_time)
+        except Queue.Empty:
+            del self  # Allow the gc to delete the main object if needed
+            continue
+        try:
+            if job is self.sentinel:
+                break
+            self.data_queue.put(self.fetch_from_datasets(job))
+        except:  # noqa
+            # If any uncaught exception, pass it along and move on
+            self.data_queue.put(sys.exc_info())
+        finally:
+            self.jobs_queue.task_done()
+            del self
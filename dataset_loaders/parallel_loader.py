@@ -1,5 +1,7 @@
-from collections import OrderedDict
+from collections import deque, OrderedDict
 import ConfigParser
+import hashlib
+import json
 import os
 from os.path import realpath
 try:
@@ -8,18 +10,25 @@ except ImportError:
     import queue as Queue
 import shutil
 import sys
-from threading import Thread
-from time import sleep
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from threading import Condition, Lock, Thread, current_thread
+from time import sleep, time
 import warnings
 import weakref
 
 import numpy as np
 from numpy.random import RandomState
 from dataset_loaders.data_augmentation import random_transform
+from dataset_loaders.dataset_stats import compute_stats
 
 import dataset_loaders
-from dataset_loaders.utils_parallel_loader import (classproperty, grouper,
-                                                   overlap_grouper)
+from dataset_loaders.profiling import (FileLatency, PipelineStats,
+                                       Profiler, Tracer, chain_timers,
+                                       format_stats, null_timer)
+from dataset_loaders.samplers import AliasTable, SumTree, get_sampler
+from dataset_loaders.utils_parallel_loader import classproperty
+from dataset_loaders.worker_pool import default_worker_pool
 
 
 class ThreadedDataset(object):
@@ -74,6 +83,12 @@ class ThreadedDataset(object):
         If True the labels will be returned in one-hot format, i.e. as
         an array of `nclasses` elements all set to 0 except from the id
         of the correct class which is set to 1. Default: False.
+    one_hot_dtype: string
+        The dtype of the one-hot labels, e.g., `'uint8'`, `'bool'` or
+        `'float16'`. If `'bits'`, the one-hot labels are packed along
+        the class axis with :func:`numpy.packbits`, i.e., 8 classes per
+        `uint8`: use `numpy.unpackbits(labels, axis)[:nclasses]` to
+        unpack them. Default: 'int32'.
     return_01c: bool
         If True the last axis will be the channel axis (01c format),
         else the channel axis will be the third to last (c01 format).
@@ -86,17 +101,20 @@ class ThreadedDataset(object):
         are used as context. Default:False.
     return_middle_frame_only:bool
         If True only the middle frame of the ground truth will be returned.
-        Default:False.
+        The other frames of the labels are not processed. Default:False.
     return_0_255: bool
         If True the images will be returned in the range [0, 255] with
         dtype `uint8`. Otherwise the images will be returned in the
         range [0, 1] as dtype `float32`. Default: False.
     use_threads: bool
         If True threads will be used to fetch the data from the dataset.
-        Note that when use_threads is True the batches will be returned
-        in a non-deterministic fashion even when the numpy random seed
-        is fixed.
-        Default: False.
+        Note that when use_threads is True and `nthreads` is greater
+        than 1 the batches might be returned in a different order across
+        runs, although their content (including the data augmentation)
+        only depends on `rng`. The fetchers do not wait for the end of
+        an epoch to start loading the batches of the next one: each
+        batch is tagged with its epoch and the epoch boundaries are
+        enforced when the batches are returned. Default: False.
     nthreads: int
         The number of threads to use when `use_threads` is True. Default: 1.
     shuffle_at_each_epoch: bool
@@ -154,7 +172,158 @@ class ThreadedDataset(object):
         screen but no Exception will be raised. Default: False.
     rng: :class:`numpy.random.RandomState` instance
         The random number generator to use. If None, one will be created.
+        It is used to shuffle the data and to draw the seed of the
+        random number generators used for data augmentation: each sample
+        gets its own generator, seeded with this seed, the epoch and the
+        index of the sample in the epoch. Default: None.
+    sampler: string, array or :class:`~samplers.Sampler` instance
+        If not None, at each epoch the sequences will be drawn with
+        replacement according to the sampler rather than shuffled. Can
+        be `'class_balanced'`, `'inverse_frequency'`, an array with one
+        weight per sequence or a :class:`~samplers.Sampler` instance.
+        The class based samplers rely on :meth:`class_histograms`. With
+        `'prioritized'` the sequences are drawn proportionally to the
+        priorities set with :meth:`update_priorities`, when the batches
+        are queued to be loaded, and the batches contain the id of each
+        sequence in `seq_id`. Not supported together with
+        `seq_per_subset` and `one_subset_per_batch`. Default: None.
+    echo_factor: int
+        The number of times each loaded sequence is augmented and
+        returned (data echoing). Each echo is augmented with independent
+        parameters and the echoes are spread across different batches
+        by a shuffle buffer. This increases the number of samples per
+        byte read when loading is the bottleneck; each epoch then
+        returns about `echo_factor` times `nbatches` batches. See
+        :meth:`echo_stats` for statistics on the spread of the echoes.
+        Default: 1.
+    echo_buffer_size: int
+        The number of samples in the echo shuffle buffer. The larger it
+        is, the less likely the echoes of a sequence end up in the same
+        batch. Default: `4 * echo_factor * batch_size`.
+    nbuckets: int
+        If greater than 0, the sequences are grouped into `nbuckets`
+        buckets of similar aspect ratio, according to the size of their
+        images (see :meth:`image_sizes`), and each batch is drawn from a
+        single bucket. The samples are padded to the largest size of
+        their bucket, the labels with the void label, and a boolean
+        `mask` of the valid pixels is returned. This allows to batch
+        datasets without `data_shape` without cropping. The fraction of
+        padded pixels is printed and stored in `padding_waste`. Not
+        supported together with `crop_size`, `one_subset_per_batch`,
+        `echo_factor` and lazy samplers. Default: 0.
+    num_shards: int
+        The number of shards the batches of each epoch are split into,
+        e.g., one per process in distributed training. All the shards
+        compute the same epoch plan, which requires them to use the same
+        `rng` seed (the default), and each one returns every
+        `num_shards`-th batch of it, starting from `shard_id`. Note that
+        `nbatches` and `nsamples` refer to the shard. Default: 1.
+    shard_id: int
+        The shard of this dataset, between 0 and `num_shards` - 1.
+        Default: 0.
+    pad_shards: bool
+        If True and the number of batches is not a multiple of
+        `num_shards`, the first batches of the epoch are repeated so
+        that all the shards have the same number of batches. If False,
+        the last batches are dropped instead, which requires at least
+        `num_shards` batches. Default: True.
+    worker_pool: bool or :class:`~worker_pool.WorkerPool` instance
+        When `use_threads` is True, the batches are loaded by the given
+        pool of workers, shared with other datasets, rather than by
+        `nthreads` threads of this dataset. If True, the process-wide
+        pool with one worker per CPU is used. The workers only load the
+        batches of the datasets with room in their `data_queue`, so that
+        the datasets that are not iterated do not use them.
+        Default: None.
+    worker_priority: int
+        The batches of the datasets with a higher priority are loaded
+        first by the `worker_pool`. Default: 0.
+    worker_quota: int
+        The maximum number of workers of the `worker_pool` that load the
+        batches of this dataset at the same time. If None, there is no
+        limit. Default: None.
+    autotune: bool
+        If True and `use_threads` is True, `nthreads` and `queues_size`
+        are tuned online: the time the consumer waits for the batches
+        and the time the fetchers take to load them are measured and the
+        number of active fetchers (up to the number of CPUs) and of
+        prefetched batches (up to a quarter of the physical memory) are
+        adapted to keep the consumer busy without wasting resources.
+        The chosen configuration is printed whenever it changes, so
+        that it can be pinned later. The initial `nthreads` and
+        `queues_size` are used as a starting point. Default: False.
+    prefetch_bytes: int
+        If not None, the maximum number of bytes of the batches loaded
+        in advance by the fetchers, in addition to the `queues_size`
+        bound on their number. The size of a batch is the sum of the
+        `nbytes` of its arrays, `raw_data` included. The fetchers wait
+        before queueing a batch that does not fit in the budget, unless
+        the queue is empty. When autotuning, it replaces the memory
+        ceiling. Default: None.
+    profile: bool
+        If True, the time spent by the fetchers in each stage of the
+        pipeline (loading, normalization, label remapping, each data
+        augmentation, padding, one-hot encoding, transposition and
+        collation) is recorded in per-thread histograms. See
+        :meth:`profile_report`. Default: False.
+    stats_interval: float
+        If not None, the throughput and stall statistics (see
+        :meth:`stats`) are printed every `stats_interval` seconds, when
+        a batch is returned. Default: None.
+    trace: string
+        If not None, the timeline of the pipeline is recorded and
+        written to this path as Chrome trace events (to be opened in
+        chrome://tracing or Perfetto) by :meth:`finish` or
+        :meth:`save_trace`. The trace shows, for each thread, when each
+        batch of names is queued, fetched (with each stage of each
+        sample) and put in the `data_queue`, and when the consumer gets
+        it, tagged with the epoch and batch index. Default: None.
+    slow_files: int
+        If greater than 0, the load time of each file is recorded and at
+        the end of each epoch a report with the latency histogram and
+        the `slow_files` slowest files is written in the dataset
+        directory (see :meth:`slow_files_report`). The files of a
+        sequence are loaded by a single call to `load_sequence`, whose
+        duration is split evenly among them. The files whose loading
+        fails are accounted for as well, and marked in the report.
+        Default: 0.
+    hedge_factor: float
+        If not None and `use_threads` is True, a batch whose loading
+        takes longer than `hedge_factor` times the 95th percentile of
+        the recent loading times is queued again, to be loaded by
+        another fetcher: the first copy to be loaded is returned and
+        the other is discarded. The deadlines are checked while the
+        consumer waits for a batch. Requires more than one fetcher.
         Default: None.
+    fetch_timeout: float
+        If not None and `use_threads` is True, a batch that is still
+        being loaded after `fetch_timeout` seconds is replaced with an
+        IOError, handled according to `raise_IOErrors`, and its fetcher
+        thread is replaced by a new one. The deadlines are checked while
+        the consumer waits for a batch. Default: None.
+    fetch_retries: int
+        The number of times the loading of a batch is attempted again,
+        with an exponential backoff, when it fails or when its fetcher
+        thread dies, before the error is returned to the consumer.
+        Fetcher threads that die are restarted, after a delay that grows
+        exponentially if they keep dying shortly after being started.
+        Default: 0.
+    quarantine: bool
+        If True, the images/frames that raise an IOError when loaded are
+        recorded in a quarantine file in the dataset directory and the
+        sequences that contain them are excluded from the following
+        epochs and runs. The other samples of the batch are returned,
+        repeated to fill the batch if `fill_last_batch` is True.
+        See :meth:`quarantined` and :meth:`verify`. Delete the file to
+        lift the quarantine. Default: False.
+    fields: list of strings
+        The keys of the dictionaries returned when `return_list` is
+        False, in addition to `data` and `labels`, which are always
+        returned (e.g., `['filenames']`). The other outputs (e.g., the
+        copy of `raw_data`, the `mask` of the valid pixels or the
+        `filenames`) are not produced at all. If None, all the
+        available keys are returned. When `return_list` is True only
+        the data and the labels are produced. Default: None.
 
     Notes
     -----
@@ -209,6 +378,28 @@ class ThreadedDataset(object):
                  divide_by_per_img_std=False,  # img stats
                  raise_IOErrors=False,
                  rng=None,
+                 sampler=None,
+                 echo_factor=1,
+                 echo_buffer_size=None,
+                 nbuckets=0,
+                 num_shards=1,
+                 shard_id=0,
+                 pad_shards=True,
+                 worker_pool=None,
+                 worker_priority=0,
+                 worker_quota=None,
+                 autotune=False,
+                 prefetch_bytes=None,
+                 profile=False,
+                 stats_interval=None,
+                 trace=None,
+                 slow_files=0,
+                 hedge_factor=None,
+                 fetch_timeout=None,
+                 fetch_retries=0,
+                 quarantine=False,
+                 fields=None,
+                 one_hot_dtype='int32',
                  **kwargs):
 
         if len(kwargs):
@@ -257,7 +448,9 @@ class ThreadedDataset(object):
                                           '{`random`, `smart`}')
 
         # Do not support multithread without shuffling
-        if use_threads and nthreads > 1 and not shuffle_at_each_epoch:
+        if (use_threads and not shuffle_at_each_epoch and
+                (nthreads > 1 or autotune if worker_pool is None else
+                 worker_quota != 1)):
             raise NotImplementedError('Multiple threads are not order '
                                       'preserving')
 
@@ -270,19 +463,36 @@ class ThreadedDataset(object):
                 missing_attrs))
         if hasattr(self, 'GT_classes'):
             raise NameError('GTclasses mispelled as GT_classes')
+        self._labels_lut = self._make_labels_lut()
 
         # If variable sized dataset --> either batch_size 1 or crop
         if (not hasattr(self, 'data_shape') and batch_size > 1 and
-                not self.data_augm_kwargs['crop_size']):
+                not self.data_augm_kwargs['crop_size'] and not nbuckets):
             raise ValueError(
                 '{} has no `data_shape` attribute, this means that the '
                 'shape of the samples varies across the dataset. You '
-                'must either set `batch_size = 1` or specify a '
-                '`crop_size`'.format(self.name))
+                'must either set `batch_size = 1`, specify a '
+                '`crop_size` or set `nbuckets`'.format(self.name))
+        if nbuckets and (self.data_augm_kwargs['crop_size'] or
+                         one_subset_per_batch or echo_factor > 1):
+            raise ValueError('`nbuckets` cannot be used together with '
+                             '`crop_size`, `one_subset_per_batch` or '
+                             '`echo_factor`')
 
         if seq_length and overlap and overlap >= seq_length:
             raise ValueError('`overlap` should be smaller than `seq_length`')
 
+        if not 0 <= shard_id < num_shards:
+            raise ValueError('`shard_id` should be between 0 and '
+                             '`num_shards` - 1')
+
+        if echo_factor < 1:
+            raise ValueError('`echo_factor` should be a positive integer')
+
+        if sampler is not None and (seq_per_subset or one_subset_per_batch):
+            raise ValueError('`sampler` cannot be used together with '
+                             '`seq_per_subset` or `one_subset_per_batch`')
+
         # Copy the data to the local path if not existing
         if not os.path.exists(self.path):
             print('The local path {} does not exist. Copying '
@@ -324,6 +534,10 @@ class ThreadedDataset(object):
         self.batch_size = batch_size
         self.queues_size = queues_size
         self.return_one_hot = return_one_hot
+        self.one_hot_dtype = one_hot_dtype
+        self._one_hot_bits = str(one_hot_dtype) == 'bits'
+        if not self._one_hot_bits:
+            np.dtype(one_hot_dtype)  # Fail early on invalid dtypes
         self.return_01c = return_01c
         self.return_extended_sequences = return_extended_sequences
         self.return_middle_frame_only = return_middle_frame_only
@@ -333,6 +547,10 @@ class ThreadedDataset(object):
         self.shuffle_at_each_epoch = shuffle_at_each_epoch
         self.infinite_iterator = infinite_iterator
         self.return_list = return_list
+        # The keys returned in addition to data and labels, None for all
+        if return_list:
+            fields = ()
+        self.fields = None if fields is None else set(fields)
         self.fill_last_batch = fill_last_batch
         self.remove_mean = remove_mean
         self.divide_by_std = divide_by_std
@@ -340,11 +558,80 @@ class ThreadedDataset(object):
         self.divide_by_per_img_std = divide_by_per_img_std
         self.raise_IOErrors = raise_IOErrors
         self.rng = rng if rng is not None else RandomState(0xbeef)
+        self.sampler = get_sampler(sampler)
+        if nbuckets and self.sampler is not None and self.sampler.lazy:
+            raise ValueError('`nbuckets` cannot be used together with a '
+                             'lazy sampler')
+        self.nbuckets = nbuckets
+        self.num_shards = num_shards
+        self.shard_id = shard_id
+        self.pad_shards = pad_shards
+        if worker_pool is True:
+            worker_pool = default_worker_pool()
+        self.worker_pool = worker_pool if use_threads else None
+        self.autotune = autotune and use_threads
+        self.prefetch_bytes = prefetch_bytes
+        self._prefetched_bytes = 0
+        self._prefetch_cond = Condition()
+        self.profiler = Profiler() if profile else None
+        self.trace = trace
+        self.tracer = Tracer() if trace else None
+        self._timer = chain_timers(obj.timer for obj in (self.profiler,
+                                                         self.tracer)
+                                   if obj is not None)
+        self.slow_files = slow_files
+        self._file_latency = FileLatency(slow_files) if slow_files else None
+        self.hedge_factor = hedge_factor
+        self.fetch_timeout = fetch_timeout
+        self._hedging = use_threads and (hedge_factor is not None or
+                                         fetch_timeout is not None)
+        # The batches being loaded, by (epoch, batch_idx)
+        self._fetching = {}
+        self._fetching_lock = Lock()
+        self._recent_fetch_times = deque(maxlen=100)
+        self.fetch_retries = fetch_retries
+        # The batch being loaded by each fetcher thread, and the number
+        # of times each batch was requeued because its fetcher died
+        self._fetcher_items = {}
+        self._requeued = {}
+        # Per fetcher thread: [start time, consecutive crashes, restart
+        # time]
+        self._fetcher_health = {}
+        # The fetcher threads stuck on a batch that timed out
+        self._hung_fetchers = set()
+        self.quarantine = quarantine
+        # Guards the quarantine and the priorities of the lazy sampler,
+        # which the fetchers update while the sequences are drawn
+        self._quarantine_lock = Lock()
+        self._quarantined = set()
+        self._seq_quarantined = None
+        self.stats_interval = stats_interval
+        self._stats = PipelineStats()
+        self._last_stats_log = time()
+        self._augm_seed = self.rng.randint(2 ** 31)
+        self.echo_factor = int(echo_factor)
+        self.echo_buffer_size = (echo_buffer_size or
+                                 4 * self.echo_factor * batch_size)
+        self._echo_rng = RandomState(self._augm_seed)
+        self._reset_echo_buffer()
 
         self.set_has_GT = getattr(self, 'set_has_GT', True)
         self.mean = getattr(self, 'mean', [])
         self.std = getattr(self, 'std', [])
 
+        # Epoch bookkeeping: `epoch` is the epoch of the batches being
+        # returned, `_plan_epoch` the epoch of the batches being
+        # planned (and fetched, in the threaded case). `_epochs_left`
+        # holds the number of batches still to be returned per epoch.
+        self.epoch = 0
+        self._plan_epoch = -1
+        self._plan_left = 0
+        self._epochs_left = {}
+        self._epoch_plans = {}
+        self._early_batches = []
+        self._inf_batch_idx = 0
+        self._inf_batches_done = 0
+
         # ...01c
         data_shape = list(getattr(self.__class__, 'data_shape',
                                   (None, None, 3)))
@@ -359,36 +646,139 @@ class ThreadedDataset(object):
         if not self.seq_per_subset or self.seq_per_subset is not np.inf:
             # Load a dict of names, per video/subset/prefix/...
             self.names_per_subset = self.get_names()
+            if self.quarantine:
+                self._load_quarantine()
 
             # Create the list of sequences with format
             # [[(prefix, name1), (prefix, name2), ..], ..]
             self._fill_names_sequences()
-            if len(self.names_sequences) == 0:
+            if len(self._seq_start) == 0:
                 raise RuntimeError('The name list cannot be empty')
             # Potentially shuffle the `names_sequences` list and create the
             # list of batches out of it
             self._fill_names_batches(shuffle_at_each_epoch)
 
+            # Compute the dataset statistics, if not provided
+            if ((self.remove_mean and not len(self.mean)) or
+                    (self.divide_by_std and not len(self.std))):
+                stats = self.dataset_stats()
+                if not len(self.mean):
+                    self.mean = stats['channel_mean'].astype('float32')
+                if not len(self.std):
+                    self.std = stats['channel_std'].astype('float32')
+        self._compile_normalization()
+
         if self.use_threads:
-            # Initialize the queues
-            self.names_queue = Queue.Queue(maxsize=self.queues_size)
-            self.data_queue = Queue.Queue(maxsize=self.queues_size)
+            # Initialize the queues. When autotuning, the number of
+            # batches in the queues is bounded by `queues_size` in
+            # `_refill_names_queue` instead
+            maxsize = 0 if self.autotune else self.queues_size
+            self.names_queue = Queue.Queue(maxsize=maxsize)
+            self.data_queue = Queue.Queue(maxsize=maxsize)
+            self._outstanding = 0
             self._init_names_queue()  # Fill the names queue
+            if self.autotune:
+                self._init_autotune()
 
             # Start the data fetcher threads
             self.sentinel = object()  # guaranteed unique reference
             self.data_fetchers = []
-            for _ in range(self.nthreads):
-                data_fetcher = Thread(
-                    target=threaded_fetch,
-                    args=(weakref.ref(self),))
-                data_fetcher.setDaemon(True)  # Die when main dies
-                data_fetcher.start()
-                data_fetcher = weakref.ref(data_fetcher)
-                self.data_fetchers.append(data_fetcher)
+            if self.worker_pool is not None:
+                # Let the shared workers fetch the data instead
+                self.worker_pool.register(self, worker_priority,
+                                          worker_quota)
+            for _ in range(0 if self.worker_pool else self.nthreads):
+                self._start_fetcher()
             # Give time to the data fetcher to die, in case of errors
             # sleep(1)
 
+    def _start_fetcher(self, thread_id=None):
+        '''Start a fetcher thread, or restart the one with `thread_id`'''
+        if thread_id is None:
+            thread_id = len(self.data_fetchers)
+            self.data_fetchers.append(None)
+        data_fetcher = Thread(
+            target=threaded_fetch,
+            args=(weakref.ref(self), thread_id))
+        data_fetcher.setDaemon(True)  # Die when main dies
+        data_fetcher.start()
+        self.data_fetchers[thread_id] = weakref.ref(data_fetcher)
+        health = self._fetcher_health.setdefault(thread_id, [0, 0, None])
+        health[0], health[2] = time(), None
+
+    _restart_backoff = 1.
+    _max_restart_backoff = 60.
+    _crash_loop_window = 10.
+
+    def _supervise_fetchers(self):
+        '''Restart the fetcher threads that died
+
+        The batch a fetcher was loading is queued again, unless it was
+        already attempted `fetch_retries` times, in which case an error
+        is returned to the consumer instead. A fetcher that dies within
+        `_crash_loop_window` seconds from its start is restarted after a
+        delay that doubles at each consecutive crash. A fetcher stuck on
+        a batch that timed out is replaced right away, the stuck thread
+        exits whenever its batch is loaded.
+        '''
+        now = time()
+        for thread_id, df in enumerate(self.data_fetchers):
+            if thread_id in self._hung_fetchers:
+                # Its batch was already replaced with an IOError
+                self._hung_fetchers.discard(thread_id)
+                self._fetcher_items.pop(thread_id, None)
+                print('WARNING: Fetcher thread {} of {} is stuck on a batch '
+                      'that timed out, replacing it'.format(thread_id,
+                                                            self.name))
+                self._start_fetcher(thread_id)
+                self._stats.count('hung_fetchers')
+                continue
+            if df() is not None and df().isAlive():
+                continue
+            health = self._fetcher_health[thread_id]
+            if health[2] is None:
+                # Just found dead: schedule the restart, the delay
+                # doubles at each consecutive crash
+                if now - health[0] >= self._crash_loop_window:
+                    health[1] = 0
+                delay = min(self._restart_backoff * 2 ** health[1],
+                            self._max_restart_backoff)
+                health[1] += 1
+                health[2] = now + delay
+                self._stats.count('worker_deaths')
+                print('WARNING: Fetcher thread {} of {} died, restarting it '
+                      'in {:.1f}s'.format(thread_id, self.name, delay))
+                item = self._fetcher_items.pop(thread_id, None)
+                if item is not None:
+                    self._requeue(item)
+            if now >= health[2]:
+                self._start_fetcher(thread_id)
+                self._stats.count('worker_restarts')
+
+    def _requeue(self, item):
+        '''Load again a batch whose fetcher died, or give up on it'''
+        key = item[:2]
+        self.names_queue.task_done()
+        self._requeued[key] = self._requeued.get(key, 0) + 1
+        if self._requeued[key] <= self.fetch_retries:
+            self._stats.count('fetch_retries')
+            _force_put(self.names_queue, item, front=True)
+            return
+        del self._requeued[key]
+        if self._hedging:
+            with self._fetching_lock:
+                entry = self._fetching.get(key)
+                if entry is not None:
+                    entry[4] = True
+                    self._drop_copy(key, entry)
+        try:
+            raise RuntimeError('The fetcher died while loading batch {} of '
+                               'epoch {}: {}'.format(key[1], key[0],
+                                                     item[2]))
+        except RuntimeError:
+            # Count it as queued and not yet taken from the data_queue
+            _force_put(self.data_queue, (key[0], sys.exc_info()))
+
     def get_names(self):
         """ Loads ALL the names, per video.
 
@@ -413,104 +803,277 @@ class ThreadedDataset(object):
         raise NotImplementedError
 
     def _fill_names_sequences(self):
-        '''Fill list of sequences [[(prefix1, name), (prefix1, name1), ..], ..]
+        '''Fill the index of the sequences [[(prefix1, name), ..], ..]
 
-        Fill `names_sequences` with lists of sequences, i.e., of lists
-        of (prefix, name) pair with the desired overlap and seq_length N:
+        Each sequence is a list of (prefix, name) pairs with the desired
+        overlap and seq_length N:
             [(prefix1, name1), (prefix1, name2), .., (prefix1, nameN)]
             [(prefix1, name(N-overlap), (prefix1, name(N-overlap+1)), ..,
              (prefix1, name(N-overlap+N)]
+
+        To keep the index compact the names are stored only once, in
+        `_names`, and each sequence is represented by the id of its
+        prefix in `_prefixes` and the position of its first frame in
+        `_names`.
         '''
-        names_sequences = {}
         seq_length = max(self.seq_length, 1)
+        prefixes, names, names_prefix, seq_prefix, seq_start = ([], [], [],
+                                                                [], [])
+        offset = 0
 
         # Cycle over prefix/subset/video/category/...
-        for prefix, names in self.names_per_subset.items():
+        for prefix_id, (prefix, p_names) in enumerate(
+                self.names_per_subset.items()):
             # Repeat the first and last elements so that the first and last
             # sequences are filled with repeated elements up/from the
             # middle element.
             if self.return_extended_sequences:
-                names = ([names[0]] * (seq_length // 2) + names +
-                         [names[-1]] * (seq_length // 2))
-            # Fill sequences with multiple el with form
-            # [(prefix, name1), (prefix, name2), ...]. The names here
-            # have overlap = (seq_length - 1), i.e., "stride" = 1
-            sequences = [el for el in overlap_grouper(
-                names, seq_length, prefix=prefix)]
-            # Sequences of frames with the requested overlap
-            sequences = sequences[::seq_length - self.overlap]
-
-            names_sequences[prefix] = sequences
-        self.names_sequences = names_sequences
-
-    def _fill_names_batches(self, shuffle):
+                p_names = ([p_names[0]] * (seq_length // 2) + list(p_names) +
+                           [p_names[-1]] * (seq_length // 2))
+            # The first frame of each sequence of frames with the
+            # requested overlap
+            starts = np.arange(0, len(p_names) - seq_length + 1,
+                               seq_length - self.overlap)
+
+            prefixes.append(prefix)
+            names.extend(p_names)
+            names_prefix.append(np.repeat(prefix_id, len(p_names)))
+            seq_prefix.append(np.repeat(prefix_id, len(starts)))
+            seq_start.append(starts + offset)
+            offset += len(p_names)
+        self._prefixes = np.array(prefixes)
+        self._names = np.array(names)
+        self._names_prefix = np.concatenate([[]] +
+                                            names_prefix).astype('int32')
+        self._alias_table = None
+        self._sum_tree = None
+        self._seq_prefix = np.concatenate([[]] + seq_prefix).astype('int32')
+        self._seq_start = np.concatenate([[]] + seq_start).astype('int32')
+        self._seq_quarantined = None
+        if self._quarantined:
+            self._seq_quarantined = self._quarantine_mask(self._quarantined)
+        if self.nbuckets:
+            self._fill_buckets()
+
+    def _fill_buckets(self):
+        '''Assign each sequence to a bucket according to its aspect ratio
+
+        The bucket edges are the quantiles of the aspect ratio of the
+        sequences, so that the buckets have about the same size. The
+        shape of each bucket is the largest size of its sequences.
+        '''
+        sizes = self.image_sizes()
+        seq_sizes = sizes[self._seq_start]
+        for i in range(1, max(self.seq_length, 1)):
+            seq_sizes = np.maximum(seq_sizes, sizes[self._seq_start + i])
+        ratio = seq_sizes[:, 0] / seq_sizes[:, 1].astype('float64')
+        self._bucket_edges = np.percentile(
+            ratio, np.linspace(0, 100, self.nbuckets + 1)[1:-1])
+        self._seq_bucket = np.searchsorted(self._bucket_edges, ratio,
+                                           'right').astype('int32')
+        self._bucket_shapes = np.zeros((self.nbuckets, 2), 'int64')
+        np.maximum.at(self._bucket_shapes, self._seq_bucket, seq_sizes)
+        padded = self._bucket_shapes[self._seq_bucket].prod(axis=1)
+        self.padding_waste = 1 - (seq_sizes.prod(axis=1).sum() /
+                                  float(padded.sum()))
+        print('{} sequences in {} buckets: {:.1%} of the pixels are '
+              'padding'.format(len(ratio), self.nbuckets,
+                               self.padding_waste))
+
+    def _bucket_shape(self, rows, cols):
+        '''Return the shape of the bucket of a sample of size rows x cols'''
+        bucket = np.searchsorted(self._bucket_edges, rows / float(cols),
+                                 'right')
+        return self._bucket_shapes[bucket]
+
+    @property
+    def names_sequences(self):
+        '''The dict of sequences of (prefix, name) pairs, per prefix
+
+        The quarantined sequences are excluded.
+        '''
+        names_sequences = OrderedDict((p, []) for p in self._prefixes.tolist())
+        for seq_id in range(len(self._seq_start)):
+            if (self._seq_quarantined is not None and
+                    self._seq_quarantined[seq_id]):
+                continue
+            seq = self._get_sequence(seq_id)
+            names_sequences[seq[0][0]].append(seq)
+        return names_sequences
+
+    def _get_sequence(self, seq_id):
+        '''Return the sequence of (prefix, name) pairs with id `seq_id`'''
+        start = self._seq_start[seq_id]
+        prefix = self._prefixes[self._seq_prefix[seq_id]].tolist()
+        return _Sequence(((prefix, name) for name in
+                          self._names[start:start + max(self.seq_length, 1)
+                                      ].tolist()), seq_id)
+
+    def _fill_names_batches(self, shuffle, new_epoch=True, start=0):
         '''Create the desired batches of sequences
 
         * Select the desired sequences according to seq_per_subset
         * Set self.nsamples, self.nbatches and self.names_batches.
-        * Set self.names_batches, an iterator over the batches of names.
-        '''
-        # self.names_sequences has the following structure:
-        #   key: a subset
-        #   value: a tuple of *sequences* with structure
-        #       `((subset, filename1), (subset, filename2), ..)`
-        #       and length `seq_length`.
-        # E.g.,
-        # names_sequences['0001TP'][0] = (('0001TP', '0001TP_006690.png'),)
-        #
-        # Here we copy it in `names_sequences`, selecting a random subset
-        # of values per key in case a limit has been imposed via
-        # self.seq_per_subset.
-        names_sequences = OrderedDict()
-        for prefix, sequences in self.names_sequences.items():
-
-            # Pick only a subset of sequences per each video
-            if self.seq_per_subset:
-                # Pick `seq_per_subset` random indices
-                idx = np.random.permutation(range(len(sequences)))[
-                    :self.seq_per_subset]
-                # Select only those sequences
-                sequences = np.array(sequences)[idx]
-
-            names_sequences.setdefault(prefix, []).extend(sequences)
+        * Set self.names_batches, an array of the ids of the sequences
+          of each batch, where -1 marks a missing sequence.
+
+        If `new_epoch` is False the new batches replace the ones of the
+        epoch currently being planned, rather than being appended as a
+        new epoch. `start` is the index of the first batch to be
+        dispatched, the previous ones are skipped.
+        '''
+        # Save the state of the rng, to be able to recreate this plan
+        rng_state = self.rng.get_state()
+        bs = self.batch_size
+        seq_ids = np.arange(len(self._seq_start))
+
+        # Draw the sequences with replacement according to the sampler.
+        # Lazy samplers draw them in `_next_names_batch` instead
+        if self.sampler is not None and self.sampler.lazy:
+            if self._sum_tree is None:
+                sum_tree = SumTree(self.sampler.weights(self))
+                with self._quarantine_lock:
+                    if self._seq_quarantined is not None:
+                        sum_tree.update(
+                            np.where(self._seq_quarantined)[0], 0)
+                    self._sum_tree = sum_tree
+        elif self.sampler is not None:
+            if self._alias_table is None:
+                self._alias_table = AliasTable(self.sampler.weights(self))
+            seq_ids = self._alias_table.draw(len(seq_ids), self.rng)
+        # Pick only a subset of sequences per each video: sort the
+        # sequences by prefix and randomly within each prefix, then keep
+        # the first `seq_per_subset` ones of each prefix
+        elif self.seq_per_subset:
+            seq_ids = np.lexsort((self.rng.random_sample(len(seq_ids)),
+                                  self._seq_prefix))
+            prefix = self._seq_prefix[seq_ids]
+            rank = (np.arange(len(seq_ids)) -
+                    np.searchsorted(prefix, prefix, 'left'))
+            seq_ids = seq_ids[rank < self.seq_per_subset]
+        # Skip the quarantined sequences
+        if self._seq_quarantined is not None:
+            seq_ids = seq_ids[~self._seq_quarantined[seq_ids]]
+            if len(seq_ids) == 0:
+                raise RuntimeError('All the sequences of {} are '
+                                   'quarantined'.format(self.name))
 
         # Group the sequences into minibatches of `batch_size` length
-        if self.one_subset_per_batch:
-            # Group each subset separately
-            names_batches = [el for seq in names_sequences.itervalues()
-                             for el in grouper(seq, self.batch_size)]
+        if self.one_subset_per_batch or self.nbuckets:
+            if self.nbuckets:
+                # Sort the sequences by bucket, randomly within each one
+                if shuffle and self.sampler is None:
+                    self.rng.shuffle(seq_ids)
+                seq_ids = seq_ids[np.argsort(self._seq_bucket[seq_ids],
+                                             kind='mergesort')]
+                group = self._seq_bucket[seq_ids]
+                ngroups = self.nbuckets
+            else:
+                group = self._seq_prefix[seq_ids]
+                ngroups = len(self._prefixes)
+            # Group each subset (or bucket) separately: compute the
+            # position of each sequence in the batches of its group
+            counts = np.bincount(group, minlength=ngroups)
+            first_batch = np.cumsum(-(-counts // bs)) - (-(-counts // bs))
+            rank = np.arange(len(seq_ids)) - (np.cumsum(counts) - counts)[
+                group]
+            names_batches = -np.ones((-(-counts // bs)).sum() * bs, 'int32')
+            names_batches[first_batch[group] * bs + rank] = seq_ids
+            names_batches = names_batches.reshape((-1, bs))
             if shuffle:
                 self.rng.shuffle(names_batches)  # shuffle the batches
         else:
-            # Concat the values in a unique list, get rid of the keys
-            names_sequences_flat = [el for outer_el in names_sequences.values()
-                                    for el in outer_el]
-            if shuffle:
-                self.rng.shuffle(names_sequences_flat)  # shuffle the sequences
+            if shuffle and self.sampler is None:
+                self.rng.shuffle(seq_ids)  # shuffle the sequences
             # Group all the subsets together
-            names_batches = [el for el in grouper(names_sequences_flat,
-                                                  self.batch_size)]
-        self.nsamples = len(names_sequences)
+            names_batches = -np.ones(-(-len(seq_ids) // bs) * bs, 'int32')
+            names_batches[:len(seq_ids)] = seq_ids
+            names_batches = names_batches.reshape((-1, bs))
+
+        # Keep the batches of this shard, evenly spread over the plan
+        if self.num_shards > 1:
+            nbatches = len(names_batches)
+            if self.pad_shards:
+                nbatches = -(-nbatches // self.num_shards) * self.num_shards
+            else:
+                nbatches -= nbatches % self.num_shards
+            shard_batches = np.arange(self.shard_id, nbatches,
+                                      self.num_shards)
+            if not len(shard_batches):
+                raise ValueError(
+                    'The {} batches of {} are fewer than the {} shards: '
+                    'use pad_shards=True or a smaller batch_size'.format(
+                        len(names_batches), self.name, self.num_shards))
+            if len(names_batches):
+                names_batches = names_batches[shard_batches %
+                                              len(names_batches)]
+        self.nsamples = int((names_batches >= 0).sum())
         self.nbatches = len(names_batches)
-        # `names_batches` contains three nested tuples and has shape
+        self.names_batches = names_batches
+
+        # Update the epoch bookkeeping
+        if new_epoch:
+            self._plan_epoch += 1
+            self._epochs_left[self._plan_epoch] = 0
+        else:
+            # Forget the batches of the old plan that were not dispatched
+            self._epochs_left[self._plan_epoch] -= self._plan_left
+        self._epochs_left[self._plan_epoch] += self.nbatches - start
+        self._plan_left = self.nbatches - start
+        self._epoch_plans[self._plan_epoch] = (rng_state, shuffle,
+                                               self.nbatches)
+
+    def _next_names_batch(self):
+        '''Return the next batch of names, with its epoch and index
+
+        When the batches of the current plan are over, the plan of the
+        next epoch is created right away, so that the fetchers can move
+        on to the next epoch without waiting for the current one to be
+        consumed.
+        '''
+        if self.seq_per_subset and self.seq_per_subset is np.inf:
+            # When it's an infinite dataset, generate a fixed name
+            name_batch = [[('default', 'inf-gen_%i_%i' % (b_idx, f_idx))
+                           for f_idx in range(self.seq_length)]
+                          for b_idx in range(self.batch_size)]
+            self._inf_batch_idx += 1
+            return 0, self._inf_batch_idx - 1, name_batch
+        if not self._plan_left:
+            self._fill_names_batches(self.shuffle_at_each_epoch)
+        batch_idx = self.nbatches - self._plan_left
+        self._plan_left -= 1
+        seq_ids = self.names_batches[batch_idx]
+        if self._sum_tree is not None:
+            # Draw the sequences now, to use the latest priorities
+            with self._quarantine_lock:
+                drawn = self._sum_tree.draw(len(seq_ids), self.rng)
+            seq_ids = np.where(seq_ids < 0, seq_ids, drawn)
+        # `name_batch` contains three nested tuples and has shape
         # (batch_size, seq_length, 2), where the most inner element is a
         # tuple `(subset, filename)`.
-        self.names_batches = iter(names_batches)
+        name_batch = [None if seq_id < 0 else self._get_sequence(seq_id)
+                      for seq_id in seq_ids]
+        return self._plan_epoch, batch_idx, name_batch
 
     def _init_names_queue(self):
-        for _ in range(self.queues_size):
-            if self.seq_per_subset and self.seq_per_subset is np.inf:
-                name_batch = [[('default', 'inf-gen_%i_%i' % (b_idx, f_idx))
-                               for f_idx in range(self.seq_length)]
-                              for b_idx in range(self.batch_size)]
-                self.names_queue.put(name_batch)
-            else:
-                try:
-                    name_batch = self.names_batches.next()
-                    self.names_queue.put(name_batch)
-                except StopIteration:
-                    # Queue is bigger than the tot number of batches
-                    break
+        # If the queue is bigger than the number of batches, the
+        # batches of the following epoch(s) will be queued as well
+        self._outstanding = 0
+        self._refill_names_queue()
+
+    def _refill_names_queue(self):
+        '''Queue batches of names until `queues_size` are in the pipeline
+
+        `_outstanding` counts the batches queued and not yet taken from
+        the `data_queue`.
+        '''
+        while self._outstanding < self.queues_size:
+            item = self._next_names_batch()
+            if self.tracer is not None:
+                self.tracer.instant('enqueue_names', epoch=item[0],
+                                    batch_idx=item[1])
+            self.names_queue.put(item)
+            self._outstanding += 1
 
     def __iter__(self):
         return self
@@ -519,7 +1082,69 @@ class ThreadedDataset(object):
         return self.next()
 
     def next(self):
-        return self._step()
+        step_start = time()
+        with self._span('consumer_get', epoch=self.epoch):
+            if self.echo_factor > 1:
+                data_batch = self._echo_step()
+            else:
+                data_batch = self._step()
+        self._account_batch(time() - step_start, data_batch)
+        return data_batch
+
+    def _account_batch(self, wait, data_batch):
+        '''Update the statistics with a batch returned after `wait`'''
+        data = data_batch[0] if self.return_list else data_batch['data']
+        qsizes = None
+        if self.use_threads:
+            qsizes = (self.names_queue.qsize(), self.data_queue.qsize())
+        self._stats.consumer_get(wait, len(data), qsizes)
+        if (self.stats_interval is not None and
+                time() - self._last_stats_log >= self.stats_interval):
+            self._last_stats_log = time()
+            print('{} stats: {}'.format(self.name,
+                                        format_stats(self.stats())))
+
+    def stats(self):
+        '''Return a snapshot of the throughput and stall statistics
+
+        Returns a dict with:
+            * `elapsed`: the seconds since the first batch was requested
+            * `batches`, `samples`: the number of batches and samples
+              returned so far and `batches_per_s`, `samples_per_s` the
+              corresponding rates
+            * `consumer_wait`: the seconds spent by the consumer waiting
+              for the batches and `consumer_wait_fraction` the fraction
+              of `elapsed` it represents. A high fraction means that
+              the training is input-bound
+            * `names_queue_mean`, `names_queue_max`, `data_queue_mean`,
+              `data_queue_max`: the occupancy of the queues, sampled
+              when a batch is returned, and `queue_history` the recent
+              `(seconds, names_queue, data_queue)` samples
+            * `fetched`: the number of batches loaded by the fetchers,
+              `worker_busy` the seconds they spent loading them and
+              `worker_blocked` waiting for room in the `data_queue`
+            * `worker_idle`, `worker_idle_fraction`: the seconds the
+              fetchers spent waiting for names and the fraction of their
+              time it represents. None without threads or with a
+              `worker_pool`
+            * `hedged_fetches`, `timed_out_fetches`: the number of
+              batches queued again or replaced with an IOError because
+              they took too long to load, if any (see `hedge_factor`
+              and `fetch_timeout`)
+            * `fetch_retries`, `worker_deaths`, `worker_restarts`: the
+              number of times the loading of a batch was attempted
+              again and the fetcher threads died and were restarted,
+              if any (see `fetch_retries`), and `hung_fetchers` the
+              number of fetchers replaced because their batch timed out
+        '''
+        nworkers = None
+        if self.use_threads and self.worker_pool is None:
+            nworkers = self.nthreads
+        return self._stats.snapshot(nworkers)
+
+    def reset_stats(self):
+        '''Reset the statistics returned by :meth:`stats`'''
+        self._stats.reset()
 
     def _step(self):
         '''Return one batch
@@ -528,101 +1153,257 @@ class ThreadedDataset(object):
         The infinite loop allows to wait for the fetchers if data is
         consumed too fast.
         '''
+        infinite_gen = self.seq_per_subset and self.seq_per_subset is np.inf
+        step_start = time()
         done = False
         while not done:
+            # END OF EPOCH - All the batches of the current epoch have
+            # been returned. The next epoch has been planned already
+            # and, in the threaded case, is possibly being fetched
+            if not infinite_gen and self._epochs_left.get(self.epoch) == 0:
+                del self._epochs_left[self.epoch]
+                del self._epoch_plans[self.epoch]
+                if self._file_latency is not None:
+                    self._write_slow_files_report()
+                self.epoch += 1
+                if not self.infinite_iterator:
+                    raise StopIteration
+                continue
+
             if self.use_threads:
                 # THREADS
-                # Kill main process if fetcher died
-                if all([df() is None or not df().isAlive()
-                        for df in self.data_fetchers]):
-                    import sys
-                    print('All fetchers threads died. I will suicide!')
-                    sys.exit(0)
+                # Restart the fetchers that died
+                if self.worker_pool is None:
+                    self._supervise_fetchers()
                 try:
                     # Get one minibatch from the out queue
-                    data_batch = self.data_queue.get(False)
-                    self.data_queue.task_done()
-                    # Exception handling
-                    if len(data_batch) == 3:
-                        if (isinstance(data_batch[1], IOError) and not
-                                self.raise_IOErrors):
-                            print('WARNING: Image corrupted or missing!')
-                            print(data_batch[1])
-                            continue  # fetch the next element
-                        if (isinstance(data_batch[1], type(BaseException)) or
-                                isinstance(data_batch[1], BaseException)):
-                            raise data_batch[0], data_batch[1], data_batch[2]
-                    done = True
-                    # When it's an infinite dataset, generate a fixed name
-                    if self.seq_per_subset and self.seq_per_subset is np.inf:
-                        name_batch = [['gen_%i_%i' % (b_idx, f_idx)
-                                       for f_idx in range(self.seq_length)]
-                                      for b_idx in range(self.batch_size)]
-                        self.names_queue.put(name_batch)
-                    else:
-                        try:
-                            name_batch = self.names_batches.next()
-                            self.names_queue.put(name_batch)
-                        except StopIteration:
-                            pass
-                # The data_queue is empty: the epoch is over or we
-                # consumed the data too fast. When the dataset is
-                # infinite, it's always the latter
+                    epoch, data_batch = self._get_data_batch()
                 except Queue.Empty:
-                    if (not self.seq_per_subset or self.seq_per_subset is not
-                            np.inf) and not self.names_queue.unfinished_tasks:
-                        # END OF EPOCH - The data_queue is empty, i.e.
-                        # the name_batches is empty: refill both
-                        self._fill_names_batches(self.shuffle_at_each_epoch)
-                        self._init_names_queue()  # Fill the names queue
-                        if not self.infinite_iterator:
-                            raise StopIteration
+                    # We consumed the data too fast: wait for the fetchers
+                    if self._hedging:
+                        self._check_stragglers()
+                    continue
+                if not infinite_gen:
+                    self._epochs_left[epoch] -= 1
+                # Exception handling
+                if isinstance(data_batch, tuple) and len(data_batch) == 3:
+                    if (isinstance(data_batch[1], IOError) and not
+                            self.raise_IOErrors):
+                        print('WARNING: Image corrupted or missing!')
+                        print(data_batch[1])
+                        continue  # fetch the next element
+                    if (isinstance(data_batch[1], type(BaseException)) or
+                            isinstance(data_batch[1], BaseException)):
+                        raise data_batch[0], data_batch[1], data_batch[2]
+                done = True
             else:
                 # NO THREADS
-                # Generate the filenames when the dataset is an infinite
-                # generator
-                if self.seq_per_subset and self.seq_per_subset is np.inf:
-                    batch_to_load = [['gen_%i_%i' % (b_idx, f_idx)
-                                      for f_idx in range(self.seq_length)]
-                                     for b_idx in range(self.batch_size)]
-                    data_batch = self.fetch_from_dataset(batch_to_load)
+                epoch, batch_idx, batch_to_load = self._next_names_batch()
+                try:
+                    data_batch = self._fetch_with_retries(batch_to_load,
+                                                          epoch, batch_idx)
                     done = True
-                else:
-                    try:
-                        batch_to_load = self.names_batches.next()
-                        data_batch = self.fetch_from_dataset(batch_to_load)
-                        done = True
-                    except StopIteration:
-                        # END OF EPOCH - The name_batches is empty: refill it
-                        self._fill_names_batches(self.shuffle_at_each_epoch)
-                        if not self.infinite_iterator:
-                            raise
-                        # else, loop to the next image
-                    except IOError as e:
-                        if self.raise_IOErrors:
-                            raise
-                        else:
-                            print('WARNING: Image corrupted or missing!')
-                            print(e)
+                except IOError as e:
+                    if self.raise_IOErrors:
+                        raise
+                    else:
+                        print('WARNING: Image corrupted or missing!')
+                        print(e)
+                finally:
+                    if not infinite_gen:
+                        self._epochs_left[epoch] -= 1
 
         assert data_batch is not None
+        if infinite_gen:
+            self._inf_batches_done += 1
+        if self.autotune:
+            self._autotune_step(step_start, data_batch)
         return data_batch
 
-    def fetch_from_dataset(self, batch_to_load):
+    def _get_data_batch(self):
+        '''Get one (epoch, batch) pair from the `data_queue`
+
+        For each batch taken from the `data_queue` a new batch of names
+        is put in the `names_queue`. Unless the sequences are drawn
+        forever (`seq_per_subset` is inf), batches that belong to a
+        later epoch than the current one are held back until the
+        current epoch is over, also when `infinite_iterator` is True.
+        '''
+        infinite_gen = self.seq_per_subset and self.seq_per_subset is np.inf
+        # Serve first the batches of this epoch that were held back
+        for i, (epoch, _) in enumerate(self._early_batches):
+            if epoch == self.epoch:
+                return self._early_batches.pop(i)
+        while True:
+            epoch, data_batch = self.data_queue.get(True, self._wait_time)
+            self.data_queue.task_done()
+            if self.prefetch_bytes is not None:
+                self._release_bytes(_batch_nbytes(data_batch))
+            self._outstanding -= 1
+            self._refill_names_queue()
+            if infinite_gen or epoch == self.epoch:
+                return epoch, data_batch
+            self._early_batches.append((epoch, data_batch))
+
+    def _fetch_names_batch(self, item):
+        '''Load a batch of names taken from the `names_queue`
+
+        The batch is put in the `data_queue`, tagged with its epoch. In
+        case of errors, the exception info is put in the `data_queue`
+        instead.
+        '''
+        epoch, batch_idx, batch_to_load = item
+        if self._hedging and not self._start_fetch(item):
+            # Another copy of this batch has been returned already
+            self.names_queue.task_done()
+            return
+        fetch_start = time()
+        try:
+            with self._span('fetch', epoch=epoch, batch_idx=batch_idx):
+                minibatch_data = self._fetch_with_retries(batch_to_load,
+                                                          epoch, batch_idx)
+        except:  # noqa
+            # If any uncaught exception, pass it along and move on
+            minibatch_data = sys.exc_info()
+        fetch_end = time()
+        if self._hedging and not self._end_fetch(item,
+                                                 fetch_end - fetch_start):
+            self.names_queue.task_done()
+            return
+        if self.autotune:
+            self._fetch_times.append(fetch_end - fetch_start)
+        with self._span('queue_put', epoch=epoch, batch_idx=batch_idx):
+            if self.prefetch_bytes is not None:
+                self._reserve_bytes(_batch_nbytes(minibatch_data))
+            self.data_queue.put((epoch, minibatch_data))
+        self._stats.worker_done(fetch_end - fetch_start, time() - fetch_end)
+        # Signal to the names queue that the job is done
+        self.names_queue.task_done()
+
+    def _fetch_with_retries(self, batch_to_load, epoch, batch_idx):
+        '''Call `fetch_from_dataset`, retrying up to `fetch_retries` times
+
+        The retries wait exponentially longer. The last error is raised.
+        '''
+        for attempt in range(self.fetch_retries + 1):
+            try:
+                return self.fetch_from_dataset(batch_to_load, epoch,
+                                               batch_idx)
+            except Exception:
+                if attempt == self.fetch_retries:
+                    raise
+                self._stats.count('fetch_retries')
+                sleep(self._wait_time * 2 ** attempt)
+
+    def _start_fetch(self, item):
+        '''Register the loading of a batch
+
+        Returns False if the batch does not need to be loaded, because
+        another copy of it has been returned already.
+        '''
+        key = item[:2]
+        with self._fetching_lock:
+            entry = self._fetching.get(key)
+            if entry is None:
+                # [start, item, copies in the pipeline, hedged, done]
+                self._fetching[key] = [time(), item, 1, False, False]
+                return True
+            if not entry[4]:
+                return True
+            self._drop_copy(key, entry)
+            return False
+
+    def _end_fetch(self, item, duration):
+        '''Return True if the loaded batch is the first copy to be done'''
+        key = item[:2]
+        with self._fetching_lock:
+            entry = self._fetching[key]
+            first = not entry[4]
+            entry[4] = True
+            self._drop_copy(key, entry)
+            if first:
+                self._recent_fetch_times.append(duration)
+            return first
+
+    def _drop_copy(self, key, entry):
+        entry[2] -= 1
+        if entry[2] == 0:
+            del self._fetching[key]
+
+    def _check_stragglers(self):
+        '''Hedge or time out the batches that take too long to load'''
+        now = time()
+        with self._fetching_lock:
+            deadline = None
+            if (self.hedge_factor is not None and
+                    len(self._recent_fetch_times) >= 10):
+                deadline = self.hedge_factor * np.percentile(
+                    self._recent_fetch_times, 95)
+            for key, entry in self._fetching.items():
+                start, item, _, hedged, done = entry
+                if done:
+                    continue
+                if (self.fetch_timeout is not None and
+                        now - start > self.fetch_timeout):
+                    try:
+                        raise IOError('Loading batch {} of epoch {} timed '
+                                      'out after {:.1f}s: {}'.format(
+                                          key[1], key[0], now - start,
+                                          item[2]))
+                    except IOError:
+                        _force_put(self.data_queue, (key[0], sys.exc_info()))
+                    entry[4] = True
+                    self._stats.count('timed_out_fetches')
+                    # Replace the fetchers stuck on it, see
+                    # `_supervise_fetchers`
+                    self._hung_fetchers.update(
+                        thread_id for thread_id, it in
+                        self._fetcher_items.items() if it[:2] == key)
+                elif (deadline is not None and not hedged and
+                        now - start > deadline):
+                    # Queue the copy first, so that it is picked by the
+                    # next available fetcher
+                    _force_put(self.names_queue, item, front=True)
+                    entry[2] += 1
+                    entry[3] = True
+                    self._stats.count('hedged_fetches')
+
+    def _reserve_bytes(self, nbytes):
+        '''Wait until a batch of `nbytes` fits in the prefetch budget'''
+        with self._prefetch_cond:
+            while (self._prefetched_bytes > 0 and
+                   self._prefetched_bytes + nbytes > self.prefetch_bytes):
+                self._prefetch_cond.wait(self._wait_time)
+            self._prefetched_bytes += nbytes
+
+    def _release_bytes(self, nbytes):
+        with self._prefetch_cond:
+            self._prefetched_bytes = max(self._prefetched_bytes - nbytes, 0)
+            self._prefetch_cond.notify_all()
+
+    def fetch_from_dataset(self, batch_to_load, epoch=0, batch_idx=0):
         """
         Return *batches* of 5D sequences/clips or 4D images.
 
         `batch_to_load` contains the indices of the first frame/image of
-        each element of the batch.
+        each element of the batch. `epoch` and `batch_idx` identify the
+        batch in the epoch and are used to seed the random number
+        generator of each sample for data augmentation.
         `load_sequence` should return a numpy array of 2 or more
         elements, the first of which 4-dimensional (frame, 0, 1, c)
         or (frame, c, 0, 1) containing the data and the second 3D or 4D
         containing the label.
+
+        When `echo_factor` is greater than 1, each sequence is augmented
+        `echo_factor` times and the list of `(source, sample)` pairs is
+        returned instead, to be batched by the shuffle buffer.
         """
-        batch_ret = {}
+        samples = []
+        sources = []
+        error = None
 
         # Create batches
-        for el in batch_to_load:
+        for i, el in enumerate(batch_to_load):
 
             if el is None:
                 # The first element cannot be None, or we wouldn't have
@@ -630,124 +1411,726 @@ class ThreadedDataset(object):
                 # the last element of the batch for each filename that
                 # is None until we fill the batch.
                 if self.fill_last_batch:
-                    for k in batch_ret.iterkeys():
-                        batch_ret[k].append(batch_ret[k][-1])
+                    samples.extend(samples[-self.echo_factor:])
+                    sources.extend([None] * self.echo_factor)
                 continue
 
-            # Load sequence, format is x:(s, 0, 1, c), y:(s, 0, 1)
-            ret = self.load_sequence(el)
-            assert all(el in ret.keys()
-                       for el in ('data', 'labels', 'filenames', 'subset')), (
-                    'Keys: {}'.format(ret.keys()))
-            assert all(isinstance(el, np.ndarray)
-                       for el in (ret['data'], ret['labels']))
-            raw_data = ret['data'].copy()
-            seq_x, seq_y = ret['data'], ret['labels']
-
-            # Per-image normalization
-            if self.remove_per_img_mean:
-                seq_x -= seq_x.mean(axis=tuple(range(seq_x.ndim - 1)),
-                                    keepdims=True)
-            if self.divide_by_per_img_std:
-                seq_x /= seq_x.std(axis=tuple(range(seq_x.ndim - 1)),
-                                   keepdims=True)
-            # Dataset statistics normalization
-            if self.remove_mean:
-                seq_x -= getattr(self, 'mean', 0)
-            if self.divide_by_std:
-                seq_x /= getattr(self, 'std', 1)
-
-            # Make sure data is 4D and labels 3D
-            if seq_x.ndim == 3:
-                seq_x = seq_x[np.newaxis, ...]
+            try:
+                ret = self._load_sample(el)
+            except IOError as e:
+                if not self.quarantine:
+                    raise
+                self._quarantine_sequence(el, e)
+                if self.raise_IOErrors:
+                    raise
+                error = sys.exc_info()
+                continue
+
+            # Perform data augmentation, if needed, with a different
+            # random number generator for each echo of the sample
+            sample_idx = self._sample_index(batch_idx, i)
+            for echo in range(self.echo_factor):
+                seed = [self._augm_seed, epoch, sample_idx]
+                if echo:
+                    seed.append(echo)
+                samples.append(self._augment_sample(ret, RandomState(seed)))
+                sources.append((epoch, sample_idx))
+
+        if not samples and error is not None:
+            # All the samples of the batch were quarantined
+            raise error[0], error[1], error[2]
+        if error is not None and self.fill_last_batch:
+            # Fill the place of the quarantined samples as for the last
+            # batch
+            while len(samples) < len(batch_to_load) * self.echo_factor:
+                samples.extend(samples[-self.echo_factor:])
+                sources.extend([None] * self.echo_factor)
+        if self.echo_factor > 1:
+            return zip(sources, samples)
+        return self._collate(samples)
+
+    def _sample_index(self, batch_idx, i):
+        '''Return the index in the epoch of the i-th sample of a batch
+
+        The index accounts for the batches of the other shards and is
+        used to seed the data augmentation of the sample.
+        '''
+        return ((batch_idx * self.num_shards + self.shard_id) *
+                self.batch_size + i)
+
+    def _load_sample(self, el):
+        '''Load a sequence and normalize it, before augmentation'''
+        # Load sequence, format is x:(s, 0, 1, c), y:(s, 0, 1)
+        load_start, failed = time(), True
+        try:
+            with self._timer('load_sequence'):
+                ret = self.load_sequence(el)
+            failed = False
+        finally:
+            # The files that fail to load are often the slowest ones
+            if self._file_latency is not None:
+                self._file_latency.add([_file_key(prefix, name)
+                                        for prefix, name in el],
+                                       time() - load_start, failed)
+        assert all(el in ret.keys()
+                   for el in ('data', 'labels', 'filenames', 'subset')), (
+                'Keys: {}'.format(ret.keys()))
+        assert all(isinstance(el, np.ndarray)
+                   for el in (ret['data'], ret['labels']))
+        if self.fields is not None:
+            # Do not carry around the outputs that were not requested
+            ret = dict((k, v) for k, v in ret.iteritems()
+                       if k in ('data', 'labels') or k in self.fields)
+        seq_x, seq_y = ret['data'], ret['labels']
+        raw_data = seq_x if self._wants('raw_data') else None
+
+        with self._timer('normalize'):
+            # The normalized data is written in a new buffer and the
+            # later stages do not modify their input, so raw_data does
+            # not need to be copied
+            seq_x = self._normalize(seq_x)
+
+        # Make sure data is 4D and labels 3D
+        if seq_x.ndim == 3:
+            seq_x = seq_x[np.newaxis, ...]
+            if raw_data is not None:
                 raw_data = raw_data[np.newaxis, ...]
-            assert seq_x.ndim == 4
-            if self.set_has_GT:
-                if seq_y.ndim == 2:
-                    seq_y = seq_y[np.newaxis, ...]
-                assert seq_y.ndim == 3
-
-            # Map all void classes to non_void_nclasses and shift the other
-            # values accordingly, so that the valid values are between 0 and
-            # non_void_nclasses-1 and the void_classes are all equal to
-            # non_void_nclasses.
-            if self.set_has_GT and self._void_labels != []:
-                void_l = self._void_labels
-                void_l.sort(reverse=True)
-                mapping = self._mapping
-
-                # Apply the mapping
-                tmp_class = (-1 if not hasattr(self, 'GTclasses') else
-                             max(self.GTclasses) + 1)
-                seq_y[seq_y == self.non_void_nclasses] = tmp_class
-                for i in sorted(mapping.keys()):
-                    if i == self.non_void_nclasses:
-                        continue
-                    seq_y[seq_y == i] = mapping[i]
-                try:
-                    seq_y[seq_y == tmp_class] = mapping[self.non_void_nclasses]
-                except KeyError:
-                    # none of the original classes was self.non_void_nclasses
-                    pass
+        assert seq_x.ndim == 4
+        if self.set_has_GT:
+            if seq_y.ndim == 2:
+                seq_y = seq_y[np.newaxis, ...]
+            assert seq_y.ndim == 3
+            # Smart cropping looks at the labels of the whole sequence
+            if self.data_augm_kwargs['crop_mode'] != 'smart':
+                seq_y = self._middle_label_frame(seq_y)
+
+        # Map all void classes to non_void_nclasses and shift the other
+        # values accordingly, so that the valid values are between 0 and
+        # non_void_nclasses-1 and the void_classes are all equal to
+        # non_void_nclasses.
+        if self.set_has_GT:
+            with self._timer('remap'):
+                seq_y = self._remap_labels(seq_y)
+
+        ret['data'], ret['labels'] = seq_x, seq_y
+        if raw_data is not None:
+            ret['raw_data'] = raw_data
+        if (self.sampler is not None and self.sampler.lazy and
+                self._wants('seq_id')):
+            # The key of the sequence for update_priorities
+            ret['seq_id'] = getattr(el, 'seq_id', -1)
+        return ret
+
+    def _wants(self, field):
+        '''Return True if `field` has to be returned'''
+        return self.fields is None or field in self.fields
+
+    def _middle_label_frame(self, seq_y):
+        '''Return the middle frame of the labels if only that is returned
 
-            # Perform data augmentation, if needed
+        The frame is returned as a sequence of one frame, so that it
+        can be augmented along with the data.
+        '''
+        if (self.seq_length > 0 and self.return_middle_frame_only and
+                len(seq_y) > 1):
+            mid = self.seq_length // 2
+            return seq_y[mid:mid + 1]
+        return seq_y
+
+    def _compile_normalization(self):
+        '''Fold the dataset statistics normalization in an affine transform
+
+        `remove_mean` and `divide_by_std` amount to `x * _norm_scale +
+        _norm_offset`, computed once rather than at each sample.
+        '''
+        self._norm_scale, self._norm_offset = 1., 0.
+        if self.remove_mean:
+            self._norm_offset = -np.asarray(self.mean, dtype='float64')
+        if self.divide_by_std:
+            self._norm_scale = 1. / np.asarray(self.std, dtype='float64')
+            self._norm_offset = self._norm_offset * self._norm_scale
+
+    def _normalize(self, x):
+        '''Normalize a sequence x (s, 0, 1, c) or image (0, 1, c)
+
+        All the normalizations (per-image mean and std, dataset mean and
+        std and, if `x` is uint8, the conversion to [0, 1]) are folded
+        in a single per-channel affine transform, applied in one pass
+        into a new float32 array. The per-image moments are computed in
+        a single pass over `x` as well. Returns `x` itself if there is
+        nothing to do, i.e., if `x` is not uint8 and no normalization is
+        requested.
+        '''
+        if x.dtype != np.uint8 and not (
+                self.remove_per_img_mean or self.divide_by_per_img_std or
+                self.remove_mean or self.divide_by_std):
+            return x
+        # y = x * scale + offset, starting from the conversion to float
+        scale = 1. / 255 if x.dtype == np.uint8 else 1.
+        offset = 0.
+        if self.remove_per_img_mean or self.divide_by_per_img_std:
+            flat = x.reshape((-1, x.shape[-1]))
+            mean = flat.sum(axis=0, dtype='float64') / len(flat)
+            if self.remove_per_img_mean:
+                offset = -mean * scale
+            if self.divide_by_per_img_std:
+                sq_mean = np.einsum('ij,ij->j', flat, flat,
+                                    dtype='float64') / len(flat)
+                std = np.sqrt(np.maximum(sq_mean - mean ** 2, 0)) * scale
+                scale, offset = scale / std, offset / std
+        # Then the dataset statistics normalization
+        scale, offset = (scale * self._norm_scale,
+                         offset * self._norm_scale + self._norm_offset)
+        out = np.empty(x.shape, dtype='float32')
+        np.multiply(x, np.asarray(scale, dtype='float32'), out=out)
+        out += np.asarray(offset, dtype='float32')
+        return out
+
+    def _augment_sample(self, ret, rng):
+        '''Augment and format a loaded sample, without modifying it'''
+        y_dtype = ret['labels'].dtype
+        with self._timer('augment'):
             seq_x, seq_y = random_transform(
-                seq_x, seq_y,
+                ret['data'], ret['labels'],
                 nclasses=self.nclasses,
                 void_label=self.void_labels,
                 mask_labels=self.mask_labels,
+                rng=rng,
+                timer=self._timer,
                 **self.data_augm_kwargs)
-
-            # Transform targets seq_y to one hot code if return_one_hot
-            # is True
-            if self.set_has_GT and self.return_one_hot:
-                nc = (self.non_void_nclasses if self._void_labels == [] else
-                      self.non_void_nclasses + 1)
-                sh = seq_y.shape
-                seq_y = seq_y.flatten()
-                seq_y_hot = np.zeros((seq_y.shape[0], nc),
-                                     dtype='int32')
-                seq_y = seq_y.astype('int32')
-                seq_y_hot[range(seq_y.shape[0]), seq_y] = 1
-                seq_y_hot = seq_y_hot.reshape(sh + (nc,))
-                seq_y = seq_y_hot
-
-            # Dimshuffle if return_01c is False
-            if not self.return_01c:
+        if self.set_has_GT:
+            # Some transformations return the labels as floats
+            seq_y = self._middle_label_frame(seq_y).astype(y_dtype,
+                                                           copy=False)
+        raw_data = ret.get('raw_data')
+
+        # Pad to the shape of the bucket and mark the valid pixels
+        if self.nbuckets:
+            with self._timer('pad'):
+                shape = np.maximum(
+                    self._bucket_shape(*ret['data'].shape[1:3]),
+                    seq_x.shape[1:3])
+                if self._wants('mask'):
+                    mask = np.zeros((seq_x.shape[0],) + tuple(shape),
+                                    'bool')
+                    mask[:, :seq_x.shape[1], :seq_x.shape[2]] = True
+                seq_x = _pad_01(seq_x, shape, 0)
+                if raw_data is not None:
+                    raw_data = _pad_01(raw_data, shape, 0)
+                if self.set_has_GT:
+                    seq_y = _pad_01(seq_y, shape,
+                                    (self.void_labels or [0])[0])
+
+        # Transform targets seq_y to one hot code if return_one_hot
+        # is True
+        if self.set_has_GT and self.return_one_hot:
+            with self._timer('one_hot'):
+                seq_y = self._one_hot(seq_y)
+
+        # Dimshuffle if return_01c is False
+        if not self.return_01c:
+            with self._timer('transpose'):
                 # s,0,1,c --> s,c,0,1
                 seq_x = seq_x.transpose([0, 3, 1, 2])
-                if self.set_has_GT and self.return_one_hot:
-                    seq_y = seq_y.transpose([0, 3, 1, 2])
-                raw_data = raw_data.transpose([0, 3, 1, 2])
+                if raw_data is not None:
+                    raw_data = raw_data.transpose([0, 3, 1, 2])
 
-            # Return 4D images
-            if not self.return_sequence:
-                seq_x = seq_x[0, ...]
-                if self.set_has_GT:
-                    seq_y = seq_y[0, ...]
+        # Return 4D images
+        if not self.return_sequence:
+            seq_x = seq_x[0, ...]
+            if self.set_has_GT:
+                seq_y = seq_y[0, ...]
+            if raw_data is not None:
                 raw_data = raw_data[0, ...]
-
-            if self.return_0_255:
-                seq_x = (seq_x * 255).astype('uint8')
-            ret['data'], ret['labels'] = seq_x, seq_y
+        elif self.set_has_GT and self.return_middle_frame_only:
+            # Drop the time axis of the middle frame of the labels
+            seq_y = seq_y[0, ...]
+
+        if self.return_0_255:
+            seq_x = (seq_x * 255).astype('uint8')
+        ret = dict(ret)
+        ret['data'], ret['labels'] = seq_x, seq_y
+        if raw_data is not None:
             ret['raw_data'] = raw_data
-            # Append the data of this batch to the minibatch array
-            for k, v in ret.iteritems():
-                batch_ret.setdefault(k, []).append(v)
+        if self.nbuckets and self._wants('mask'):
+            ret['mask'] = mask if self.return_sequence else mask[0]
+        return ret
 
-        for k, v in batch_ret.iteritems():
-            try:
-                batch_ret[k] = np.array(v)
-            except ValueError:
-                # Variable shape: cannot wrap with a numpy array
-                pass
-        if self.seq_length > 0 and self.return_middle_frame_only:
-            batch_ret['labels'] = batch_ret['labels'][:, self.seq_length//2]
+    def _one_hot(self, seq_y):
+        '''Return the one-hot encoding of the labels seq_y (s, 0, 1)
+
+        The encoding is written with a single indexed write in a buffer
+        of dtype `one_hot_dtype`, directly in the (s, 0, 1, c) or (s, c,
+        0, 1) layout, and bit-packed along the class axis if needed.
+        '''
+        nc = self.nclasses
+        if seq_y.size and (seq_y.min() < 0 or seq_y.max() >= nc):
+            raise IndexError('The labels should be between 0 and {}, found '
+                             '{}'.format(nc - 1, np.unique(seq_y)))
+        dtype = 'bool' if self._one_hot_bits else self.one_hot_dtype
+        npix = seq_y[0].size  # The pixels of a frame
+        pix = np.arange(seq_y.size)
+        if self.return_01c:
+            seq_y_hot = np.zeros(seq_y.shape + (nc,), dtype)
+            idx = pix * nc + seq_y.ravel()
+        else:
+            seq_y_hot = np.zeros(seq_y.shape[:1] + (nc,) + seq_y.shape[1:],
+                                 dtype)
+            idx = pix + (pix // npix * (nc - 1) + seq_y.ravel()) * npix
+        seq_y_hot.put(idx, 1)
+        if self._one_hot_bits:
+            seq_y_hot = np.packbits(seq_y_hot,
+                                    axis=-1 if self.return_01c else 1)
+        return seq_y_hot
+
+    def _collate(self, samples):
+        '''Stack a list of samples into a batch'''
+        batch_ret = {}
+        with self._timer('collate'):
+            # Append the data of each sample to the minibatch array
+            for ret in samples:
+                for k, v in ret.iteritems():
+                    batch_ret.setdefault(k, []).append(v)
+
+            for k, v in batch_ret.iteritems():
+                try:
+                    batch_ret[k] = np.array(v)
+                except ValueError:
+                    # Variable shape: cannot wrap with a numpy array
+                    pass
         if self.return_list:
             return [batch_ret['data'], batch_ret['labels']]
         else:
             return batch_ret
 
+    def _echo_step(self):
+        '''Return one batch drawn from the echo shuffle buffer
+
+        The buffer is filled with the echoes of the loaded batches until
+        it holds `echo_buffer_size` samples, then `batch_size` samples
+        are drawn at random from it. At the end of an epoch the buffer
+        is emptied before moving on to the next one.
+        '''
+        infinite_gen = self.seq_per_subset and self.seq_per_subset is np.inf
+        buf = self._echo_buffer
+        while len(buf) < self.echo_buffer_size:
+            epoch_over = (not infinite_gen and
+                          self._epochs_left.get(self.epoch) == 0)
+            if buf and epoch_over:
+                break
+            buf.extend(self._step())
+
+        # Draw the batch, swapping the drawn samples with the last ones
+        # of the buffer to remove them in O(batch_size)
+        batch = []
+        for _ in range(min(self.batch_size, len(buf))):
+            i = self._echo_rng.randint(len(buf))
+            buf[i], buf[-1] = buf[-1], buf[i]
+            batch.append(buf.pop())
+        self._update_echo_stats([source for source, _ in batch])
+        return self._collate([sample for _, sample in batch])
+
+    def _update_echo_stats(self, sources):
+        '''Account for the sources of the samples of one batch'''
+        stats = self._echo_stats
+        batch_id = stats['batches']
+        stats['batches'] += 1
+        stats['samples'] += len(sources)
+        sources = [el for el in sources if el is not None]
+        stats['collisions'] += len(sources) - len(set(sources))
+        for source in set(sources):
+            first, nbatches, nechoes = self._echo_seen.get(
+                source, (batch_id, 0, 0))
+            nechoes += sources.count(source)
+            if nechoes < self.echo_factor:
+                self._echo_seen[source] = (first, nbatches + 1, nechoes)
+                continue
+            # All the echoes of the source have been returned
+            self._echo_seen.pop(source, None)
+            stats['sources'] += 1
+            stats['spread'] += nbatches + 1
+            stats['span'] += batch_id - first
+
+    def _span(self, name, **args):
+        '''Trace a `with` block, if tracing is enabled'''
+        if self.tracer is None:
+            return null_timer(name)
+        return self.tracer.span(name, **args)
+
+    def save_trace(self, path=None):
+        '''Write the trace recorded so far to `path` (default: `trace`)'''
+        if self.tracer is None:
+            raise RuntimeError('Tracing is disabled: create the dataset '
+                               'with trace=<path>')
+        self.tracer.save(path or self.trace)
+
+    def slow_files_report(self):
+        '''Return the load time histogram and the slowest files
+
+        The files are identified by their `(prefix, name)`. Requires
+        `slow_files` to be greater than 0.
+        '''
+        if self._file_latency is None:
+            raise RuntimeError('The load time of the files is not recorded: '
+                               'create the dataset with slow_files > 0')
+        return self._file_latency.report()
+
+    def _write_slow_files_report(self):
+        path = self._cache_path('slow_files', '.txt')
+        try:
+            with open(path, 'w') as f:
+                f.write('Epoch {}\n{}\n'.format(self.epoch,
+                                                self.slow_files_report()))
+        except IOError as e:
+            print('WARNING: Could not write the slow files report: '
+                  '{}'.format(e))
+
+    def profile_report(self, per_worker=False):
+        '''Return a report of the time spent in each stage of the pipeline
+
+        For each stage, the report lists the number of calls, the total
+        time and the mean, median, 99th percentile and maximum duration.
+        The percentiles are approximated with logarithmic bins (10 per
+        decade). If `per_worker` is True a table is returned for each
+        thread, to spot stragglers. Requires `profile` to be True.
+        '''
+        if self.profiler is None:
+            raise RuntimeError('Profiling is disabled: create the dataset '
+                               'with profile=True')
+        return self.profiler.report(per_worker)
+
+    def echo_stats(self):
+        '''Return statistics on the spread of the echoed samples
+
+        Returns a dict with:
+            * `batches`, `samples`: the number of batches and samples
+              returned so far
+            * `collisions`: the number of samples that were returned in
+              the same batch as another echo of the same sequence
+            * `collision_rate`: `collisions` over `samples`
+            * `mean_spread`: the average number of distinct batches the
+              echoes of a sequence were returned in (`echo_factor` at
+              best)
+            * `mean_span`: the average number of batches between the
+              first and the last echo of a sequence
+        The last two only account for the sequences whose echoes have
+        all been returned.
+        '''
+        stats = self._echo_stats
+        sources = max(stats['sources'], 1)
+        return {'batches': stats['batches'],
+                'samples': stats['samples'],
+                'collisions': stats['collisions'],
+                'collision_rate': (stats['collisions'] /
+                                   float(max(stats['samples'], 1))),
+                'mean_spread': stats['spread'] / float(sources),
+                'mean_span': stats['span'] / float(sources)}
+
+    def _reset_echo_buffer(self):
+        self._echo_buffer = []
+        self._echo_seen = {}
+        self._echo_stats = dict.fromkeys(
+            ['batches', 'samples', 'collisions', 'sources', 'spread',
+             'span'], 0)
+
+    def _make_labels_lut(self):
+        '''Return the lookup table of the mapping of the labels
+
+        The labels that are not in the mapping are left unchanged. The
+        negative labels are mapped by `_remap_labels`.'''
+        mapping = self._mapping
+        lut = np.arange(max([self.nclasses] + [k + 1 for k in mapping]))
+        for k, v in mapping.items():
+            if k >= 0:
+                lut[k] = v
+        return lut.astype(self.label_dtype)
+
+    def _remap_labels(self, seq_y):
+        '''Map the void labels to `non_void_nclasses`
+
+        The non void labels are shifted accordingly, so that the valid
+        values are between 0 and non_void_nclasses-1. The labels are
+        returned as a new array of dtype `label_dtype`, or int64 if
+        some of the labels out of the mapping do not fit in it.'''
+        lut = self._labels_lut
+        if seq_y.dtype.kind not in 'iu':
+            seq_y = seq_y.astype('int64')
+        if seq_y.size == 0 or (seq_y.min() >= 0 and
+                               seq_y.max() < len(lut)):
+            # A single lookup for all the classes
+            return lut[seq_y]
+        # Leave the labels out of the range of the mapping unchanged
+        out = seq_y.astype('int64')
+        valid = (seq_y >= 0) & (seq_y < len(lut))
+        out[valid] = lut[seq_y[valid]]
+        for k, v in self._mapping.items():
+            if k < 0:
+                out[seq_y == k] = v
+        info = np.iinfo(lut.dtype)
+        if out.min() >= info.min and out.max() <= info.max:
+            return out.astype(lut.dtype)
+        return out
+
+    def _cache_path(self, kind, ext='.npz'):
+        '''Return the path of the `kind` cache file of this set'''
+        return os.path.join(self.path, '{}_{}{}'.format(
+            kind, getattr(self, 'which_set', 'default'), ext))
+
+    def _names_digest(self):
+        '''Return a digest of the (prefix, name) of each image/frame
+
+        Used as the key of the caches of per-frame data in `path`, so
+        that the names, which are not necessarily strings (e.g., dicts),
+        do not need to be saved.
+        '''
+        keys = [_file_key(p, n) for p, n in zip(
+            self._prefixes[self._names_prefix].tolist(),
+            self._names.tolist())]
+        return hashlib.sha1(json.dumps(keys, default=repr)).hexdigest()
+
+    def _load_cache(self, cache_path, key):
+        '''Return the cache at `cache_path` if its key is `key`
+
+        Returns None if the cache is missing, unreadable or outdated.
+        '''
+        try:
+            cache = np.load(cache_path)
+            if str(cache['key']) == key:
+                return cache
+        except (IOError, KeyError, ValueError):
+            pass
+        return None
+
+    def class_histograms(self):
+        '''Return the class histogram of each sequence
+
+        Returns an array of shape (nsequences, nclasses) with the number
+        of pixels of each class, after the void labels have been mapped,
+        in each sequence (see `names_sequences` for the order). The
+        histograms of the frames are computed in parallel with
+        `nthreads` threads the first time and cached in `path`.
+        '''
+        if not self.set_has_GT:
+            raise RuntimeError('Cannot compute the class histograms of a '
+                               'set without ground truth')
+        nc = self.nclasses
+        names = self._names
+        prefixes = self._prefixes[self._names_prefix]
+        cache_path = self._cache_path('class_hist')
+        key = self._names_digest()
+        cache = self._load_cache(cache_path, key)
+        if cache is not None:
+            hist = cache['hist']
+        else:
+            def frame_hist(i):
+                ret = self.load_sequence([(prefixes[i], names[i])])
+                seq_y = self._remap_labels(np.array(ret['labels']))
+                return np.bincount(seq_y.ravel().astype('int64'),
+                                   minlength=nc)[:nc]
+
+            pool = ThreadPool(max(self.nthreads, 1))
+            try:
+                hist = np.array(pool.map(frame_hist, range(len(names))),
+                                dtype='int64').reshape((-1, nc))
+            finally:
+                pool.close()
+            try:
+                np.savez(cache_path, key=key, hist=hist)
+            except (IOError, OSError) as e:
+                warnings.warn('Could not cache the class histograms: '
+                              '{}'.format(e))
+
+        # Sum the histograms of the frames of each sequence
+        cum_hist = np.concatenate([np.zeros((1, nc), 'int64'),
+                                   np.cumsum(hist, axis=0)])
+        return (cum_hist[self._seq_start + max(self.seq_length, 1)] -
+                cum_hist[self._seq_start])
+
+    def dataset_stats(self, recompute=False):
+        '''Return the statistics of the images and labels of the set
+
+        See :func:`~dataset_stats.compute_stats`. The statistics are
+        computed in parallel with `nthreads` threads the first time (or
+        if `recompute` is True) and cached in `path`. They are used by
+        `remove_mean` and `divide_by_std` when the dataset does not
+        define `mean` and `std`.
+        '''
+        cache_path = self._cache_path('stats')
+        # The statistics of uint8 data are in [0, 1] since v2
+        key = 'v2-' + self._names_digest()
+        cache = None if recompute else self._load_cache(cache_path, key)
+        if cache is not None:
+            # The statistics that are None are listed in `missing`
+            stats = dict((k, None) for k in cache['missing'].tolist())
+            stats.update((k, cache[k] if cache[k].ndim else cache[k].item())
+                         for k in cache.files if k not in ('key', 'missing'))
+            return stats
+        print('Computing the statistics of {} {}'.format(
+            self.name, getattr(self, 'which_set', '')))
+        stats = compute_stats(self)
+        missing = [k for k, v in stats.items() if v is None]
+        present = dict((k, v) for k, v in stats.items() if v is not None)
+        try:
+            np.savez(cache_path, key=key,
+                     missing=np.array(missing, dtype='str'), **present)
+        except (IOError, OSError) as e:
+            warnings.warn('Could not cache the statistics: {}'.format(e))
+        return stats
+
+    def get_image_size(self, prefix, name):
+        '''Return the size (rows, cols) of the image/frame `name`
+
+        Used to build the index of :meth:`image_sizes`. By default the
+        image is loaded with `load_sequence`: datasets should override
+        this to only read the header of the image file.
+        '''
+        return self.load_sequence([(prefix, name)])['data'].shape[1:3]
+
+    def image_sizes(self):
+        '''Return the size (rows, cols) of each image/frame
+
+        Returns an array of shape (nframes, 2), in the order of
+        `_names`. The sizes are read in parallel with `nthreads` threads
+        with :meth:`get_image_size` the first time and cached in `path`
+        (the header index).
+        '''
+        names = self._names
+        prefixes = self._prefixes[self._names_prefix]
+        cache_path = self._cache_path('header_index')
+        key = self._names_digest()
+        cache = self._load_cache(cache_path, key)
+        if cache is not None:
+            return cache['sizes']
+
+        def frame_size(i):
+            return tuple(self.get_image_size(prefixes[i], names[i])[:2])
+
+        pool = ThreadPool(max(self.nthreads, 1))
+        try:
+            sizes = np.array(pool.map(frame_size, range(len(names))),
+                             dtype='int64').reshape((-1, 2))
+        finally:
+            pool.close()
+        try:
+            np.savez(cache_path, key=key, sizes=sizes)
+        except (IOError, OSError) as e:
+            warnings.warn('Could not cache the header index: {}'.format(e))
+        return sizes
+
+    def _load_quarantine(self):
+        '''Load the (prefix, name) pairs quarantined by previous runs'''
+        path = self._cache_path('quarantine', '.txt')
+        try:
+            with open(path) as f:
+                self._quarantined = set(tuple(json.loads(line)) for line in f
+                                        if line.strip())
+        except IOError:
+            return
+        if self._quarantined:
+            print('{} images/frames of {} are quarantined, see {}'.format(
+                len(self._quarantined), self.name, path))
+
+    def _quarantine_mask(self, keys):
+        '''Return which sequences contain any of the (prefix, name) keys'''
+        prefixes = dict((p, i) for i, p in enumerate(self._prefixes.tolist()))
+        bad = np.zeros(len(self._names), 'bool')
+        for prefix, name in keys:
+            if prefix not in prefixes:
+                continue
+            in_prefix = np.where(self._names_prefix == prefixes[prefix])[0]
+            bad[in_prefix[[_file_key(prefix, n)[1] == name for n in
+                           self._names[in_prefix].tolist()]]] = True
+        # A sequence is quarantined if any of its frames is
+        cumsum = np.concatenate([[0], np.cumsum(bad)])
+        return (cumsum[self._seq_start + max(self.seq_length, 1)] >
+                cumsum[self._seq_start])
+
+    def _quarantine_sequence(self, sequence, error):
+        '''Quarantine the images/frames of a sequence that failed to load'''
+        keys = set(_file_key(prefix, name) for prefix, name in sequence)
+        with self._quarantine_lock:
+            keys -= self._quarantined
+            if not keys:
+                return
+            self._quarantined |= keys
+            try:
+                with open(self._cache_path('quarantine', '.txt'), 'a') as f:
+                    for key in sorted(keys):
+                        f.write(json.dumps(key) + '\n')
+            except IOError as e:
+                warnings.warn('Could not write the quarantine file: '
+                              '{}'.format(e))
+            mask = self._quarantine_mask(keys)
+            if self._seq_quarantined is not None:
+                mask |= self._seq_quarantined
+            self._seq_quarantined = mask
+            if self._sum_tree is not None:
+                self._sum_tree.update(np.where(mask)[0], 0)
+        self._stats.count('quarantined', len(keys))
+        print('WARNING: Quarantined {}: {}'.format(sorted(keys), error))
+
+    def quarantined(self):
+        '''Return the sorted list of the quarantined (prefix, name) pairs'''
+        with self._quarantine_lock:
+            return sorted(self._quarantined)
+
+    def verify(self, nthreads=None):
+        '''Load every sequence once and quarantine the ones that fail
+
+        The sequences are loaded in parallel with `nthreads` threads
+        (default: `nthreads`), without data augmentation, to find the
+        corrupted or missing images before training. Requires
+        `quarantine` to be True. Returns the list of quarantined
+        (prefix, name) pairs.
+        '''
+        if not self.quarantine:
+            raise RuntimeError('Quarantine is disabled: create the dataset '
+                               'with quarantine=True')
+
+        def check(seq_id):
+            seq = self._get_sequence(seq_id)
+            try:
+                self.load_sequence(seq)
+            except IOError as e:
+                self._quarantine_sequence(seq, e)
+
+        seq_ids = np.arange(len(self._seq_start))
+        if self._seq_quarantined is not None:
+            seq_ids = seq_ids[~self._seq_quarantined]
+        pool = ThreadPool(max(nthreads or self.nthreads, 1))
+        try:
+            pool.map(check, seq_ids.tolist())
+        finally:
+            pool.close()
+        return self.quarantined()
+
+    def update_priorities(self, seq_ids, losses):
+        '''Update the priorities of the prioritized sampler
+
+        Parameters
+        ----------
+        seq_ids: array of ints
+            The ids of the sequences, as returned in the `seq_id` key of
+            a batch.
+        losses: array of floats
+            One loss per sequence, converted into a priority by the
+            sampler.
+
+        Since the sequences are drawn when the batches are put in the
+        queue, the new priorities affect the batches that follow the
+        ones already in the queue.
+        '''
+        if self._sum_tree is None:
+            raise RuntimeError('update_priorities requires a prioritized '
+                               'sampler')
+        seq_ids = np.asarray(seq_ids, dtype='int64').ravel()
+        priorities = self.sampler.priorities(losses) * np.ones(len(seq_ids))
+        with self._quarantine_lock:
+            if self._seq_quarantined is not None:
+                # The quarantined sequences are never drawn
+                priorities[self._seq_quarantined[seq_ids]] = 0
+            self._sum_tree.update(seq_ids, priorities)
+
     def reset(self, shuffle, reload_sequences_from_dataset=True):
         '''Reset the dataset loader
 
@@ -771,31 +2154,169 @@ class ThreadedDataset(object):
             # desired overlap
             self._fill_names_sequences()
 
+        # Reset the queues
+        if self.use_threads:
+            self._empty_queues()
+
+        # Restart planning from the current epoch
+        self._reset_echo_buffer()
+        self._early_batches = []
+        self._epochs_left = {}
+        self._epoch_plans = {}
+        self._plan_epoch = self.epoch - 1
+        self._plan_left = 0
+
         # Select the sequences we want, according to the parameters
         # Sets self.nsamples, self.nbatches and self.names_batches.
-        # Self.names_batches is an iterator over the batches of names.
         self._fill_names_batches(shuffle)
 
-        # Reset the queues
         if self.use_threads:
-            # Empty names_queue
-            done = False
-            while not done:
-                try:
-                    self.names_queue.get(False)
-                    self.names_queue.task_done()
-                except Queue.Empty:
-                    done = True
-            # Wait for the fetchers to be done
-            while self.names_queue.unfinished_tasks:
-                sleep(self._wait_time)
-            # Empty the data_queue
-            self.data_queue.queue.clear()
-            self.data_queue.unfinished_tasks = 0
-
             # Refill the names queue
             self._init_names_queue()
 
+    def _init_autotune(self):
+        self._max_threads = max(self.nthreads, multiprocessing.cpu_count())
+        try:
+            self._max_prefetch_bytes = (os.sysconf('SC_PHYS_PAGES') *
+                                        os.sysconf('SC_PAGE_SIZE') // 4)
+        except (AttributeError, ValueError, OSError):
+            self._max_prefetch_bytes = np.inf
+        if self.prefetch_bytes is not None:
+            self._max_prefetch_bytes = self.prefetch_bytes
+        self._fetch_times = deque(maxlen=self._autotune_interval)
+        self._wait_times = []
+        self._busy_times = []
+        self._last_step_end = None
+
+    _autotune_interval = 20
+
+    def _autotune_step(self, step_start, data_batch):
+        '''Measure the consumer and adapt `nthreads` and `queues_size`
+
+        Every `_autotune_interval` batches, compare the time the consumer
+        waits for a batch with the time it spends processing it (between
+        two calls to `next`). When the consumer waits, a fetcher is
+        added, otherwise one is removed if the others can keep up. The
+        prefetch depth covers one batch per active fetcher plus the
+        batches consumed while a batch is loaded, up to one more per
+        fetcher since a deeper queue does not help a starving consumer.
+        '''
+        now = time()
+        self._wait_times.append(now - step_start)
+        if self._last_step_end is not None:
+            self._busy_times.append(step_start - self._last_step_end)
+        self._last_step_end = now
+        if (len(self._wait_times) < self._autotune_interval or
+                not self._busy_times or not self._fetch_times):
+            return
+        wait = np.mean(self._wait_times)
+        busy = max(np.mean(self._busy_times), 1e-4)
+        fetch = np.mean(self._fetch_times)
+        self._wait_times, self._busy_times = [], []
+
+        nthreads = self.nthreads
+        if self.worker_pool is None:
+            if wait > 0.05 * (wait + busy):
+                nthreads = min(nthreads + 1, self._max_threads)
+            elif nthreads > 1 and fetch < 0.8 * busy * (nthreads - 1):
+                nthreads -= 1
+        max_depth = max(2, int(self._max_prefetch_bytes //
+                               max(_batch_nbytes(data_batch), 1)))
+        depth = min(nthreads + int(np.ceil(min(fetch / busy, nthreads))),
+                    max_depth)
+        if (nthreads, depth) == (self.nthreads, self.queues_size):
+            return
+        while len(self.data_fetchers) < nthreads:
+            self._start_fetcher()
+        self.nthreads, self.queues_size = nthreads, depth
+        print('Autotune {}: nthreads={}, queues_size={} (fetch {:.3f}s, '
+              'consumer {:.3f}s, wait {:.3f}s per batch)'.format(
+                  self.name, nthreads, depth, fetch, busy, wait))
+
+    def _empty_queues(self):
+        '''Empty the queues and wait for the fetchers to be idle'''
+        # Empty names_queue
+        done = False
+        while not done:
+            try:
+                self.names_queue.get(False)
+                self.names_queue.task_done()
+            except Queue.Empty:
+                done = True
+        # Wait for the fetchers to be done, making room for them in
+        # the data_queue
+        while self.names_queue.unfinished_tasks:
+            self.data_queue.queue.clear()
+            with self.data_queue.not_full:
+                self.data_queue.not_full.notify_all()
+            self._release_bytes(self._prefetched_bytes)
+            sleep(self._wait_time)
+        # Empty the data_queue
+        self.data_queue.queue.clear()
+        self.data_queue.unfinished_tasks = 0
+        self._fetching.clear()
+        self._fetcher_items.clear()
+        self._hung_fetchers.clear()
+        self._requeued.clear()
+        self._release_bytes(self._prefetched_bytes)
+
+    def state_dict(self):
+        '''Return the state of the iterator
+
+        The state contains the current epoch, the index of the next
+        batch to be returned in the epoch (the cursor), the state of
+        `rng` at the time the epoch was planned and the seed of the
+        data augmentation. Together with :meth:`load_state_dict` this
+        allows to resume an interrupted iteration where it stopped.
+
+        Note that the position in the epoch is exact only when the
+        batches are returned in order, i.e., when `nthreads` is 1 or
+        threads are not used, and `echo_factor` is 1: the echoes in the
+        shuffle buffer are not saved.
+        '''
+        state_dict = {'augm_seed': self._augm_seed}
+        if self.seq_per_subset and self.seq_per_subset is np.inf:
+            state_dict.update({'epoch': 0, 'batch': self._inf_batches_done,
+                               'rng': self.rng.get_state(),
+                               'shuffle': self.shuffle_at_each_epoch})
+            return state_dict
+        if self.epoch not in self._epoch_plans:
+            # Without threads the next epoch is planned lazily, e.g., it
+            # is not planned yet right after a StopIteration
+            self._fill_names_batches(self.shuffle_at_each_epoch)
+        rng_state, shuffle, nbatches = self._epoch_plans[self.epoch]
+        state_dict.update({'epoch': self.epoch,
+                           'batch': nbatches - self._epochs_left[self.epoch],
+                           'rng': rng_state,
+                           'shuffle': shuffle})
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        '''Restore the state of the iterator
+
+        Restores a state returned by :meth:`state_dict`. The batches of
+        names of the saved epoch are recreated and the ones that had
+        already been returned are skipped, without loading any data.
+        '''
+        if self.use_threads:
+            self._empty_queues()
+        self.rng.set_state(state_dict['rng'])
+        self._augm_seed = state_dict['augm_seed']
+        self.epoch = state_dict['epoch']
+        self._reset_echo_buffer()
+        self._early_batches = []
+        self._epochs_left = {}
+        self._epoch_plans = {}
+        self._plan_epoch = self.epoch - 1
+        self._plan_left = 0
+        if self.seq_per_subset and self.seq_per_subset is np.inf:
+            self._inf_batch_idx = self._inf_batches_done = state_dict['batch']
+        else:
+            self._fill_names_batches(state_dict['shuffle'],
+                                     start=state_dict['batch'])
+        if self.use_threads:
+            self._init_names_queue()
+
     def shuffle(self):
         '''Shuffles the sequences and creates new batches, according to
         the initial parameters. To account for changes in the parameters
@@ -803,11 +2324,16 @@ class ThreadedDataset(object):
         if self.seq_per_subset and self.seq_per_subset is np.inf:
             warnings.warn("You cannot shuffle an infinite dataset!")
             return
-        self._fill_names_batches(True)
+        self._fill_names_batches(True, new_epoch=False)
 
     def finish(self):
-        # Stop fetchers
+        if self.worker_pool is not None:
+            self.worker_pool.unregister(self)
+        # Stop fetchers, including the idle ones, making sure they are
+        # not waiting for room in the data_queue
         try:
+            self.nthreads = len(self.data_fetchers)
+            self._empty_queues()
             for _ in self.data_fetchers:
                 self.names_queue.put(self.sentinel)
             while any([df() is not None and df().isAlive()
@@ -820,6 +2346,8 @@ class ThreadedDataset(object):
         except AttributeError:
             # Not using threads
             pass
+        if self.tracer is not None:
+            self.tracer.save(self.trace)
 
     @classproperty
     def __config_parser__(self):
@@ -851,6 +2379,14 @@ class ThreadedDataset(object):
         return (self.non_void_nclasses + 1 if hasattr(self, '_void_labels') and
                 self._void_labels != [] else self.non_void_nclasses)
 
+    @classproperty
+    def label_dtype(self):
+        '''The dtype of the labels: the smallest that fits the classes'''
+        n = max([self.nclasses] + [k + 1 for k in self._mapping])
+        if n <= 256:
+            return np.dtype('uint8')
+        return np.dtype('int16' if n <= 32768 else 'int32')
+
     @classproperty
     def void_labels(self):
         '''Returns the void label(s)
@@ -908,12 +2444,63 @@ class ThreadedDataset(object):
                          sorted(inv_mapping.keys())])
 
 
-def threaded_fetch(weakself):
+def _batch_nbytes(batch):
+    '''Return the number of bytes of the arrays of a batch'''
+    if isinstance(batch, np.ndarray):
+        return batch.nbytes
+    if isinstance(batch, dict):
+        batch = batch.values()
+    if isinstance(batch, (list, tuple)):
+        return sum(_batch_nbytes(v) for v in batch)
+    return 0
+
+
+def _force_put(queue, item, front=False):
+    '''Put `item` in `queue` without blocking, even if it is full
+
+    The item is put at the front of the queue if `front` is True.
+    '''
+    with queue.mutex:
+        if front:
+            queue.queue.appendleft(item)
+        else:
+            queue.queue.append(item)
+        queue.unfinished_tasks += 1
+        queue.not_empty.notify()
+
+
+class _Sequence(tuple):
+    '''A tuple of (prefix, name) pairs that knows the id of its sequence'''
+    def __new__(cls, pairs, seq_id):
+        seq = tuple.__new__(cls, pairs)
+        seq.seq_id = seq_id
+        return seq
+
+
+def _file_key(prefix, name):
+    '''Return a hashable key for a file, also for non-string names'''
+    try:
+        hash(name)
+    except TypeError:
+        name = repr(name)
+    return prefix, name
+
+
+def _pad_01(x, shape, value):
+    '''Pad the axes 1 and 2 of `x` at the end to `shape` with `value`'''
+    pad = [(0, 0)] * x.ndim
+    pad[1] = (0, shape[0] - x.shape[1])
+    pad[2] = (0, shape[1] - x.shape[2])
+    return np.pad(x, pad, 'constant', constant_values=value)
+
+
+def threaded_fetch(weakself, thread_id=0):
     """
     Fill the data_queue.
 
     Whenever there are names in the names queue, it will read them,
-    fetch the corresponding data and fill the data_queue.
+    fetch the corresponding data and fill the data_queue. Fetchers
+    whose `thread_id` is not lower than `nthreads` are idle.
 
     Note that in case of errors, it will put the exception object in the
     data_queue.
@@ -924,27 +2511,27 @@ def threaded_fetch(weakself):
         if self is None:
             break
         try:
+            df = self.data_fetchers[thread_id]
+            if df is not None and df() is not current_thread():
+                # Replaced by another fetcher after timing out
+                break
+            if thread_id >= self.nthreads:
+                continue
+
             # Grabs names from queue
-            batch_to_load = self.names_queue.get(False)
+            item = self.names_queue.get(False)
 
-            if batch_to_load is self.sentinel:
+            if item is self.sentinel:
                 self.names_queue.task_done()
                 break
 
-            # Load the data
-            minibatch_data = self.fetch_from_dataset(batch_to_load)
-
-            # Place it in data_queue
-            self.data_queue.put(minibatch_data)
-
-            # Signal to the names queue that the job is done
-            self.names_queue.task_done()
+            # Load the data and place it in data_queue
+            self._fetcher_items[thread_id] = item
+            self._fetch_names_batch(item)
+            if self._fetcher_items.get(thread_id) is item:
+                del self._fetcher_items[thread_id]
         except Queue.Empty:
             # names_queue is empty --> loop again
             pass
-        except:  # noqa
-            # If any uncaught exception, pass it along and move on
-            self.data_queue.put(sys.exc_info())
-            self.names_queue.task_done()
         finally:
             del(self)
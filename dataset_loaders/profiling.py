@@ -0,0 +1,459 @@
+from collections import deque
+from contextlib import contextmanager
+import heapq
+import json
+import math
+import os
+import threading
+from time import time
+
+
+class Histogram(object):
+    '''A histogram of durations, with logarithmic bins
+
+    The bins span from 1 microsecond to 1000 seconds, with
+    `bins_per_decade` bins per power of 10. Adding a duration costs a
+    logarithm, so that the histograms can be kept during training.
+    '''
+    bins_per_decade = 10
+    min_exp = -6
+    max_exp = 3
+
+    def __init__(self):
+        self.counts = [0] * ((self.max_exp - self.min_exp) *
+                             self.bins_per_decade + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, duration):
+        idx = 0
+        if duration > 0:
+            idx = int((math.log10(duration) - self.min_exp) *
+                      self.bins_per_decade) + 1
+            idx = min(max(idx, 0), len(self.counts) - 1)
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def merge(self, other):
+        '''Add the durations of `other` to this histogram'''
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def bins(self):
+        '''Yield the `(lower, upper, count)` of the non-empty bins'''
+        for idx, count in enumerate(self.counts):
+            if count:
+                yield (10 ** (self.min_exp + float(idx - 1) /
+                              self.bins_per_decade) if idx else 0.,
+                       10 ** (self.min_exp + float(idx) /
+                              self.bins_per_decade),
+                       count)
+
+    def percentile(self, q):
+        '''Return the upper edge of the bin of the `q`-th percentile'''
+        threshold = q / 100. * self.count
+        cumsum = 0
+        for idx, count in enumerate(self.counts):
+            cumsum += count
+            if count and cumsum >= threshold:
+                break
+        return min(10 ** (self.min_exp + float(idx) / self.bins_per_decade),
+                   self.max)
+
+
+class _NullTimer(object):
+    '''A context manager that does nothing, when profiling is disabled'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def null_timer(stage):
+    '''Return a timer that does not time anything'''
+    return _null_timer
+
+
+class Profiler(object):
+    '''Collect the time spent in each stage of the fetch pipeline
+
+    Each thread records its durations in its own histograms, without
+    locking, and :meth:`report` aggregates them.
+    '''
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._workers = {}
+
+    def _histograms(self):
+        '''Return the histograms of the current thread'''
+        histograms = getattr(self._local, 'histograms', None)
+        if histograms is None:
+            histograms = self._local.histograms = {}
+            with self._lock:
+                self._workers[threading.current_thread().name] = histograms
+        return histograms
+
+    def record(self, stage, duration):
+        '''Account for `duration` seconds spent in `stage`'''
+        histograms = self._histograms()
+        if stage not in histograms:
+            histograms[stage] = Histogram()
+        histograms[stage].add(duration)
+
+    @contextmanager
+    def timer(self, stage):
+        '''Time the execution of a `with` block as `stage`'''
+        start = time()
+        try:
+            yield
+        finally:
+            self.record(stage, time() - start)
+
+    def histograms(self, per_worker=False):
+        '''Return the histograms of each stage
+
+        If `per_worker` is True, returns a dict of histograms per worker
+        thread, otherwise the histograms of all the workers are merged.
+        '''
+        with self._lock:
+            workers = dict((name, dict(histograms)) for name, histograms in
+                           self._workers.items())
+        if per_worker:
+            return workers
+        merged = {}
+        for histograms in workers.values():
+            for stage, hist in histograms.items():
+                merged.setdefault(stage, Histogram()).merge(hist)
+        return merged
+
+    def report(self, per_worker=False):
+        '''Return a table with the statistics of each stage'''
+        if per_worker:
+            groups = sorted(self.histograms(per_worker=True).items())
+        else:
+            groups = [('all workers', self.histograms())]
+        lines = []
+        for name, histograms in groups:
+            lines.append('{}:'.format(name))
+            lines.append('  {:<24} {:>8} {:>10} {:>10} {:>10} {:>10} '
+                         '{:>10}'.format('stage', 'count', 'total [s]',
+                                         'mean [ms]', 'p50 [ms]', 'p99 [ms]',
+                                         'max [ms]'))
+            for stage, hist in sorted(histograms.items()):
+                lines.append(
+                    '  {:<24} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} '
+                    '{:>10.3f}'.format(stage, hist.count, hist.total,
+                                       1e3 * hist.mean,
+                                       1e3 * hist.percentile(50),
+                                       1e3 * hist.percentile(99),
+                                       1e3 * hist.max))
+        return '\n'.join(lines)
+
+
+class PipelineStats(object):
+    '''Cheap counters of the throughput and stalls of a loader
+
+    The consumer accounts for each batch it gets, the fetchers for each
+    batch they load. Only sums and maxima are updated, under a lock
+    taken once per batch, so that the counters can be left on.
+
+    Parameters
+    ----------
+    history_size: int
+        The number of recent queue occupancy samples to keep.
+        Default: 256.
+    '''
+    def __init__(self, history_size=256):
+        self._lock = threading.Lock()
+        self.history_size = history_size
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start = time()
+            self.first_get = None
+            self.batches = 0
+            self.samples = 0
+            self.consumer_wait = 0.
+            self.qsize_samples = 0
+            self.qsize_sums = [0, 0]
+            self.qsize_max = [0, 0]
+            self.qsize_history = deque(maxlen=self.history_size)
+            self.fetched = 0
+            self.worker_busy = 0.
+            self.worker_blocked = 0.
+            self.events = {}
+
+    def consumer_get(self, wait, nsamples, qsizes=None):
+        '''Account for a batch of `nsamples` returned to the consumer
+
+        `wait` is the time the consumer waited for it and `qsizes` the
+        occupancy of the names and data queues, if any.
+        '''
+        now = time()
+        with self._lock:
+            if self.first_get is None:
+                self.first_get = now - wait
+            self.batches += 1
+            self.samples += nsamples
+            self.consumer_wait += wait
+            if qsizes is not None:
+                self.qsize_samples += 1
+                for i, qsize in enumerate(qsizes):
+                    self.qsize_sums[i] += qsize
+                    self.qsize_max[i] = max(self.qsize_max[i], qsize)
+                self.qsize_history.append((now - self.start,) +
+                                          tuple(qsizes))
+
+    def worker_done(self, busy, blocked):
+        '''Account for a batch loaded in `busy` seconds by a fetcher,
+        that then waited `blocked` seconds for room in the queue'''
+        with self._lock:
+            self.fetched += 1
+            self.worker_busy += busy
+            self.worker_blocked += blocked
+
+    def count(self, event, n=1):
+        '''Count `n` occurrences of `event` (e.g., a retried batch)'''
+        with self._lock:
+            self.events[event] = self.events.get(event, 0) + n
+
+    def snapshot(self, nworkers=None):
+        '''Return the counters and the rates derived from them
+
+        The idle time of the workers is only known if the number of
+        workers `nworkers` is given.
+        '''
+        now = time()
+        with self._lock:
+            elapsed = now - (self.first_get or now)
+            nqs = max(self.qsize_samples, 1)
+            stats = {
+                'elapsed': elapsed,
+                'batches': self.batches,
+                'samples': self.samples,
+                'batches_per_s': self.batches / elapsed if elapsed else 0.,
+                'samples_per_s': self.samples / elapsed if elapsed else 0.,
+                'consumer_wait': self.consumer_wait,
+                'consumer_wait_fraction': (min(self.consumer_wait / elapsed,
+                                               1.) if elapsed else 0.),
+                'names_queue_mean': self.qsize_sums[0] / float(nqs),
+                'names_queue_max': self.qsize_max[0],
+                'data_queue_mean': self.qsize_sums[1] / float(nqs),
+                'data_queue_max': self.qsize_max[1],
+                'queue_history': list(self.qsize_history),
+                'fetched': self.fetched,
+                'worker_busy': self.worker_busy,
+                'worker_blocked': self.worker_blocked,
+                'worker_idle': None,
+                'worker_idle_fraction': None}
+            stats.update(self.events)
+            if nworkers:
+                capacity = (now - self.start) * nworkers
+                idle = max(capacity - self.worker_busy -
+                           self.worker_blocked, 0.)
+                stats['worker_idle'] = idle
+                stats['worker_idle_fraction'] = (idle / capacity if capacity
+                                                 else 0.)
+        return stats
+
+
+def format_stats(stats):
+    '''Return a one-line summary of a :meth:`PipelineStats.snapshot`'''
+    line = ('{batches_per_s:.2f} batches/s, {samples_per_s:.1f} samples/s, '
+            'consumer waiting {consumer_wait_fraction:.0%}, queues '
+            '{names_queue_mean:.1f}/{data_queue_mean:.1f} (names/data)')
+    if stats['worker_idle_fraction'] is not None:
+        line += ', workers idle {worker_idle_fraction:.0%}'
+    return line.format(**stats)
+
+
+class FileLatency(object):
+    '''Track the load time of the files, to find the slowest ones
+
+    Keeps a histogram of the load times, the `top_k` files with the
+    longest load time seen so far and the files that failed to load.
+
+    Parameters
+    ----------
+    top_k: int
+        The number of slowest files to keep. Default: 20.
+    '''
+    def __init__(self, top_k=20):
+        self.top_k = top_k
+        self._lock = threading.Lock()
+        self.histogram = Histogram()
+        self._slowest = {}
+        self._failed = {}
+
+    def add(self, keys, duration, failed=False):
+        '''Account for the files `keys`, loaded together in `duration`
+
+        The duration is split evenly among the files. If `failed` is
+        True, the loading of the files raised an error after `duration`.
+        '''
+        duration /= float(max(len(keys), 1))
+        with self._lock:
+            for key in keys:
+                self.histogram.add(duration)
+                if duration > self._slowest.get(key, -1):
+                    self._slowest[key] = duration
+                if failed:
+                    self._failed[key] = self._failed.get(key, 0) + 1
+            # Prune once in a while, to keep add cheap
+            if len(self._slowest) > 2 * self.top_k:
+                self._slowest = dict(heapq.nlargest(
+                    self.top_k, self._slowest.items(), key=lambda el: el[1]))
+
+    def slowest(self):
+        '''Return the `(duration, key)` of the slowest files, slowest first'''
+        with self._lock:
+            return sorted(((d, k) for k, d in self._slowest.items()),
+                          reverse=True)[:self.top_k]
+
+    def failed(self):
+        '''Return the `(failures, key)` of the files that failed to load'''
+        with self._lock:
+            return sorted(((n, k) for k, n in self._failed.items()),
+                          reverse=True)
+
+    def report(self):
+        '''Return the latency histogram and the slowest files as text
+
+        The slowest files that failed to load are marked with `failed`.
+        '''
+        with self._lock:
+            hist = Histogram()
+            hist.merge(self.histogram)
+        lines = ['{} files, mean {:.3f} ms, p50 {:.3f} ms, p90 {:.3f} ms, '
+                 'p99 {:.3f} ms, max {:.3f} ms'.format(
+                     hist.count, 1e3 * hist.mean, 1e3 * hist.percentile(50),
+                     1e3 * hist.percentile(90), 1e3 * hist.percentile(99),
+                     1e3 * hist.max),
+                 '', 'Load time histogram [ms]:']
+        for lower, upper, count in hist.bins():
+            lines.append('  {:>10.3f} - {:>10.3f} {:>8}'.format(
+                1e3 * lower, 1e3 * upper, count))
+        failed = dict((k, n) for n, k in self.failed())
+        lines.extend(['', 'Slowest files [ms]:'])
+        for duration, key in self.slowest():
+            lines.append('  {:>10.3f} {}{}'.format(
+                1e3 * duration, ' '.join(str(el) for el in key),
+                ' (failed)' if key in failed else ''))
+        if failed:
+            lines.extend(['', 'Files that failed to load:'])
+            for n, key in self.failed():
+                lines.append('  {:>10} {}'.format(
+                    n, ' '.join(str(el) for el in key)))
+        return '\n'.join(lines)
+
+
+class _MultiTimer(object):
+    '''Enter several context managers, and exit them in reverse order'''
+    def __init__(self, timers):
+        self.timers = timers
+
+    def __enter__(self):
+        for timer in self.timers:
+            timer.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        for timer in reversed(self.timers):
+            timer.__exit__(*exc_info)
+        return False
+
+
+def chain_timers(timers):
+    '''Return a timer that runs all the `timers` on the same stage'''
+    timers = list(timers)
+    if not timers:
+        return null_timer
+    if len(timers) == 1:
+        return timers[0]
+    return lambda stage: _MultiTimer([timer(stage) for timer in timers])
+
+
+class Tracer(object):
+    '''Record the timeline of the pipeline as Chrome trace events
+
+    Each timed block becomes a complete ('X') event on the thread that
+    ran it, with the arguments of the enclosing :meth:`span` (e.g., the
+    epoch and the batch index). The trace can be saved with
+    :meth:`save` and opened in chrome://tracing or Perfetto.
+
+    Parameters
+    ----------
+    max_events: int
+        The maximum number of events kept. When reached, the oldest
+        events are dropped. Default: 1000000.
+    '''
+    def __init__(self, max_events=1000000):
+        self.events = deque(maxlen=max_events)
+        self.pid = os.getpid()
+        self._origin = time()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._threads = {}
+
+    def _args(self):
+        args = getattr(self._local, 'args', None)
+        if args is None:
+            args = self._local.args = {}
+            thread = threading.current_thread()
+            with self._lock:
+                self._threads[thread.ident] = thread.name
+        return args
+
+    def _event(self, name, ph, ts, **fields):
+        event = {'name': name, 'ph': ph, 'pid': self.pid,
+                 'tid': threading.current_thread().ident,
+                 'ts': 1e6 * (ts - self._origin)}
+        event.update(fields)
+        self.events.append(event)
+
+    @contextmanager
+    def span(self, name, **args):
+        '''Record a `with` block, tagging the nested events with `args`'''
+        outer = self._args()
+        self._local.args = dict(outer, **args)
+        start = time()
+        try:
+            yield
+        finally:
+            self._event(name, 'X', start, dur=1e6 * (time() - start),
+                        args=self._local.args)
+            self._local.args = outer
+
+    def timer(self, stage):
+        '''Record a `with` block as a stage, see :class:`Profiler`'''
+        return self.span(stage)
+
+    def instant(self, name, **args):
+        '''Record an instantaneous event'''
+        self._event(name, 'i', time(), s='t', args=dict(self._args(), **args))
+
+    def save(self, path):
+        '''Write the trace to `path` in the Chrome trace event format'''
+        with self._lock:
+            threads = dict(self._threads)
+        events = list(self.events)
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                       'tid': tid, 'args': {'name': name}}
+                      for tid, name in threads.items())
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
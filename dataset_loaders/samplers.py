@@ -0,0 +1,246 @@
+import numpy as np
+
+
+class AliasTable(object):
+    '''Draw indices from a discrete distribution in O(1) per draw
+
+    Implements Vose's version of Walker's alias method [Alias1]_: the
+    table is built once in O(n) and each draw costs a uniform integer
+    and a uniform float, regardless of the number of elements.
+
+    Parameters
+    ----------
+    weights: array of floats
+        The (unnormalized) non-negative weight of each element.
+
+    References
+    ----------
+    .. [Alias1] http://www.keithschwarz.com/darts-dice-coins/
+    '''
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype='float64')
+        if weights.ndim != 1 or len(weights) == 0:
+            raise ValueError('The weights should be a non-empty 1D array')
+        if (weights < 0).any() or not weights.sum() > 0:
+            raise ValueError('The weights should be non-negative and not '
+                             'all zero')
+        n = len(weights)
+        prob = weights * n / weights.sum()
+        alias = np.arange(n)
+        small = list(np.where(prob < 1)[0])
+        large = list(np.where(prob >= 1)[0])
+        while small and large:
+            s, l = small.pop(), large.pop()
+            alias[s] = l
+            prob[l] -= 1 - prob[s]
+            (small if prob[l] < 1 else large).append(l)
+        # Whatever is left is 1 up to numerical errors
+        prob[small + large] = 1
+        self.prob = prob
+        self.alias = alias
+
+    def __len__(self):
+        return len(self.prob)
+
+    def draw(self, size, rng):
+        '''Draw `size` indices with replacement using `rng`'''
+        idx = rng.randint(len(self.prob), size=size)
+        keep = rng.random_sample(size) < self.prob[idx]
+        return np.where(keep, idx, self.alias[idx])
+
+
+class SumTree(object):
+    '''Draw indices proportionally to priorities that change over time
+
+    A binary tree whose leaves are the priorities and whose internal
+    nodes are the sum of their children. Updating a priority and
+    drawing an index both cost O(log n).
+
+    Parameters
+    ----------
+    priorities: array of floats
+        The initial (unnormalized) non-negative priority of each element.
+    '''
+    def __init__(self, priorities):
+        priorities = np.asarray(priorities, dtype='float64')
+        if priorities.ndim != 1 or len(priorities) == 0:
+            raise ValueError('The priorities should be a non-empty 1D array')
+        self.n = len(priorities)
+        self.capacity = 1
+        while self.capacity < self.n:
+            self.capacity *= 2
+        # tree[1] is the root, the leaves start at tree[capacity]
+        self.tree = np.zeros(2 * self.capacity)
+        self.tree[self.capacity:self.capacity + self.n] = priorities
+        for level_start in self._levels():
+            idx = np.arange(level_start, 2 * level_start)
+            self.tree[idx] = self.tree[2 * idx] + self.tree[2 * idx + 1]
+
+    def _levels(self):
+        '''The index of the first node of each internal level, bottom up'''
+        level_start = self.capacity // 2
+        while level_start >= 1:
+            yield level_start
+            level_start //= 2
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def update(self, idx, priorities):
+        '''Set the priority of the elements `idx` to `priorities`'''
+        idx = np.asarray(idx, dtype='int64') + self.capacity
+        if (np.asarray(priorities) < 0).any():
+            raise ValueError('The priorities should be non-negative')
+        self.tree[idx] = priorities
+        # Update the sums, one level at a time
+        for _ in self._levels():
+            idx = np.unique(idx // 2)
+            self.tree[idx] = self.tree[2 * idx] + self.tree[2 * idx + 1]
+
+    def draw(self, size, rng):
+        '''Draw `size` indices with replacement using `rng`'''
+        if not self.total > 0:
+            raise ValueError('Cannot draw when all the priorities are zero')
+        mass = rng.random_sample(size) * self.total
+        idx = np.ones(size, dtype='int64')
+        # Descend the tree, going right when the mass exceeds the left sum
+        for _ in self._levels():
+            left = self.tree[2 * idx]
+            go_right = mass >= left
+            mass -= left * go_right
+            idx = 2 * idx + go_right
+        # Guard against numerical errors that lead to an empty leaf
+        return np.minimum(idx - self.capacity, self.n - 1)
+
+
+class Sampler(object):
+    '''Base class of the samplers
+
+    A sampler replaces the uniform shuffle of the sequences at each
+    epoch with a draw with replacement of the same number of sequences,
+    each with probability proportional to its weight. Subclasses should
+    implement `weights`.
+
+    If `lazy` is True the sequences of each batch are drawn only when
+    the batch is queued to be loaded, rather than when the epoch is
+    planned, so that changes of the weights take effect quickly.
+    '''
+    lazy = False
+
+    def weights(self, dataset):
+        '''Return the weight of each sequence of `dataset`'''
+        raise NotImplementedError
+
+
+class WeightedSampler(Sampler):
+    '''Sample the sequences according to user-defined weights
+
+    Parameters
+    ----------
+    weights: array of floats
+        One non-negative weight per sequence, in the order of the
+        sequences of the dataset (see `names_sequences`).
+    '''
+    def __init__(self, weights):
+        self._weights = np.asarray(weights, dtype='float64')
+
+    def weights(self, dataset):
+        if len(self._weights) != len(dataset._seq_start):
+            raise ValueError('Expected {} weights, one per sequence, got '
+                             '{}'.format(len(dataset._seq_start),
+                                         len(self._weights)))
+        return self._weights
+
+
+class ClassBalancedSampler(Sampler):
+    '''Sample the sequences so that each class is equally represented
+
+    A class is picked uniformly among the non-void classes present in
+    the dataset, then a sequence is picked with probability proportional
+    to the number of pixels of that class it contains.
+    '''
+    def weights(self, dataset):
+        hist = _non_void_histograms(dataset)
+        class_px = hist.sum(axis=0)
+        present = class_px > 0
+        return (hist[:, present] / class_px[present]).sum(axis=1)
+
+
+class InverseFrequencySampler(Sampler):
+    '''Sample the sequences according to the rarity of their classes
+
+    The weight of each sequence is the average over its non-void pixels
+    of the inverse of the frequency of their class in the dataset.
+    '''
+    def weights(self, dataset):
+        hist = _non_void_histograms(dataset)
+        class_px = hist.sum(axis=0)
+        present = class_px > 0
+        inv_freq = np.zeros(len(class_px))
+        inv_freq[present] = class_px.sum() / class_px[present]
+        seq_px = np.maximum(hist.sum(axis=1), 1)
+        return hist.dot(inv_freq) / seq_px
+
+
+class PrioritizedSampler(Sampler):
+    '''Sample the sequences proportionally to a feedback priority
+
+    The priorities are updated with
+    :meth:`~parallel_loader.ThreadedDataset.update_priorities`, e.g.,
+    with the loss of each sequence, to draw the hard examples more
+    often. The priority of a sequence is `(abs(loss) + eps) ** alpha`.
+    All the sequences start with the same priority.
+
+    Parameters
+    ----------
+    alpha: float
+        How much the priorities matter. 0 corresponds to uniform
+        sampling. Default: 0.6.
+    eps: float
+        A small constant that prevents the priorities from being zero.
+        Default: 1e-6.
+    '''
+    lazy = True
+
+    def __init__(self, alpha=0.6, eps=1e-6):
+        self.alpha = alpha
+        self.eps = eps
+
+    def weights(self, dataset):
+        return np.ones(len(dataset._seq_start))
+
+    def priorities(self, losses):
+        '''Convert the losses into priorities'''
+        return (np.abs(np.asarray(losses, dtype='float64')) +
+                self.eps) ** self.alpha
+
+
+def _non_void_histograms(dataset):
+    hist = dataset.class_histograms().astype('float64')
+    return hist[:, :dataset.non_void_nclasses]
+
+
+_samplers = {'class_balanced': ClassBalancedSampler,
+             'inverse_frequency': InverseFrequencySampler,
+             'prioritized': PrioritizedSampler}
+
+
+def get_sampler(sampler):
+    '''Return a :class:`Sampler` instance out of its specification
+
+    `sampler` can be None, a :class:`Sampler` instance, one of
+    `'class_balanced'`, `'inverse_frequency'` and `'prioritized'` or an
+    array of per-sequence weights.
+    '''
+    if sampler is None or isinstance(sampler, Sampler):
+        return sampler
+    if isinstance(sampler, basestring):
+        if sampler not in _samplers:
+            raise ValueError('Unknown sampler {}. Valid values are: '
+                             '{}'.format(sampler, _samplers.keys()))
+        return _samplers[sampler]()
+    return WeightedSampler(sampler)
@@ -0,0 +1,87 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dataset_loaders.parallel_loader import ThreadedDataset
+
+
+# The size of each image: some tall and some wide
+SIZES = {'a': (8, 4), 'b': (10, 5), 'c': (9, 4), 'd': (4, 8), 'e': (5, 10),
+         'f': (9, 6), 'g': (4, 7), 'h': (5, 9)}
+
+
+class TestDataset(ThreadedDataset):
+    # No data_shape: the size of the images varies
+    name = 'test_buckets'
+    non_void_nclasses = 4
+    _void_labels = [4]
+    path = shared_path = tempfile.mkdtemp()
+
+    def get_names(self):
+        return {'default': sorted(SIZES)}
+
+    def load_sequence(self, sequence):
+        name = sequence[0][1]
+        rng = np.random.RandomState(ord(name))
+        shape = (len(sequence),) + SIZES[name]
+        return {'data': 1 + rng.random_sample(shape + (3,)).astype('float32'),
+                'labels': rng.randint(0, 4, shape),
+                'subset': sequence[0][0],
+                'filenames': np.array([n for _, n in sequence])}
+
+
+class TestBuckets(unittest.TestCase):
+    def testPadding(self):
+        dd = TestDataset(batch_size=2, nbuckets=2, return_01c=True,
+                         infinite_iterator=False)
+        self.assertTrue(0 < dd.padding_waste < 1)
+        nframes = 0
+        while True:
+            try:
+                batch = dd.next()
+            except StopIteration:
+                break
+            data, labels, mask = batch['data'], batch['labels'], batch['mask']
+            self.assertEqual(mask.dtype, np.bool)
+            self.assertEqual(mask.shape, data.shape[:3])
+            self.assertEqual(labels.shape, data.shape[:3])
+            # The images of a batch have the same aspect ratio
+            ratios = [SIZES[name][0] > SIZES[name][1]
+                      for name in batch['filenames'].ravel()]
+            self.assertEqual(len(set(ratios)), 1)
+            for i, name in enumerate(batch['filenames'].ravel()):
+                rows, cols = SIZES[name]
+                loaded = dd.load_sequence([('default', name)])
+                # The image is in the top-left corner, marked by the mask
+                self.assertEqual(mask[i].sum(), rows * cols)
+                self.assertTrue(mask[i, :rows, :cols].all())
+                np.testing.assert_array_equal(data[i, :rows, :cols],
+                                              loaded['data'][0])
+                np.testing.assert_array_equal(labels[i, :rows, :cols],
+                                              loaded['labels'][0])
+                # The padding is 0 in the data and void in the labels
+                self.assertTrue((data[i][~mask[i]] == 0).all())
+                self.assertTrue((labels[i][~mask[i]] == 4).all())
+                nframes += 1
+        self.assertEqual(nframes, len(SIZES))
+
+    def testNoMask(self):
+        dd = TestDataset(batch_size=2, nbuckets=2, fields=['filenames'])
+        self.assertNotIn('mask', dd.next())
+
+    def testInvalid(self):
+        with self.assertRaises(ValueError):
+            TestDataset(batch_size=2)
+        with self.assertRaises(ValueError):
+            TestDataset(batch_size=2, nbuckets=2,
+                        data_augm_kwargs={'crop_size': (4, 4)})
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
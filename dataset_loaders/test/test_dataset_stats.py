@@ -0,0 +1,52 @@
+import unittest
+
+import numpy as np
+
+from dataset_loaders.dataset_stats import Moments
+
+
+class TestMoments(unittest.TestCase):
+    def _chunks(self, shape):
+        rng = np.random.RandomState(0)
+        # Chunks of different sizes, with a large offset to stress the
+        # numerical stability, and an empty one
+        return [1e4 + rng.random_sample((n,) + shape).astype('float32')
+                for n in (1, 7, 0, 30, 12)]
+
+    def _check(self, merged, data, axis):
+        np.testing.assert_allclose(merged.mean, data.mean(axis=axis,
+                                                          dtype='float64'))
+        np.testing.assert_allclose(merged.variance,
+                                   data.astype('float64').var(axis=axis))
+        self.assertEqual(merged.n, data.size if axis is None else
+                         data.shape[axis])
+
+    def testMergeAll(self):
+        chunks = self._chunks((4, 3))
+        merged = Moments()
+        for chunk in chunks:
+            moments = Moments()
+            moments.update(chunk)
+            merged.merge(moments)
+        self._check(merged, np.concatenate(chunks), None)
+
+    def testMergeAxis(self):
+        chunks = self._chunks((3,))
+        merged = Moments((3,))
+        for chunk in chunks:
+            moments = Moments((3,))
+            moments.update(chunk, axis=0)
+            merged.merge(moments)
+        self._check(merged, np.concatenate(chunks), 0)
+
+    def testUpdate(self):
+        # Updating with each chunk is the same as merging them
+        chunks = self._chunks((3,))
+        moments = Moments((3,))
+        for chunk in chunks:
+            moments.update(chunk, axis=0)
+        self._check(moments, np.concatenate(chunks), 0)
+
+
+if __name__ == '__main__':
+        unittest.main()
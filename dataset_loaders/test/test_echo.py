@@ -0,0 +1,85 @@
+from collections import Counter
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dataset_loaders.parallel_loader import ThreadedDataset
+
+
+class TestDataset(ThreadedDataset):
+    name = 'test_echo'
+    non_void_nclasses = 4
+    _void_labels = []
+    data_shape = (6, 8, 3)
+    path = shared_path = tempfile.mkdtemp()
+
+    def get_names(self):
+        return dict(('p%d' % p, ['p%d_%02d' % (p, i) for i in range(7)])
+                    for p in range(2))
+
+    def load_sequence(self, sequence):
+        shape = (len(sequence),) + TestDataset.data_shape
+        rng = np.random.RandomState(int(sequence[0][1][1]) * 100 +
+                                    int(sequence[0][1][3:]))
+        return {'data': rng.random_sample(shape).astype('float32'),
+                'labels': rng.randint(0, 4, shape[:3]),
+                'subset': sequence[0][0],
+                'filenames': np.array([name for _, name in sequence])}
+
+
+def _epoch(dd):
+    batches = []
+    while True:
+        try:
+            batches.append(dd.next())
+        except StopIteration:
+            return batches
+
+
+class TestEcho(unittest.TestCase):
+    def _new_dataset(self, **kwargs):
+        return TestDataset(batch_size=4, echo_factor=3,
+                           infinite_iterator=False,
+                           rng=np.random.RandomState(1),
+                           data_augm_kwargs={'rotation_range': 20}, **kwargs)
+
+    def testEpoch(self):
+        for use_threads in (False, True):
+            dd = self._new_dataset(use_threads=use_threads)
+            for _ in range(2):
+                # Each sequence is returned echo_factor times per epoch
+                batches = _epoch(dd)
+                files = Counter(sum([b['filenames'].ravel().tolist()
+                                     for b in batches], []))
+                self.assertEqual(len(files), 14)
+                self.assertEqual(set(files.values()), set([3]))
+                self.assertTrue(all(len(b['data']) <= 4 for b in batches))
+            stats = dd.echo_stats()
+            self.assertEqual(stats['samples'], 2 * 14 * 3)
+            self.assertEqual(stats['batches'], 2 * len(batches))
+            self.assertLessEqual(stats['mean_spread'], 3)
+            if use_threads:
+                dd.finish()
+
+    def testEchoes(self):
+        # The echoes are augmented independently, and reproducibly
+        first = _epoch(self._new_dataset())
+        second = _epoch(self._new_dataset())
+        echoes = {}
+        for b1, b2 in zip(first, second):
+            np.testing.assert_array_equal(b1['data'], b2['data'])
+            for name, x in zip(b1['filenames'].ravel(), b1['data']):
+                echoes.setdefault(name, []).append(x)
+        for x in echoes.values():
+            self.assertFalse(np.array_equal(x[0], x[1]))
+            self.assertFalse(np.array_equal(x[1], x[2]))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
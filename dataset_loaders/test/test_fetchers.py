@@ -0,0 +1,138 @@
+import shutil
+import tempfile
+from threading import Event, Lock
+from time import sleep
+import unittest
+
+import numpy as np
+
+from dataset_loaders.parallel_loader import ThreadedDataset
+
+
+class TestDataset(ThreadedDataset):
+    name = 'test_fetchers'
+    non_void_nclasses = 2
+    _void_labels = []
+    data_shape = (2, 2, 1)
+    path = shared_path = tempfile.mkdtemp()
+    # Do not wait seconds to restart the fetchers that died
+    _restart_backoff = 0.01
+
+    def __init__(self, hang=None, slow=None, crash=None, *args, **kwargs):
+        # The name of the file that hangs until `release` is set, of the
+        # file that is slow the first time it is loaded after a few
+        # other ones, and of the file whose fetcher dies
+        self.hang, self.slow, self.crash = hang, slow, crash
+        self.release = Event()
+        self.lock = Lock()
+        self.nloaded = 0
+        self.slowed = False
+        self.crashes = 0
+        super(TestDataset, self).__init__(*args, **kwargs)
+
+    def get_names(self):
+        return dict(('p%d' % p, ['p%d_%02d' % (p, i) for i in range(7)])
+                    for p in range(3))
+
+    def load_sequence(self, sequence):
+        name = sequence[0][1]
+        if name == self.hang:
+            self.release.wait()
+        with self.lock:
+            self.nloaded += 1
+            slow = (name == self.slow and not self.slowed and
+                    self.nloaded > 15)
+            self.slowed |= slow
+        sleep(1. if slow else 0.005)
+        shape = (len(sequence),) + TestDataset.data_shape
+        return {'data': np.zeros(shape, 'float32'),
+                'labels': np.zeros(shape[:3], 'int32'),
+                'subset': sequence[0][0],
+                'filenames': np.array([name for _, name in sequence])}
+
+    def _fetch_names_batch(self, item):
+        if any(name == self.crash for seq in item[2] if seq is not None
+               for _, name in seq):
+            self.crashes += 1
+            # Kill the fetcher thread
+            raise SystemExit
+        super(TestDataset, self)._fetch_names_batch(item)
+
+
+def _epoch(dd):
+    '''Return the filenames and the number of errors of one epoch'''
+    files, errors = [], []
+    while True:
+        try:
+            files.extend(dd.next()['filenames'].ravel().tolist())
+        except StopIteration:
+            return files, errors
+        except (IOError, RuntimeError) as e:
+            errors.append(e)
+
+
+class TestFetchers(unittest.TestCase):
+    def setUp(self):
+        self.datasets = []
+
+    def _new_dataset(self, **kwargs):
+        dd = TestDataset(batch_size=1, use_threads=True,
+                         infinite_iterator=False, **kwargs)
+        self.datasets.append(dd)
+        return dd
+
+    def testTimeout(self):
+        # The only fetcher hangs: it is replaced and the batch is
+        # returned as an IOError
+        dd = self._new_dataset(hang='p1_03', nthreads=1, fetch_timeout=0.5,
+                               raise_IOErrors=True,
+                               shuffle_at_each_epoch=False)
+        files, errors = _epoch(dd)
+        self.assertEqual(len(files), 20)
+        self.assertNotIn('p1_03', files)
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], IOError)
+        self.assertEqual(dd.stats()['timed_out_fetches'], 1)
+        self.assertEqual(dd.stats()['hung_fetchers'], 1)
+        # The replacement keeps loading the next epochs
+        dd.release.set()
+        files, errors = _epoch(dd)
+        self.assertEqual((len(files), errors), (21, []))
+
+    def testHedging(self):
+        # The hedged batch is returned once, by the fastest copy
+        dd = self._new_dataset(slow='p2_05', nthreads=2, hedge_factor=2)
+        for _ in range(2):
+            files, errors = _epoch(dd)
+            self.assertEqual(sorted(files), sorted(
+                sum(dd.get_names().values(), [])))
+            self.assertEqual(errors, [])
+        self.assertTrue(dd.slowed)
+        self.assertGreaterEqual(dd.stats()['hedged_fetches'], 1)
+
+    def testRestart(self):
+        # The batch of a dead fetcher is retried `fetch_retries` times,
+        # then the error is returned
+        dd = self._new_dataset(crash='p0_02', nthreads=2, fetch_retries=2)
+        files, errors = _epoch(dd)
+        self.assertEqual(len(files), 20)
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], RuntimeError)
+        self.assertEqual(dd.crashes, 3)
+        self.assertEqual(dd.stats()['worker_deaths'], 3)
+        # The fetchers are restarted
+        self.assertTrue(all(df() is not None and df().isAlive()
+                            for df in dd.data_fetchers))
+
+    def tearDown(self):
+        for dd in self.datasets:
+            dd.release.set()
+            dd.finish()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,82 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dataset_loaders.parallel_loader import ThreadedDataset
+
+
+class TestDataset(ThreadedDataset):
+    name = 'test_fields'
+    non_void_nclasses = 4
+    _void_labels = [4]
+    data_shape = (6, 8, 3)
+    path = shared_path = tempfile.mkdtemp()
+
+    def get_names(self):
+        return dict(('p%d' % p, ['p%d_%03d' % (p, i) for i in range(7)])
+                    for p in range(2))
+
+    def load_sequence(self, sequence):
+        X, Y = [], []
+        shape = TestDataset.data_shape
+        for prefix, name in sequence:
+            rng = np.random.RandomState(int(name[1]) * 100 + int(name[3:]))
+            X.append(rng.random_sample(shape).astype('float32'))
+            Y.append(rng.randint(0, 5, shape[:2]))
+        return {'data': np.array(X), 'labels': np.array(Y),
+                'subset': prefix,
+                'filenames': np.array([name for _, name in sequence])}
+
+
+def _batches(nbatches=3, **kwargs):
+    dd = TestDataset(batch_size=2, shuffle_at_each_epoch=False,
+                     rng=np.random.RandomState(1), **kwargs)
+    return [dd.next() for _ in range(nbatches)]
+
+
+class TestFields(unittest.TestCase):
+    def testFields(self):
+        batch = _batches(1)[0]
+        self.assertEqual(set(batch.keys()),
+                         set(['data', 'labels', 'raw_data', 'filenames',
+                              'subset']))
+        for fields in (['data'], ['labels'], ['filenames']):
+            batch = _batches(1, fields=fields)[0]
+            self.assertEqual(set(batch.keys()),
+                             set(['data', 'labels'] + fields))
+
+    def testSameOutputs(self):
+        # Dropping the other fields does not change data and labels
+        for full, data_only in zip(_batches(), _batches(fields=['data'])):
+            for k in ('data', 'labels'):
+                np.testing.assert_array_equal(full[k], data_only[k])
+
+
+class TestMiddleFrame(unittest.TestCase):
+    def testMiddleFrame(self):
+        # The middle frame of the labels is selected before the data
+        # augmentation: the result is the same as augmenting the whole
+        # sequence of labels and selecting the frame afterwards
+        augm = {'rotation_range': 25, 'horizontal_flip': 0.5,
+                'shear_range': 0.3, 'zoom_range': 0.2}
+        for seq_length in (3, 4):
+            kwargs = dict(seq_length=seq_length, seq_per_subset=0,
+                          data_augm_kwargs=augm)
+            middle = _batches(return_middle_frame_only=True, **kwargs)
+            full = _batches(**kwargs)
+            for mid, seq in zip(middle, full):
+                np.testing.assert_array_equal(mid['data'], seq['data'])
+                self.assertEqual(mid['labels'].ndim,
+                                 seq['labels'].ndim - 1)
+                np.testing.assert_array_equal(
+                    mid['labels'], seq['labels'][:, seq_length // 2])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
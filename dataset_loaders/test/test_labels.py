@@ -0,0 +1,114 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dataset_loaders.parallel_loader import ThreadedDataset
+
+
+class TestDataset(ThreadedDataset):
+    name = 'test_labels'
+    non_void_nclasses = 4
+    _void_labels = [2]
+    data_shape = (3, 4, 1)
+    path = shared_path = tempfile.mkdtemp()
+
+    def get_names(self):
+        return {'default': ['a', 'b']}
+
+    def load_sequence(self, sequence):
+        shape = (len(sequence),) + TestDataset.data_shape
+        return {'data': np.zeros(shape, 'float32'),
+                'labels': np.zeros(shape[:3], 'int32'),
+                'subset': sequence[0][0],
+                'filenames': np.array([name for _, name in sequence])}
+
+
+class GTClassesDataset(TestDataset):
+    # The classes are not contiguous and there are no void labels
+    non_void_nclasses = 3
+    _void_labels = []
+    GTclasses = [0, 5, 7]
+
+
+class NegativeVoidDataset(TestDataset):
+    # As in cityscapes, the void label is negative
+    non_void_nclasses = 3
+    _void_labels = [-1]
+    GTclasses = [-1, 0, 1, 2]
+
+
+def _labels(nc, seed=0):
+    return np.random.RandomState(seed).randint(0, nc, (2, 3, 4))
+
+
+class TestOneHot(unittest.TestCase):
+    def testLayouts(self):
+        for return_01c in (False, True):
+            for one_hot_dtype in ('int32', 'uint8', 'bool', 'float16'):
+                dd = TestDataset(batch_size=1, return_01c=return_01c,
+                                 one_hot_dtype=one_hot_dtype)
+                nc = dd.nclasses
+                y = _labels(nc)
+                expected = np.eye(nc)[y]
+                if not return_01c:
+                    expected = np.moveaxis(expected, -1, 1)
+                y_hot = dd._one_hot(y)
+                self.assertEqual(y_hot.dtype, np.dtype(one_hot_dtype))
+                np.testing.assert_array_equal(y_hot, expected)
+
+    def testBits(self):
+        for return_01c in (False, True):
+            dd = TestDataset(batch_size=1, return_01c=return_01c,
+                             one_hot_dtype='bits')
+            nc = dd.nclasses
+            y = _labels(nc)
+            axis = -1 if return_01c else 1
+            y_hot = np.unpackbits(dd._one_hot(y), axis=axis)
+            y_hot = np.moveaxis(y_hot, axis, -1)[..., :nc]
+            np.testing.assert_array_equal(y_hot, np.eye(nc)[y])
+
+    def testOutOfRange(self):
+        dd = TestDataset(batch_size=1)
+        for y in ([[[-1]]], [[[dd.nclasses]]]):
+            with self.assertRaises(IndexError):
+                dd._one_hot(np.array(y))
+
+
+class TestRemapLabels(unittest.TestCase):
+    def _check(self, dd, y, expected, dtype):
+        out = dd._remap_labels(np.array(y, 'int32'))
+        np.testing.assert_array_equal(out, expected)
+        self.assertEqual(out.dtype, np.dtype(dtype))
+
+    def testVoid(self):
+        dd = TestDataset(batch_size=1)
+        self.assertEqual(dd.label_dtype, np.uint8)
+        # The void label is mapped to non_void_nclasses, the following
+        # ones are shifted
+        self._check(dd, [0, 1, 2, 3, 4], [0, 1, 4, 2, 3], 'uint8')
+
+    def testOutOfRange(self):
+        dd = TestDataset(batch_size=1)
+        # The labels out of the mapping are left unchanged
+        self._check(dd, [1, 2, 200], [1, 4, 200], 'uint8')
+        self._check(dd, [1, 2, 300], [1, 4, 300], 'int64')
+        self._check(dd, [-3, 2], [-3, 4], 'int64')
+
+    def testGTClasses(self):
+        dd = GTClassesDataset(batch_size=1)
+        self._check(dd, [7, 0, 5, 3], [2, 0, 1, 3], 'uint8')
+
+    def testNegative(self):
+        dd = NegativeVoidDataset(batch_size=1)
+        self._check(dd, [-1, 0, 2, 1], [3, 0, 2, 1], 'uint8')
+        self._check(dd, [-2, -1, 1], [-2, 3, 1], 'int64')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,98 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dataset_loaders.mixed_dataset import MixedDataset
+from dataset_loaders.parallel_loader import ThreadedDataset
+
+
+class FirstDataset(ThreadedDataset):
+    name = 'test_mixed_first'
+    non_void_nclasses = 3
+    _void_labels = [3]
+    data_shape = (4, 6, 3)
+    path = shared_path = tempfile.mkdtemp()
+
+    def get_names(self):
+        return {'default': ['%s_%02d' % (self.name, i) for i in range(6)]}
+
+    def load_sequence(self, sequence):
+        shape = (len(sequence),) + self.__class__.data_shape
+        label = self.non_void_nclasses + len(self._void_labels) - 1
+        return {'data': np.zeros(shape, 'float32'),
+                # The last label, i.e. the void one if any
+                'labels': np.full(shape[:3], label, 'int32'),
+                'subset': sequence[0][0],
+                'filenames': np.array([name for _, name in sequence])}
+
+
+class SecondDataset(FirstDataset):
+    name = 'test_mixed_second'
+    non_void_nclasses = 5
+    _void_labels = []
+
+
+class TestMixedDataset(unittest.TestCase):
+    def _mixed(self, **kwargs):
+        datasets = [FirstDataset(batch_size=1), SecondDataset(batch_size=1)]
+        # The void label of the first dataset is 255 in the shared space
+        return MixedDataset(datasets, label_maps=[{3: 255}, None],
+                            batch_size=4, rng=np.random.RandomState(0),
+                            **kwargs)
+
+    def testKeysAndDtypes(self):
+        for mixed_batches in (False, True):
+            for use_threads in (False, True):
+                mixed = self._mixed(mixed_batches=mixed_batches,
+                                    use_threads=use_threads)
+                sources = set()
+                for _ in range(10):
+                    batch = mixed.next()
+                    self.assertEqual(set(batch.keys()),
+                                     set(['data', 'labels', 'raw_data',
+                                          'filenames', 'subset', 'source']))
+                    self.assertEqual(batch['data'].dtype, np.float32)
+                    self.assertEqual(batch['labels'].dtype, np.uint8)
+                    self.assertEqual(batch['data'].shape, (4, 3, 4, 6))
+                    # The labels are in the shared label space
+                    expected = np.where(batch['source'] == 0, 255, 4)
+                    np.testing.assert_array_equal(
+                        batch['labels'][:, 0, 0], expected)
+                    if not mixed_batches:
+                        self.assertEqual(len(set(batch['source'])), 1)
+                    sources.update(batch['source'].tolist())
+                self.assertEqual(sources, set([0, 1]))
+                mixed.finish()
+
+    def testLabelDtype(self):
+        # The labels of all the datasets fit the shared dtype
+        datasets = [FirstDataset(batch_size=1), SecondDataset(batch_size=1)]
+        mixed = MixedDataset(datasets, label_maps=[{3: -1}, None],
+                             batch_size=2, use_threads=False)
+        self.assertEqual(mixed.label_dtype, np.int16)
+        self.assertEqual(mixed.next()['labels'].dtype, np.int16)
+
+    def testReturnList(self):
+        mixed = self._mixed(return_list=True, use_threads=False)
+        data, labels = mixed.next()
+        self.assertEqual((len(data), len(labels)), (4, 4))
+
+    def testInvalid(self):
+        datasets = [FirstDataset(batch_size=1), SecondDataset(batch_size=1)]
+        with self.assertRaises(ValueError):
+            MixedDataset([])
+        with self.assertRaises(ValueError):
+            MixedDataset(datasets, weights=[1.])
+        with self.assertRaises(ValueError):
+            MixedDataset(datasets + [FirstDataset(batch_size=1,
+                                                  use_threads=True)])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(FirstDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
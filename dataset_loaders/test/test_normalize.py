@@ -0,0 +1,107 @@
+import itertools
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dataset_loaders.parallel_loader import ThreadedDataset
+
+
+class TestDataset(ThreadedDataset):
+    name = 'test_normalize'
+    non_void_nclasses = 4
+    _void_labels = []
+    data_shape = (6, 8, 3)
+    mean = [0.4, 0.5, 0.6]
+    std = [0.2, 0.25, 0.3]
+    path = shared_path = tempfile.mkdtemp()
+
+    def __init__(self, dtype='float32', *args, **kwargs):
+        self.dtype = dtype
+        super(TestDataset, self).__init__(*args, **kwargs)
+
+    def get_names(self):
+        return {'p0': ['p0_%02d' % i for i in range(4)]}
+
+    def load_sequence(self, sequence):
+        rng = np.random.RandomState(int(sequence[0][1][3:]))
+        x = rng.randint(0, 256, (len(sequence),) + TestDataset.data_shape)
+        if self.dtype == 'float32':
+            x = x / np.float32(255)
+        return {'data': x.astype(self.dtype),
+                'labels': rng.randint(0, 4, x.shape[:3]).astype('int32'),
+                'subset': sequence[0][0],
+                'filenames': np.array([name for _, name in sequence])}
+
+
+class AutoStatsDataset(TestDataset):
+    # The statistics are computed by `dataset_stats`
+    mean = []
+    std = []
+
+
+def _four_passes(dd, seq_x):
+    '''The normalization as it was done before it was fused'''
+    seq_x = seq_x.astype('float32')
+    if dd.remove_per_img_mean:
+        seq_x -= seq_x.mean(axis=tuple(range(seq_x.ndim - 1)),
+                            keepdims=True)
+    if dd.divide_by_per_img_std:
+        seq_x /= seq_x.std(axis=tuple(range(seq_x.ndim - 1)),
+                           keepdims=True)
+    if dd.remove_mean:
+        seq_x -= getattr(dd, 'mean', 0)
+    if dd.divide_by_std:
+        seq_x /= getattr(dd, 'std', 1)
+    return seq_x
+
+
+class TestNormalize(unittest.TestCase):
+    flags = ('remove_per_img_mean', 'divide_by_per_img_std',
+             'remove_mean', 'divide_by_std')
+
+    def testFourPasses(self):
+        for values in itertools.product((False, True), repeat=4):
+            kwargs = dict(zip(self.flags, values))
+            for dtype in ('float32', 'uint8'):
+                dd = TestDataset(dtype, batch_size=1, **kwargs)
+                x = dd.load_sequence([('p0', 'p0_01'), ('p0', 'p0_02')])
+                out = dd._normalize(x['data'])
+                self.assertEqual(out.dtype, np.float32)
+                # The loaders used to return floats in [0, 1]
+                expected = _four_passes(dd, x['data'] / np.float32(
+                    255 if dtype == 'uint8' else 1))
+                np.testing.assert_allclose(out, expected, rtol=1e-4,
+                                           atol=1e-5)
+
+    def testUint8(self):
+        # The uint8 data is converted to [0, 1] without normalization
+        for return_0_255 in (False, True):
+            batch = {}
+            for dtype in ('float32', 'uint8'):
+                dd = TestDataset(dtype, batch_size=2,
+                                 return_0_255=return_0_255,
+                                 shuffle_at_each_epoch=False)
+                batch[dtype] = dd.next()['data']
+            self.assertEqual(batch['uint8'].dtype, batch['float32'].dtype)
+            np.testing.assert_allclose(batch['uint8'], batch['float32'],
+                                       atol=1e-5)
+
+    def testDatasetStats(self):
+        # The statistics computed on uint8 data are in the same units as
+        # the normalized data
+        for dtype in ('uint8', 'float32'):
+            dd = AutoStatsDataset(dtype, batch_size=4, return_01c=True,
+                                  remove_mean=True, divide_by_std=True)
+            x = dd.next()['data'].reshape((-1, 3))
+            np.testing.assert_allclose(x.mean(axis=0), 0, atol=1e-4)
+            np.testing.assert_allclose(x.std(axis=0), 1, atol=1e-4)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,75 @@
+import shutil
+import tempfile
+from time import sleep
+import unittest
+
+import numpy as np
+
+from dataset_loaders.parallel_loader import ThreadedDataset, _batch_nbytes
+
+
+class TestDataset(ThreadedDataset):
+    name = 'test_prefetch'
+    non_void_nclasses = 4
+    _void_labels = []
+    data_shape = (16, 16, 3)
+    path = shared_path = tempfile.mkdtemp()
+
+    def get_names(self):
+        return {'default': ['%02d' % i for i in range(20)]}
+
+    def load_sequence(self, sequence):
+        shape = (len(sequence),) + TestDataset.data_shape
+        return {'data': np.zeros(shape, 'float32'),
+                'labels': np.zeros(shape[:3], 'int32'),
+                'subset': sequence[0][0],
+                'filenames': np.array([name for _, name in sequence])}
+
+
+class TestPrefetch(unittest.TestCase):
+    def _new_dataset(self, **kwargs):
+        return TestDataset(batch_size=2, use_threads=True, nthreads=2,
+                           queues_size=8, infinite_iterator=False, **kwargs)
+
+    def testBudget(self):
+        dd = self._new_dataset()
+        nbytes = _batch_nbytes(dd.next())
+        sleep(1)
+        # Without a budget the fetchers fill the queue
+        self.assertGreater(dd.data_queue.qsize(), 2)
+        dd.finish()
+
+        budget = int(1.5 * nbytes)
+        dd = self._new_dataset(prefetch_bytes=budget)
+        sleep(1)
+        # Only one batch fits in the budget
+        self.assertEqual(dd.data_queue.qsize(), 1)
+        self.assertLessEqual(dd._prefetched_bytes, budget)
+        # All the batches are returned nonetheless
+        files = []
+        for _ in range(2):
+            while True:
+                try:
+                    files.extend(dd.next()['filenames'].ravel().tolist())
+                except StopIteration:
+                    break
+                self.assertLessEqual(dd._prefetched_bytes, budget)
+        self.assertEqual(sorted(files), sorted(2 * dd.get_names()['default']))
+        dd.finish()
+        self.assertEqual(dd._prefetched_bytes, 0)
+
+    def testLargeBatch(self):
+        # A batch larger than the budget is loaded when the queue is
+        # empty, rather than blocking forever
+        dd = self._new_dataset(prefetch_bytes=1)
+        batch = dd.next()
+        self.assertEqual(len(batch['data']), 2)
+        dd.finish()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
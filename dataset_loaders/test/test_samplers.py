@@ -0,0 +1,110 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dataset_loaders.parallel_loader import ThreadedDataset
+from dataset_loaders.samplers import (AliasTable, PrioritizedSampler,
+                                      SumTree, WeightedSampler, get_sampler)
+
+
+class TestDataset(ThreadedDataset):
+    name = 'test_samplers'
+    non_void_nclasses = 2
+    _void_labels = []
+    data_shape = (2, 2, 1)
+    path = shared_path = tempfile.mkdtemp()
+
+    def get_names(self):
+        # The same names in every subset, as the frames of the videos
+        return dict(('video%d' % v, ['%05d' % i for i in range(4)])
+                    for v in range(3))
+
+    def load_sequence(self, sequence):
+        shape = (len(sequence),) + tuple(self.data_shape)
+        return {'data': np.zeros(shape, 'float32'),
+                'labels': np.zeros(shape[:3], 'int32'),
+                'subset': sequence[0][0],
+                # The filenames differ from the names, e.g., in davis
+                'filenames': np.array([name + '.jpg'
+                                       for _, name in sequence])}
+
+
+class TestAliasTable(unittest.TestCase):
+    def testDistribution(self):
+        weights = np.array([1., 0., 3., 6.])
+        table = AliasTable(weights)
+        draws = table.draw(100000, np.random.RandomState(0))
+        freqs = np.bincount(draws, minlength=len(weights)) / 100000.
+        np.testing.assert_allclose(freqs, weights / weights.sum(),
+                                   atol=0.01)
+        self.assertEqual(freqs[1], 0)
+
+    def testInvalidWeights(self):
+        for weights in ([], [0, 0], [1, -1]):
+            with self.assertRaises(ValueError):
+                AliasTable(weights)
+
+
+class TestSumTree(unittest.TestCase):
+    def testUpdate(self):
+        tree = SumTree(np.ones(5))
+        self.assertEqual(tree.total, 5)
+        tree.update([0, 3], [4., 0.])
+        self.assertEqual(tree.total, 7)
+        tree.update([4], [2.])
+        self.assertEqual(tree.total, 8)
+        with self.assertRaises(ValueError):
+            tree.update([1], [-1.])
+
+    def testDraw(self):
+        priorities = np.array([1., 2., 0., 5., 2.])
+        tree = SumTree(np.ones(5))
+        tree.update(np.arange(5), priorities)
+        draws = tree.draw(100000, np.random.RandomState(0))
+        freqs = np.bincount(draws, minlength=len(priorities)) / 100000.
+        np.testing.assert_allclose(freqs, priorities / priorities.sum(),
+                                   atol=0.01)
+        tree.update(np.arange(5), np.zeros(5))
+        with self.assertRaises(ValueError):
+            tree.draw(1, np.random.RandomState(0))
+
+
+class TestGetSampler(unittest.TestCase):
+    def testGetSampler(self):
+        self.assertIsNone(get_sampler(None))
+        sampler = PrioritizedSampler(alpha=1.)
+        self.assertIs(get_sampler(sampler), sampler)
+        self.assertIsInstance(get_sampler('prioritized'),
+                              PrioritizedSampler)
+        self.assertIsInstance(get_sampler([1, 2, 3]), WeightedSampler)
+        with self.assertRaises(ValueError):
+            get_sampler('unknown')
+
+
+class TestPrioritized(unittest.TestCase):
+    def testUpdatePriorities(self):
+        dd = TestDataset(batch_size=4, sampler=PrioritizedSampler(alpha=1.))
+        batch = dd.next()
+        self.assertEqual(batch['seq_id'].shape, (4,))
+        # Only the sequences of the batch get the new priority
+        dd.update_priorities(batch['seq_id'], np.zeros(4))
+        seq_ids = set(batch['seq_id'].tolist())
+        self.assertAlmostEqual(dd._sum_tree.total,
+                               len(dd._seq_start) - len(seq_ids), 4)
+        # The same names in different subsets are different sequences
+        dd.update_priorities(np.arange(len(dd._seq_start)), np.zeros(12))
+        dd.update_priorities([4], [1.])
+        batch = dd.next()
+        self.assertEqual(batch['seq_id'].tolist(), [4] * 4)
+        self.assertEqual(batch['subset'].tolist(),
+                         [dd._prefixes[dd._seq_prefix[4]]] * 4)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,96 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dataset_loaders.parallel_loader import ThreadedDataset
+
+
+class TestDataset(ThreadedDataset):
+    name = 'test_sharding'
+    non_void_nclasses = 2
+    _void_labels = []
+    data_shape = (2, 2, 1)
+    path = shared_path = tempfile.mkdtemp()
+
+    def __init__(self, raiseIO=False, *args, **kwargs):
+        self.raiseIO = raiseIO
+        super(TestDataset, self).__init__(*args, **kwargs)
+
+    def get_names(self):
+        return dict(('p%d' % p, ['p%d_%02d' % (p, i) for i in range(9)])
+                    for p in range(3))
+
+    def load_sequence(self, sequence):
+        if self.raiseIO:
+            raise IOError('Cannot read {}'.format(sequence[0][1]))
+        shape = (len(sequence),) + tuple(self.data_shape)
+        return {'data': np.zeros(shape, 'float32'),
+                'labels': np.zeros(shape[:3], 'int32'),
+                'subset': sequence[0][0],
+                'filenames': np.array([name for _, name in sequence])}
+
+
+def _epoch_filenames(dd):
+    '''Return the filenames of each batch of one epoch'''
+    batches = []
+    while True:
+        try:
+            batches.append(dd.next()['filenames'].ravel().tolist())
+        except StopIteration:
+            return batches
+
+
+class TestSharding(unittest.TestCase):
+    def _shards(self, num_shards, batch_size=2, **kwargs):
+        return [_epoch_filenames(TestDataset(
+            batch_size=batch_size, num_shards=num_shards, shard_id=i,
+            infinite_iterator=False, **kwargs)) for i in range(num_shards)]
+
+    def testDisjoint(self):
+        # 27 frames in 14 batches: the last two are dropped
+        shards = self._shards(4, pad_shards=False)
+        files = sum([sum(batches, []) for batches in shards], [])
+        self.assertEqual(len(files), len(set(files)))
+        self.assertEqual(len(files), 12 * 2)
+        self.assertEqual(set(len(batches) for batches in shards), set([3]))
+
+    def testPadded(self):
+        shards = self._shards(4, pad_shards=True)
+        self.assertEqual(set(len(batches) for batches in shards), set([4]))
+        # All the frames are returned, the padding repeats a few batches
+        files = sum([sum(batches, []) for batches in shards], [])
+        self.assertEqual(len(set(files)), 27)
+
+    def testSameSteps(self):
+        # Different number of shards, with and without threads
+        for num_shards in (2, 3, 5):
+            for use_threads in (False, True):
+                nsteps = [len(batches) for batches in self._shards(
+                    num_shards, use_threads=use_threads)]
+                self.assertEqual(len(set(nsteps)), 1)
+
+    def testFewerBatchesThanShards(self):
+        # 27 frames in 3 batches of 10
+        for use_threads in (False, True):
+            with self.assertRaises(ValueError):
+                TestDataset(batch_size=10, num_shards=4, pad_shards=False,
+                            use_threads=use_threads)
+        shards = self._shards(4, batch_size=10, pad_shards=True)
+        self.assertEqual(set(len(batches) for batches in shards), set([1]))
+
+    def testAllQuarantined(self):
+        dd = TestDataset(raiseIO=True, quarantine=True, batch_size=2,
+                         num_shards=2, shard_id=1)
+        with self.assertRaises(RuntimeError):
+            for _ in range(20):
+                dd.next()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,77 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dataset_loaders.parallel_loader import ThreadedDataset
+
+
+class TestDataset(ThreadedDataset):
+    name = 'test_state_dict'
+    non_void_nclasses = 4
+    _void_labels = [4]
+    data_shape = (6, 8, 3)
+    path = shared_path = tempfile.mkdtemp()
+
+    def get_names(self):
+        return dict(('p%d' % p, ['p%d_%03d' % (p, i) for i in range(7)])
+                    for p in range(3))
+
+    def load_sequence(self, sequence):
+        X, Y = [], []
+        for prefix, name in sequence:
+            rng = np.random.RandomState(int(name[1]) * 100 + int(name[3:]))
+            X.append(rng.random_sample(self.data_shape).astype('float32'))
+            Y.append(rng.randint(0, 5, self.data_shape[:2]))
+        return {'data': np.array(X), 'labels': np.array(Y),
+                'subset': prefix,
+                'filenames': np.array([name for _, name in sequence])}
+
+
+def _new_dataset(**kwargs):
+    return TestDataset(batch_size=2, infinite_iterator=False,
+                       data_augm_kwargs={'horizontal_flip': 0.5,
+                                         'rotation_range': 20},
+                       **kwargs)
+
+
+class TestStateDict(unittest.TestCase):
+    def _check_resume(self, nbatches, **kwargs):
+        '''Save the state after `nbatches` and compare the next ones'''
+        dd = _new_dataset(rng=np.random.RandomState(1), **kwargs)
+        for _ in range(nbatches):
+            dd.next()
+        if nbatches == dd.nbatches:
+            self.assertRaises(StopIteration, dd.next)
+        state = dd.state_dict()
+        expected = [dd.next() for _ in range(5)]
+
+        resumed = _new_dataset(rng=np.random.RandomState(2), **kwargs)
+        resumed.load_state_dict(state)
+        for exp in expected:
+            ret = resumed.next()
+            for k in ('data', 'labels', 'filenames'):
+                np.testing.assert_array_equal(ret[k], exp[k])
+        for d in (dd, resumed):
+            if d.use_threads:
+                d.finish()
+
+    def testMidEpoch(self):
+        self._check_resume(4)
+
+    def testEpochBoundary(self):
+        # The state is saved right after the StopIteration
+        dd = _new_dataset()
+        self._check_resume(dd.nbatches)
+
+    def testThreads(self):
+        self._check_resume(4, use_threads=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestDataset.path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,194 @@
+"""Check that every image/frame of a dataset can be loaded and is valid.
+
+Usage::
+
+    python -m dataset_loaders.verify <DatasetName> --sets train,val
+
+The images and labels are decoded in parallel by a pool of processes.
+For each image the shape is checked against the `data_shape` of the
+dataset and the labels against its `GTclasses` (or the range of its
+classes) and `_void_labels`. A JSON report is written, along with the
+manifest of the files and the header index of their sizes (see
+:meth:`~parallel_loader.ThreadedDataset.image_sizes`) as by-products.
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import sys
+from time import time
+
+import numpy as np
+
+import dataset_loaders
+from dataset_loaders.parallel_loader import _file_key
+
+# The dataset of each worker process
+_dataset = None
+
+
+def get_dataset_class(name):
+    '''Return a dataset class out of its class name, `name` attribute or
+    dotted path (e.g., `mypackage.mymodule.MyDataset`)'''
+    if '.' in name:
+        module, cls = name.rsplit('.', 1)
+        return getattr(importlib.import_module(module), cls)
+    for cls_name in dataset_loaders.__all__:
+        cls = getattr(dataset_loaders, cls_name)
+        if name in (cls_name, cls.name):
+            return cls
+    raise ValueError('Unknown dataset {}. Valid values are: {}'.format(
+        name, dataset_loaders.__all__))
+
+
+def _load_dataset(cls, which_set, **kwargs):
+    return cls(which_set=which_set, batch_size=1, seq_length=0,
+               use_threads=False, shuffle_at_each_epoch=False,
+               return_01c=True, **kwargs)
+
+
+def _init_worker(cls, which_set):
+    global _dataset
+    _dataset = _load_dataset(cls, which_set)
+
+
+def check_frame(i):
+    '''Load the i-th image/frame of the dataset of the worker
+
+    Returns a tuple `(i, size, error, bad_shape, bad_labels)` where
+    `size` is the (rows, cols) of the image, `error` the error raised
+    while loading it, if any, `bad_shape` a description of the shape
+    mismatch, if any, and `bad_labels` a dict of the count of each
+    unexpected label value.
+    '''
+    ds = _dataset
+    prefix = ds._prefixes[ds._names_prefix[i]].tolist()
+    # The names are not necessarily strings, e.g., dicts in mscoco
+    name = ds._names[i:i + 1].tolist()[0]
+    try:
+        ret = ds.load_sequence(((prefix, name),))
+    except Exception as e:
+        return i, (0, 0), '{}: {}'.format(type(e).__name__, e), None, {}
+    data, labels = np.asarray(ret['data']), np.asarray(ret['labels'])
+    if data.ndim == 4:
+        data = data[0]
+    size = tuple(data.shape[:2])
+
+    bad_shape = None
+    expected = getattr(type(ds), 'data_shape', None)
+    if data.ndim != 3:
+        bad_shape = 'data has shape {}'.format(data.shape)
+    elif expected is not None and any(
+            e is not None and e != s for e, s in zip(expected, data.shape)):
+        bad_shape = 'data has shape {}, expected {}'.format(data.shape,
+                                                            tuple(expected))
+    elif ds.set_has_GT and labels.shape[-2:] != size:
+        bad_shape = 'labels have shape {}, data {}'.format(labels.shape,
+                                                           data.shape)
+
+    bad_labels = {}
+    if ds.set_has_GT:
+        values, counts = np.unique(labels, return_counts=True)
+        valid = set(ds._mapping.keys())
+        bad_labels = dict((v, c) for v, c in zip(values.tolist(),
+                                                 counts.tolist())
+                          if v not in valid)
+    return i, size, None, bad_shape, bad_labels
+
+
+def verify_set(cls, which_set, processes=None, quarantine=False):
+    '''Check all the images/frames of a set of a dataset in parallel
+
+    Writes the manifest and the header index of the set in the dataset
+    directory and returns the report of the set as a dict. If
+    `quarantine` is True, the images that fail to load are quarantined
+    (see :class:`~parallel_loader.ThreadedDataset`).
+    '''
+    start = time()
+    ds = _load_dataset(cls, which_set, quarantine=quarantine)
+    nframes = len(ds._names)
+    prefixes = ds._prefixes[ds._names_prefix].tolist()
+    names = ds._names.tolist()
+    sizes = np.zeros((nframes, 2), 'int64')
+    errors, bad_shapes, bad_labels = [], [], {}
+
+    processes = processes or multiprocessing.cpu_count()
+    chunksize = max(1, min(64, nframes // (4 * processes)))
+    pool = multiprocessing.Pool(processes, _init_worker, (cls, which_set))
+    try:
+        results = pool.imap_unordered(check_frame, range(nframes),
+                                      chunksize)
+        for i, size, error, bad_shape, labels in results:
+            key = list(_file_key(prefixes[i], names[i]))
+            sizes[i] = size
+            if error is not None:
+                errors.append(key + [error])
+                if quarantine:
+                    ds._quarantine_sequence([tuple(key)], error)
+            if bad_shape is not None:
+                bad_shapes.append(key + [bad_shape])
+            if labels:
+                for v, c in labels.items():
+                    bad_labels[v] = bad_labels.get(v, 0) + c
+    finally:
+        pool.close()
+        pool.join()
+
+    files = [list(_file_key(p, n)) + s
+             for p, n, s in zip(prefixes, names, sizes.tolist())]
+    with open(ds._cache_path('manifest', '.json'), 'w') as f:
+        json.dump({'dataset': ds.name, 'which_set': which_set,
+                   'files': files}, f)
+    if not errors:
+        np.savez(ds._cache_path('header_index'), key=ds._names_digest(),
+                 sizes=sizes)
+
+    return {'nframes': nframes,
+            'errors': sorted(errors),
+            'bad_shapes': sorted(bad_shapes),
+            'bad_labels': dict((str(v), c) for v, c in bad_labels.items()),
+            'ok': not (errors or bad_shapes or bad_labels),
+            'seconds': time() - start}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m dataset_loaders.verify',
+        description='Check that every image/frame of a dataset can be '
+        'loaded and is valid.')
+    parser.add_argument('dataset', help='The class name or the name of '
+                        'the dataset (e.g., CamvidDataset or camvid), or '
+                        'the dotted path of a dataset class')
+    parser.add_argument('--sets', default='train,val,test',
+                        help='Comma-separated list of the sets to check. '
+                        'Default: %(default)s')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='The number of processes. Default: the '
+                        'number of CPUs')
+    parser.add_argument('--report', default=None,
+                        help='The path of the JSON report. Default: '
+                        'verify_<dataset>.json')
+    parser.add_argument('--quarantine', action='store_true',
+                        help='Quarantine the images that fail to load')
+    args = parser.parse_args(argv)
+
+    cls = get_dataset_class(args.dataset)
+    report = {'dataset': cls.name, 'sets': {}}
+    for which_set in args.sets.split(','):
+        print('Verifying {} - {}'.format(cls.name, which_set))
+        rep = verify_set(cls, which_set, args.processes, args.quarantine)
+        report['sets'][which_set] = rep
+        print('  {} images/frames in {:.1f}s: {} errors, {} bad shapes, '
+              '{} unexpected label values'.format(
+                  rep['nframes'], rep['seconds'], len(rep['errors']),
+                  len(rep['bad_shapes']), len(rep['bad_labels'])))
+    report_path = args.report or 'verify_{}.json'.format(cls.name)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Report written in {}'.format(report_path))
+    ok = all(rep['ok'] for rep in report['sets'].values())
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
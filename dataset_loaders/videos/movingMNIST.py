@@ -247,6 +247,17 @@ class MovingMNISTDataset(ThreadedDataset):
         self._reset(self, *args, **kwargs)
         super(MovingMNISTDataset, self)._fill_names_batches(*args, **kwargs)
 
+    def state_dict(self):
+        state_dict = super(MovingMNISTDataset, self).state_dict()
+        state_dict['digits_rng'] = self._rng.get_state()
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        super(MovingMNISTDataset, self).load_state_dict(state_dict)
+        # Restore the digit generator after the names have been refilled,
+        # since that resets it
+        self._rng.set_state(state_dict['digits_rng'])
+
     def load_sequence(self, sequence):
         """Load a sequence of images/frames
 
@@ -0,0 +1,121 @@
+import multiprocessing
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+from threading import Lock, Thread
+from time import sleep
+import weakref
+
+
+class WorkerPool(object):
+    """
+    A pool of fetcher threads shared by several datasets.
+
+    Instead of starting their own fetcher threads, the threaded datasets
+    created with a `worker_pool` register to the pool, whose workers
+    load the batches of names queued by any of them. A worker only picks
+    a batch of a dataset if there is room for it in the dataset's
+    `data_queue`, so datasets that are not being iterated (e.g., the
+    validation set during training) do not hold any worker.
+
+    Among the datasets with batches to load, the ones with the highest
+    priority are served first, and the ones with the same priority in
+    turn. The quota of a dataset limits the number of workers that load
+    its batches at the same time.
+
+    Parameters
+    ----------
+    nthreads: int
+        The number of worker threads. If None, the number of CPUs is
+        used. Default: None.
+    """
+    _wait_time = 0.01
+
+    def __init__(self, nthreads=None):
+        self.nthreads = nthreads or multiprocessing.cpu_count()
+        self._lock = Lock()
+        # One [weakref, priority, quota, in_flight] entry per dataset
+        self._datasets = []
+        self._turn = 0
+        self.workers = []
+        for _ in range(self.nthreads):
+            worker = Thread(target=_pool_worker, args=(weakref.ref(self),))
+            worker.setDaemon(True)  # Die when main dies
+            worker.start()
+            self.workers.append(worker)
+
+    def register(self, dataset, priority=0, quota=None):
+        '''Let the workers load the batches queued by `dataset`'''
+        with self._lock:
+            self._datasets.append([weakref.ref(dataset), priority, quota, 0])
+
+    def unregister(self, dataset):
+        '''Stop loading the batches of `dataset`'''
+        with self._lock:
+            self._datasets = [el for el in self._datasets
+                              if el[0]() not in (dataset, None)]
+
+    def _next_job(self):
+        '''Pick the next batch of names to load, if any
+
+        Returns a tuple `(entry, dataset, item)` or None.
+        '''
+        with self._lock:
+            self._datasets = [el for el in self._datasets
+                              if el[0]() is not None]
+            if not self._datasets:
+                return None
+            # Sort by priority, starting from a different dataset at
+            # each call to serve the ones with the same priority in turn
+            self._turn = (self._turn + 1) % len(self._datasets)
+            entries = self._datasets[self._turn:] + self._datasets[:self._turn]
+            for entry in sorted(entries, key=lambda el: -el[1]):
+                dataset = entry[0]()
+                if dataset is None or (entry[2] is not None and
+                                       entry[3] >= entry[2]):
+                    continue
+                # Make sure there is room for the batch in the data_queue
+                if (dataset.data_queue.qsize() + entry[3] >=
+                        dataset.queues_size):
+                    continue
+                try:
+                    item = dataset.names_queue.get(False)
+                except Queue.Empty:
+                    continue
+                entry[3] += 1
+                return entry, dataset, item
+        return None
+
+    def _job_done(self, entry):
+        with self._lock:
+            entry[3] -= 1
+
+
+_default_worker_pool = []
+
+
+def default_worker_pool():
+    '''Return the process-wide :class:`WorkerPool`, creating it if needed'''
+    if not _default_worker_pool:
+        _default_worker_pool.append(WorkerPool())
+    return _default_worker_pool[0]
+
+
+def _pool_worker(weakpool):
+    '''Load the batches picked by the pool, until the pool is deleted'''
+    while True:
+        pool = weakpool()
+        if pool is None:
+            break
+        job = pool._next_job()
+        if job is None:
+            del pool  # Allow the gc to delete the pool if needed
+            sleep(WorkerPool._wait_time)
+            continue
+        entry, dataset, item = job
+        try:
+            dataset._fetch_names_batch(item)
+        finally:
+            pool._job_done(entry)
+            del pool, dataset, job